@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+"""Micro-benchmarks for json-patch.py.
+
+Run from the repository root::
+
+    python json-patch-bench.py [--number N] [--repeat R] [--json FILE]
+                               [--only NAME ...]
+
+Every benchmark prints the best per-call time out of ``--repeat`` runs.
+With ``--json``, the results are also written to FILE, along with the
+versions of the library and of Python, so that runs can be compared
+across versions. Documents are generated from a fixed seed, so every run
+measures the same work.
+"""
+
+from __future__ import print_function
+
+import argparse
+import copy
+import importlib.util
+import json
+import os
+import platform
+import random
+import sys
+import timeit
+
+
+def load_jsonpatch():
+    """Imports json-patch.py, whose file name is not a valid module name."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'json-patch.py')
+    spec = importlib.util.spec_from_file_location('jsonpatch', path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['jsonpatch'] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+jsonpatch = load_jsonpatch()
+
+
+def template_doc(width=50):
+    """A document with a few levels of nesting and `width` records."""
+    return {
+        'meta': {'name': 'service', 'version': 1, 'labels': {'tier': 'web'}},
+        'spec': {
+            'replicas': 3,
+            'items': [
+                {'id': i, 'name': 'item-%d' % i, 'tags': ['a', 'b'],
+                 'limits': {'cpu': 1, 'memory': 256}}
+                for i in range(width)
+            ],
+        },
+    }
+
+
+def template_patch(width=50):
+    """An idempotent patch that touches every record of `template_doc`."""
+    patch = [
+        {'op': 'test', 'path': '/meta/name', 'value': 'service'},
+        {'op': 'replace', 'path': '/spec/replicas', 'value': 5},
+    ]
+    for i in range(width):
+        base = '/spec/items/%d' % i
+        patch.append({'op': 'replace', 'path': base + '/limits/cpu',
+                      'value': 2})
+        patch.append({'op': 'add', 'path': base + '/name',
+                      'value': 'item-%d' % i})
+        patch.append({'op': 'move', 'path': base + '/tags/0',
+                      'from': base + '/tags/1'})
+        patch.append({'op': 'copy', 'path': base + '/limits/memory',
+                      'from': base + '/limits/memory'})
+    return patch
+
+
+def record(rng, i):
+    """A small record, as found in arrays of real documents."""
+    return {'id': i, 'name': 'record-%d' % i, 'score': rng.randint(0, 100),
+            'tags': ['t%d' % rng.randint(0, 9) for _ in range(3)]}
+
+
+def wide_dict_pair(rng, width=5000, changes=50):
+    """An object with `width` members, of which `changes` differ."""
+    src = dict(('key%05d' % i, record(rng, i)) for i in range(width))
+    dst = copy.deepcopy(src)
+    for key in rng.sample(sorted(dst), changes):
+        dst[key]['score'] = -1
+    for i in range(changes // 2):
+        dst['new%05d' % i] = i
+    return src, dst
+
+
+def deep_tree(rng, depth, fanout):
+    """A tree `depth` levels deep with `fanout` children per object."""
+    if depth == 0:
+        return rng.randint(0, 1000)
+    return dict(('n%d' % i, deep_tree(rng, depth - 1, fanout))
+                for i in range(fanout))
+
+
+def deep_tree_pair(rng, depth=8, fanout=3, changes=20):
+    """A deep tree and a copy of it with `changes` leaves replaced."""
+    src = deep_tree(rng, depth, fanout)
+    dst = copy.deepcopy(src)
+    for _ in range(changes):
+        node = dst
+        for _ in range(depth - 1):
+            node = node['n%d' % rng.randrange(fanout)]
+        node['n%d' % rng.randrange(fanout)] = -1
+    return src, dst
+
+
+def array_inserts_pair(rng, length=2000, inserts=50):
+    """A long array of records and a copy with `inserts` new ones."""
+    src = [record(rng, i) for i in range(length)]
+    dst = list(src)
+    for i in range(inserts):
+        dst.insert(rng.randint(0, len(dst)), record(rng, length + i))
+    return src, dst
+
+
+def array_moves_pair(rng, length=2000, moves=50):
+    """A long array of records and a copy with `moves` of them moved."""
+    src = [record(rng, i) for i in range(length)]
+    dst = list(src)
+    for _ in range(moves):
+        dst.insert(rng.randint(0, len(dst) - 1),
+                   dst.pop(rng.randrange(len(dst))))
+    return src, dst
+
+
+def array_reorder_pair(rng, length=500):
+    """A long array of records and a shuffled copy of it."""
+    src = [record(rng, i) for i in range(length)]
+    dst = list(src)
+    rng.shuffle(dst)
+    return src, dst
+
+
+def large_strings_pair(rng, count=20, size=100000):
+    """An object with `count` strings of `size` characters, half changed."""
+    alphabet = 'abcdefghijklmnopqrstuvwxyz '
+    src = dict(('text%d' % i,
+                ''.join(rng.choice(alphabet) for _ in range(size)))
+               for i in range(count))
+    dst = dict(src)
+    for key in sorted(dst)[::2]:
+        dst[key] = dst[key][1:] + '.'
+    return src, dst
+
+
+# Name -> function returning a (source, destination) pair of documents
+SHAPES = [
+    ('wide_dict', wide_dict_pair),
+    ('deep_tree', deep_tree_pair),
+    ('array_inserts', array_inserts_pair),
+    ('array_moves', array_moves_pair),
+    ('array_reorder', array_reorder_pair),
+    ('large_strings', large_strings_pair),
+]
+
+
+def best_time(func, number, repeat, setup=None):
+    """The best time per call of `func` out of `repeat` runs of `number`
+    calls, not counting `setup`, which is called before every call."""
+    if setup is None:
+        return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+    best = None
+    for _ in range(repeat):
+        total = 0.0
+        for _ in range(number):
+            arg = setup()
+            start = timeit.default_timer()
+            func(arg)
+            total += timeit.default_timer() - start
+        if best is None or total < best:
+            best = total
+    return best / number
+
+
+def report(results, benchmark, case, seconds, **info):
+    """Prints a result and adds it to `results`."""
+    results.append(dict(benchmark=benchmark, case=case, seconds=seconds,
+                        **info))
+    print('{0:<22} {1:<26} {2:12.1f} us'.format(
+        benchmark, case, seconds * 1e6))
+
+
+def bench_compiled_apply(results, number, repeat):
+    """Per-apply cost of the generic, prebuilt and compiled patch paths."""
+    doc = template_doc()
+    raw = template_patch()
+    patch = jsonpatch.JsonPatch(raw)
+    compiled = patch.compile()
+    specialized = patch.compile(specialize=True, sample=doc)
+
+    cases = [
+        ('apply_patch(doc, list)',
+         lambda: jsonpatch.apply_patch(doc, raw, in_place=True)),
+        ('JsonPatch.apply', lambda: patch.apply(doc, in_place=True)),
+        ('CompiledPatch.apply', lambda: compiled.apply(doc, in_place=True)),
+        ('specialized apply',
+         lambda: specialized.apply(doc, in_place=True)),
+    ]
+    for name, func in cases:
+        report(results, 'compiled_apply', name,
+               best_time(func, number, repeat), ops=len(raw))
+
+
+def bench_small_patches(results, number, repeat):
+    """In-place apply of patches of a few operations, the common case."""
+    doc = template_doc()
+    raw = [
+        {'op': 'replace', 'path': '/spec/replicas', 'value': 5},
+        {'op': 'add', 'path': '/meta/labels/zone', 'value': 'eu'},
+        {'op': 'replace', 'path': '/spec/items/3/limits/cpu', 'value': 2},
+    ]
+    for size in (1, 3):
+        patch = jsonpatch.JsonPatch(raw[:size])
+        report(results, 'small_patches', '%d op(s) (in_place)' % size,
+               best_time(lambda: patch.apply(doc, in_place=True), number,
+                         repeat), ops=size)
+
+
+def bench_small_diffs(results, number, repeat):
+    """make_patch between small documents, the common case."""
+    src = template_doc(width=3)
+    dst = copy.deepcopy(src)
+    dst['spec']['replicas'] = 5
+    dst['spec']['items'][1]['limits']['cpu'] = 2
+    cases = [
+        ('template_doc(3)', src, dst),
+        ('20 element shift', list(range(20)), [-1] + list(range(20))),
+    ]
+    for name, src, dst in cases:
+        report(results, 'small_diffs', name,
+               best_time(lambda: jsonpatch.make_patch(src, dst), number,
+                         repeat))
+
+
+def bench_copy_on_write(results, number, repeat):
+    """Not-in-place apply of a small patch to a large document."""
+    doc = template_doc(width=5000)
+    patch = jsonpatch.JsonPatch([
+        {'op': 'replace', 'path': '/spec/replicas', 'value': 5},
+        {'op': 'add', 'path': '/meta/labels/zone', 'value': 'eu'},
+        {'op': 'remove', 'path': '/spec/items/10/tags/0'},
+        {'op': 'move', 'path': '/spec/items/0', 'from': '/spec/items/4000'},
+    ])
+
+    cases = [
+        ('apply (deepcopy)', lambda: patch.apply(doc)),
+        ('apply (copy_on_write)',
+         lambda: patch.apply(doc, copy_on_write=True)),
+    ]
+    calls = max(1, number // 100)
+    for name, func in cases:
+        report(results, 'copy_on_write', name,
+               best_time(func, calls, repeat), records=5000)
+
+
+def bench_shapes(results, number, repeat):
+    """Diffing, applying, serializing and comparing patches between the
+    documents of every shape in `SHAPES`."""
+    calls = max(1, number // 100)
+    for name, make_pair in SHAPES:
+        src, dst = make_pair(random.Random(name))
+        patch = jsonpatch.make_patch(src, dst)
+        info = {'ops': len(patch.patch)}
+
+        report(results, 'make_patch', name,
+               best_time(lambda: jsonpatch.make_patch(src, dst), calls,
+                         repeat), **info)
+        keyed = jsonpatch.make_patch(src, dst, list_key='id')
+        report(results, 'make_patch (list_key)', name,
+               best_time(lambda: jsonpatch.make_patch(src, dst, list_key='id'),
+                         calls, repeat), ops=len(keyed.patch))
+        report(results, 'apply_patch', name + ' (copy)',
+               best_time(lambda: jsonpatch.apply_patch(src, patch.patch),
+                         calls, repeat), **info)
+        report(results, 'apply_patch', name + ' (in_place)',
+               best_time(lambda doc: jsonpatch.apply_patch(
+                   doc, patch.patch, in_place=True),
+                         calls, repeat, setup=lambda: copy.deepcopy(src)),
+               **info)
+
+        text = patch.to_string()
+        report(results, 'to_string', name,
+               best_time(patch.to_string, calls, repeat), **info)
+        report(results, 'from_string', name,
+               best_time(lambda: jsonpatch.JsonPatch.from_string(text),
+                         calls, repeat), **info)
+
+        other = jsonpatch.JsonPatch.from_string(text)
+        report(results, 'equality', name,
+               best_time(lambda: patch == other, calls, repeat), **info)
+
+
+def bench_tracking(results, number, repeat):
+    """A few changes to a large document, as a diff of copies from before
+    and after them and as recorded by a tracked document."""
+    doc = template_doc(width=5000)
+
+    def change(items):
+        for i in range(0, len(items), 500):
+            items[i]['limits']['cpu'] = 2
+        items.insert(10, {'id': -1})
+        del items[4000]
+
+    def diff(src):
+        dst = copy.deepcopy(src)
+        change(dst['spec']['items'])
+        return jsonpatch.make_patch(src, dst)
+
+    def tracked(src):
+        tracked = jsonpatch.track(src)
+        change(tracked['spec']['items'])
+        return tracked.patch()
+
+    calls = max(1, number // 100)
+    for name, func in [('make_patch', diff), ('track', tracked)]:
+        report(results, 'tracking', name,
+               best_time(func, calls, repeat,
+                         setup=lambda: copy.deepcopy(doc)),
+               records=5000)
+
+
+def bench_hashing(results, number, repeat):
+    """Hashing of patches, whose operations must have hashable values."""
+    src, dst = wide_dict_pair(random.Random('hashing'))
+    for key in dst:
+        if isinstance(dst[key], dict):
+            dst[key] = dst[key]['score']
+    patch = jsonpatch.make_patch(src, dst)
+    report(results, 'hash', 'wide_dict (scalars)',
+           best_time(lambda: hash(patch), number, repeat),
+           ops=len(patch.patch))
+
+
+BENCHMARKS = [
+    ('compiled_apply', bench_compiled_apply),
+    ('small_patches', bench_small_patches),
+    ('small_diffs', bench_small_diffs),
+    ('copy_on_write', bench_copy_on_write),
+    ('shapes', bench_shapes),
+    ('tracking', bench_tracking),
+    ('hashing', bench_hashing),
+]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=200,
+                        help='calls per timing run')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='timing runs per benchmark')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results to FILE as JSON')
+    parser.add_argument('--only', nargs='+', metavar='NAME',
+                        choices=[name for name, _ in BENCHMARKS],
+                        help='run only these benchmarks')
+    args = parser.parse_args(argv)
+
+    results = []
+    for name, bench in BENCHMARKS:
+        if args.only is None or name in args.only:
+            bench(results, args.number, args.repeat)
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({
+                'jsonpatch': jsonpatch.__version__,
+                'python': platform.python_version(),
+                'implementation': platform.python_implementation(),
+                'number': args.number,
+                'repeat': args.repeat,
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+            output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
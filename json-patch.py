@@ -1,18 +1,23 @@
 from __future__ import unicode_literals
 
 
+import bisect
 import collections
 import copy
+import fnmatch
 import functools
 import json
+import multiprocessing
+import re
 import sys
+import threading
 
 
 
 try:
-    from collections.abc import Sequence
+    from collections.abc import Mapping, Sequence
 except ImportError:  # Python 3
-    from collections import Sequence
+    from collections import Mapping, Sequence
 
 try:
     from types import MappingProxyType
@@ -22,6 +27,11 @@ except ImportError:
 
 from jsonpointer import JsonPointer, JsonPointerException
 
+try:
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+except ImportError:  # Python 2
+    ProcessPoolExecutor = ThreadPoolExecutor = None
+
 
 _ST_ADD = 0
 _ST_REMOVE = 1
@@ -68,6 +78,16 @@ class JsonPatchTestFailed(JsonPatchException, AssertionError):
     """ A Test operation failed """
 
 
+# The result of applying a patch to one document of `JsonPatch.apply_many()`:
+# the position of the document, the patched document and the error that made
+# the patch fail, of which exactly one is None.
+ApplyResult = collections.namedtuple('ApplyResult', ['index', 'doc', 'error'])
+
+# Errors that make a patch fail for one document but not for the others
+_DOCUMENT_ERRORS = (JsonPatchConflict, JsonPatchTestFailed,
+                    JsonPointerException)
+
+
 def multidict(ordered_pairs):
     """Convert duplicate keys values to lists."""
     # read all values into lists
@@ -87,7 +107,8 @@ def multidict(ordered_pairs):
 _jsonloads = functools.partial(json.loads, object_pairs_hook=multidict)
 
 
-def apply_patch(doc, patch, in_place=False, pointer_cls=JsonPointer):
+def apply_patch(doc, patch, in_place=False, pointer_cls=JsonPointer,
+                copy_on_write=False, atomic=False):
     """
     This function applies a JSON Patch to a JSON document (the "doc" argument),
     optionally modifying the document "in place".
@@ -102,6 +123,11 @@ def apply_patch(doc, patch, in_place=False, pointer_cls=JsonPointer):
             as a new modified document (`False`).
         pointer_cls (int): The `pointer_cls` parameter is used to specify the class
             to use for creating JSON pointers during the application of the patch.
+        copy_on_write (bool): The `copy_on_write` parameter makes a patch that is
+            not applied in place copy only the containers it modifies; see
+            `JsonPatch.apply()`.
+        atomic (bool): The `atomic` parameter makes a patch applied in place
+            undo its changes if it fails; see `JsonPatch.apply()`.
 
     Returns:
         : The output of this function is a `JsonPatch` object that has applied the
@@ -112,11 +138,15 @@ def apply_patch(doc, patch, in_place=False, pointer_cls=JsonPointer):
         patch = JsonPatch.from_string(patch, pointer_cls=pointer_cls)
     else:
         patch = JsonPatch(patch, pointer_cls=pointer_cls)
-    return patch.apply(doc, in_place)
+    return patch.apply(doc, in_place, copy_on_write=copy_on_write,
+                       atomic=atomic)
 
 
 
-def make_patch(src, dst, pointer_cls=JsonPointer):
+def make_patch(src, dst, pointer_cls=JsonPointer, align_lists=False,
+               workers=None, optimization=True, list_key=None,
+               replace_subtrees=False, max_ops=None, include=None,
+               exclude=None):
     
     """
     This function creates a JSON patch from the difference between two JSON objects.
@@ -133,17 +163,113 @@ def make_patch(src, dst, pointer_cls=JsonPointer):
             that will be used to generate the JSON patch.
         pointer_cls (int): The `pointer_cls` parameter is an optional type hint
             for the `JsonPointer` class.
+        align_lists (bool): The `align_lists` parameter makes arrays be diffed
+            by aligning their elements instead of by position; see
+            `JsonPatch.from_diff()`.
+        workers (int): The `workers` parameter compares the top-level members
+            of `src` and `dst` in that many processes; see
+            `JsonPatch.from_diff()`.
+        optimization (str): The `optimization` parameter trades the time
+            taken to diff for the size of the patch; see
+            `JsonPatch.from_diff()`.
+        list_key (str): The `list_key` parameter makes the records of arrays
+            be matched by the value of this member rather than by position;
+            see `JsonPatch.from_diff()`.
+        replace_subtrees (bool): The `replace_subtrees` parameter replaces
+            changed objects and arrays whole where that encodes smaller; see
+            `JsonPatch.from_diff()`.
+        max_ops (int): The `max_ops` parameter bounds the number of
+            operations of the patch; see `JsonPatch.from_diff()`.
+        include (list): The `include` parameter is the patterns of the
+            locations to compare; see `JsonPatch.from_diff()`.
+        exclude (list): The `exclude` parameter is the patterns of the
+            locations not to compare; see `JsonPatch.from_diff()`.
 
     Returns:
         dict: The function `make_patch` returns a `JsonPatch` object.
 
     """
-    return JsonPatch.from_diff(src, dst, pointer_cls=pointer_cls)
+    return JsonPatch.from_diff(src, dst, optimization=optimization,
+                               pointer_cls=pointer_cls,
+                               align_lists=align_lists, workers=workers,
+                               list_key=list_key,
+                               replace_subtrees=replace_subtrees,
+                               max_ops=max_ops, include=include,
+                               exclude=exclude)
+
+
+def iter_diff(src, dst, pointer_cls=JsonPointer, align_lists=False,
+              max_pending=1000, dumps=None, optimization=True, list_key=None,
+              replace_subtrees=False, include=None, exclude=None):
+    """
+    This function generates the JSON patch from `src` to `dst` one operation
+    at a time, so that it can be written out while the documents are still
+    being compared, without holding the whole patch in memory.
+
+    At most about `max_pending` operations are held back at once. To stay
+    within that bound, values that were removed or added more than
+    `max_pending` operations earlier are no longer matched into `move`
+    operations, so a large diff may use `remove` and `add` where
+    `make_patch()` would have used `move`. Pass `max_pending=None` to get
+    the same operations as `make_patch()`, yielded once the comparison ends.
+
+    >>> src = {'foo': 'bar', 'numbers': [1, 3, 4, 8]}
+    >>> dst = {'baz': 'qux', 'numbers': [1, 4, 7]}
+    >>> list(iter_diff(src, dst)) == make_patch(src, dst).patch
+    True
+
+    Whatever the bound, the operations make a patch that turns `src` into
+    `dst`:
+
+    >>> src = {'l': [1, [1], 2, [1]]}
+    >>> dst = {'l': [3, [2, 3], [1], [2, 3]]}
+    >>> all(JsonPatch(list(iter_diff(src, dst, max_pending=bound))).apply(src)
+    ...     == dst for bound in (None, 1, 2, 3, 5, 10))
+    True
+
+    Args:
+        src (dict): The `src` input parameter is the original document.
+        dst (dict): The `dst` input parameter is the updated document.
+        pointer_cls (type): The `pointer_cls` parameter is the JSON pointer
+            class to use.
+        align_lists (bool): The `align_lists` parameter makes arrays be
+            diffed by aligning their elements; see `JsonPatch.from_diff()`.
+        max_pending (int): The `max_pending` parameter bounds the number of
+            operations held back, or None for no bound.
+        dumps (function): The `dumps` parameter is the JSON serializer used
+            to compare values that are not plain JSON types.
+        optimization (str): The `optimization` parameter trades the time
+            taken to diff for the size of the patch; see
+            `JsonPatch.from_diff()`.
+        list_key (str): The `list_key` parameter makes the records of arrays
+            be matched by the value of this member rather than by position;
+            see `JsonPatch.from_diff()`.
+        replace_subtrees (bool): The `replace_subtrees` parameter replaces
+            changed objects and arrays whole where that encodes smaller; see
+            `JsonPatch.from_diff()`.
+        include (list): The `include` parameter is the patterns of the
+            locations to compare; see `JsonPatch.from_diff()`.
+        exclude (list): The `exclude` parameter is the patterns of the
+            locations not to compare; see `JsonPatch.from_diff()`.
+
+    Returns:
+        generator: The operations of the patch, as dicts.
+
+    """
+    builder = _diff_builder(src, dst, dumps or JsonPatch.json_dumper,
+                            pointer_cls, align_lists, optimization, list_key,
+                            replace_subtrees, include=include,
+                            exclude=exclude)
+    return builder.iter_operations(max_pending)
 
 
 class PatchOperation(object):
     """A single operation inside a JSON Patch."""
 
+    _route = None
+    _from_route = None
+    _parsed_from = None
+
     def __init__(self, operation, pointer_cls=JsonPointer):
         """
         This function takes an "operation" argument and a pointer class "pointer_cls"
@@ -175,9 +301,224 @@ class PatchOperation(object):
         self.operation = operation
 
     def apply(self, obj):
-        """Abstract method that applies a patch operation to the specified object."""
+        """Applies the patch operation to the specified object."""
+        return self._apply(obj, None)
+
+    def _apply(self, obj, cache):
+        """
+        Abstract method that applies a patch operation to the specified object,
+        resolving its pointers through `cache` and telling it about the
+        containers it modifies.
+
+        Args:
+            obj (dict): The `obj` input parameter is the document to patch.
+            cache (_ParentCache): The `cache` input parameter holds the
+                containers resolved by the operations of the patch so far, or
+                is None.
+
+        """
         raise NotImplementedError('should implement the patch operation.')
 
+    def _compile(self):
+        """
+        This function prepares the operation for repeated application by
+        pre-splitting its pointer into typed parts, so that applying it no
+        longer goes through the generic pointer walk.
+
+        """
+        self._route = _CompiledPointer.for_pointer(self.pointer)
+
+    def _to_last(self, obj, cache=None):
+        """
+        This function resolves the operation's pointer up to its last part,
+        using the parents in `cache`, or the compiled route when the operation
+        has been compiled.
+
+        Args:
+            obj (dict): The `obj` input parameter is the document the pointer
+                is resolved against.
+            cache (_ParentCache): The `cache` input parameter is the optional
+                cache of the containers resolved so far.
+
+        Returns:
+            tuple: The parent container and the last part of the pointer, as
+            returned by `JsonPointer.to_last()`.
+
+        """
+        if cache is not None:
+            return cache.to_last(obj, self.pointer, self.location)
+        route = self._route
+        if route is None:
+            return self.pointer.to_last(obj)
+        return route.to_last(obj)
+
+    def _copy_on_write(self, obj, copies):
+        """
+        This function shallow-copies the containers of `obj` that applying the
+        operation would modify, from the root down, so that it can be applied
+        without changing the original document.
+
+        Args:
+            obj (dict): The `obj` input parameter is the document the operation
+                is about to be applied to.
+            copies (dict): The `copies` input parameter holds the containers
+                copied so far, by id; see `_copy_path()`.
+
+        Returns:
+            dict: The (possibly copied) root of the document.
+
+        """
+        return _copy_path(obj, self.pointer, copies)
+
+    def _get_from_pointer(self):
+        """
+        This function returns the operation's `from` member as a pointer,
+        parsing it with `pointer_cls` unless it already is one. The pointer is
+        kept for as long as the member is unchanged, so that it is parsed
+        once per operation.
+
+        Returns:
+            JsonPointer: The pointer referenced by the `from` member; callers
+            must not modify it.
+
+        """
+        if self._from_route is not None:
+            return self._from_route.pointer
+
+        try:
+            from_ptr = self.operation['from']
+        except KeyError as ex:
+            raise InvalidJsonPatch(
+                "The operation does not contain a 'from' member")
+
+        parsed = self._parsed_from
+        if parsed is not None and parsed[0] is from_ptr:
+            return parsed[1]
+
+        if isinstance(from_ptr, self.pointer_cls):
+            pointer = from_ptr
+        else:
+            pointer = self.pointer_cls(from_ptr)
+        self._parsed_from = (from_ptr, pointer)
+        return pointer
+
+    def _remove_member(self, subobj, part, cache, pointer):
+        """
+        This function removes the member `part` from the container `subobj`.
+
+        Args:
+            subobj (dict): The `subobj` input parameter is the container, as
+                resolved by `JsonPointer.to_last()`.
+            part (str): The `part` input parameter is the key or index of the
+                member to remove.
+            cache (_ParentCache): The `cache` input parameter is the optional
+                cache of resolved containers to tell about the removal.
+            pointer (JsonPointer): The `pointer` input parameter is the
+                pointer to the member, for the journal of the changes.
+
+        """
+        if isinstance(subobj, Sequence) and not isinstance(part, int):
+            raise JsonPointerException("invalid array index '{0}'".format(part))
+
+        recording = cache is not None and cache.recording
+        try:
+            if recording:
+                value = subobj[part]
+            del subobj[part]
+        except (KeyError, IndexError) as ex:
+            msg = "can't remove a non-existent object '{0}'".format(part)
+            raise JsonPatchConflict(msg)
+
+        if cache is not None:
+            if recording:
+                cache.removed(subobj, part, value, pointer)
+            cache.changed(subobj, part, isinstance(part, int))
+
+    def _add_member(self, obj, subobj, part, value, cache):
+        """
+        This function adds `value` to the container `subobj` as its member
+        `part`, inserting it into arrays.
+
+        Args:
+            obj (dict): The `obj` input parameter is the document.
+            subobj (dict): The `subobj` input parameter is the container, as
+                resolved by `JsonPointer.to_last()`.
+            part (str): The `part` input parameter is the key or index to add
+                the value at; None for the root.
+            value (object): The `value` input parameter is the value to add.
+            cache (_ParentCache): The `cache` input parameter is the optional
+                cache of resolved containers to tell about the addition.
+
+        Returns:
+            dict: The document, which is `value` if it replaced the root.
+
+        """
+        recording = cache is not None and cache.recording
+        if isinstance(subobj, MutableSequence):
+            if part == '-':
+                subobj.append(value)  # pylint: disable=E1103
+                if recording:
+                    cache.added(subobj, len(subobj) - 1, _MISSING,
+                                self.pointer)
+
+            elif part > len(subobj) or part < 0:
+                raise JsonPatchConflict("can't insert outside of list")
+
+            else:
+                subobj.insert(part, value)  # pylint: disable=E1103
+                if cache is not None:
+                    if recording:
+                        cache.added(subobj, part, _MISSING, self.pointer)
+                    cache.changed(subobj, part, True)
+
+        elif isinstance(subobj, MutableMapping):
+            if part is None:
+                if recording:
+                    cache.replaced(None, None, obj, self.pointer)
+                obj = value  # we're replacing the root
+            else:
+                if recording:
+                    cache.added(subobj, part, subobj.get(part, _MISSING),
+                                self.pointer)
+                subobj[part] = value
+                if cache is not None:
+                    cache.changed(subobj, part, False)
+
+        else:
+            if part is None:
+                raise TypeError("invalid document type {0}".format(type(subobj)))
+            else:
+                raise JsonPatchConflict("unable to fully resolve json pointer {0}, part {1}".format(self.location, part))
+        return obj
+
+    def _from_to_last(self, obj, cache=None):
+        """
+        This function resolves the operation's `from` pointer up to its last
+        part, reusing the pointer parsed by `_compile()` when available.
+
+        Args:
+            obj (dict): The `obj` input parameter is the document the pointer
+                is resolved against.
+            cache (_ParentCache): The `cache` input parameter is the optional
+                cache of the containers resolved so far.
+
+        Returns:
+            tuple: The `from` pointer, its parent container and its last part.
+
+        """
+        route = self._from_route
+        if cache is not None:
+            from_ptr = self._get_from_pointer()
+            subobj, part = cache.to_last(obj, from_ptr, self.operation['from'])
+            return from_ptr, subobj, part
+        if route is None:
+            from_ptr = self._get_from_pointer()
+            subobj, part = from_ptr.to_last(obj)
+            return from_ptr, subobj, part
+
+        subobj, part = route.to_last(obj)
+        return route.pointer, subobj, part
+
     def __hash__(self):
         """
         This function defines a `__hash__` method for an object that returns the
@@ -271,12 +612,13 @@ class PatchOperation(object):
         self.pointer.parts[-1] = str(value)
         self.location = self.pointer.path
         self.operation['path'] = self.location
+        self._route = None
 
 
 class RemoveOperation(PatchOperation):
     """Removes an object property or an array element."""
 
-    def apply(self, obj):
+    def _apply(self, obj, cache):
         """
         This function takes an object `obj` and removes a member specified by a
         JSON pointer `part` from the object. It checks if the member exists and
@@ -290,71 +632,16 @@ class RemoveOperation(PatchOperation):
             : The output returned by this function is the modified object `obj`.
 
         """
-        subobj, part = self.pointer.to_last(obj)
-
-        if isinstance(subobj, Sequence) and not isinstance(part, int):
-            raise JsonPointerException("invalid array index '{0}'".format(part))
-
-        try:
-            del subobj[part]
-        except (KeyError, IndexError) as ex:
-            msg = "can't remove a non-existent object '{0}'".format(part)
-            raise JsonPatchConflict(msg)
-
+        subobj, part = self._to_last(obj, cache)
+        self._remove_member(subobj, part, cache, self.pointer)
         return obj
 
-    def _on_undo_remove(self, path, key):
-        """
-        This function reverses the order of items after undo removal.
-
-        Args:
-            path (str): The `path` input parameter is the path of the node being
-                undone (i.e., removed) from the linked list.
-            key (int): The `key` input parameter determines which key to increment
-                or decrement when an item is undone. If the item was deleted at
-                position `key`, then `key` is subtracted from the current key.
-
-        Returns:
-            int: The output returned by this function is `key`.
-
-        """
-        if self.path == path:
-            if self.key >= key:
-                self.key += 1
-            else:
-                key -= 1
-        return key
-
-    def _on_undo_add(self, path, key):
-        """
-        This function implements an "undo" mechanism for a stack-like data structure.
-
-        Args:
-            path (str): The `path` input parameter specifies the undo path for
-                which the function is being called (i.e., the sequence of keys to
-                be undone).
-            key (int): The `key` input parameter is used to determine which key
-                should be subtracted from the current key if there are multiple
-                undo actions for the same path. If `self.key > key`, then the
-                current key is decremented by the difference between `self.key`
-                and `key`.
-
-        Returns:
-            int: The output returned by this function is `key -= 1`.
-
-        """
-        if self.path == path:
-            if self.key > key:
-                self.key -= 1
-            else:
-                key -= 1
-        return key
 
 
 class AddOperation(PatchOperation):
     """Adds an object property or an array element."""
 
-    def apply(self, obj):
+    def _apply(self, obj, cache):
         """
         This function applies a JSON patch to an object. It takes the object and
         a JSON pointer that specifies the location of the patch.
@@ -377,80 +664,15 @@ class AddOperation(PatchOperation):
             raise InvalidJsonPatch(
                 "The operation does not contain a 'value' member")
 
-        subobj, part = self.pointer.to_last(obj)
-
-        if isinstance(subobj, MutableSequence):
-            if part == '-':
-                subobj.append(value)  # pylint: disable=E1103
-
-            elif part > len(subobj) or part < 0:
-                raise JsonPatchConflict("can't insert outside of list")
-
-            else:
-                subobj.insert(part, value)  # pylint: disable=E1103
-
-        elif isinstance(subobj, MutableMapping):
-            if part is None:
-                obj = value  # we're replacing the root
-            else:
-                subobj[part] = value
-
-        else:
-            if part is None:
-                raise TypeError("invalid document type {0}".format(type(subobj)))
-            else:
-                raise JsonPatchConflict("unable to fully resolve json pointer {0}, part {1}".format(self.location, part))
-        return obj
-
-    def _on_undo_remove(self, path, key):
-        """
-        This function named `_on_undo_remove` when called with `path` and `key`
-        as parameters adjusts the key of an item stored at the path based on the
-        order of other items if any.
-
-        Args:
-            path (str): The `path` parameter is the path of the item being undone.
-            key (int): The `key` input parameter is used to update the key of the
-                item that is being undone.
-
-        Returns:
-            int: The output returned by this function is `key + 1`.
-
-        """
-        if self.path == path:
-            if self.key > key:
-                self.key += 1
-            else:
-                key += 1
-        return key
-
-    def _on_undo_add(self, path, key):
-        """
-        This function undoes an addition operation by decrementing the `key` of
-        the current node and returning the new value.
-
-        Args:
-            path (str): The `path` parameter specifies the path (a sequence of
-                nodes) where the undo action happened.
-            key (int): The `key` input parameter adjusts the key value of the item
-                being undone.
-
-        Returns:
-            int: The output returned by this function is `key + 1`.
+        subobj, part = self._to_last(obj, cache)
+        return self._add_member(obj, subobj, part, value, cache)
 
-        """
-        if self.path == path:
-            if self.key > key:
-                self.key -= 1
-            else:
-                key += 1
-        return key
 
 
 class ReplaceOperation(PatchOperation):
     """Replaces an object property or an array element by a new value."""
 
-    def apply(self, obj):
+    def _apply(self, obj, cache):
         """
         This function applies a JSON patch operation to an object. It takes the
         object and a dictionary of operations as arguments. It returns the updated
@@ -470,9 +692,11 @@ class ReplaceOperation(PatchOperation):
             raise InvalidJsonPatch(
                 "The operation does not contain a 'value' member")
 
-        subobj, part = self.pointer.to_last(obj)
+        subobj, part = self._to_last(obj, cache)
 
         if part is None:
+            if cache is not None and cache.recording:
+                cache.replaced(None, None, obj, self.pointer)
             return value
 
         if part == "-":
@@ -492,50 +716,19 @@ class ReplaceOperation(PatchOperation):
             else:
                 raise JsonPatchConflict("unable to fully resolve json pointer {0}, part {1}".format(self.location, part))
 
+        if cache is not None and cache.recording:
+            cache.replaced(subobj, part, subobj[part], self.pointer)
         subobj[part] = value
+        if cache is not None:
+            cache.changed(subobj, part, False)
         return obj
 
-    def _on_undo_remove(self, path, key):
-        """
-        This function undoes the previous action by removing the item at `path`
-        with the `key`.
-
-        Args:
-            path (str): The `path` parameter is not used by the function
-                `._on_undo_remove`. This is because the `path` argument is deprecated
-                and was removed from the `Undo` API specs (see section 3.2.2 of
-                the `Undo` documentation).
-            key (str): In the given function `_on_undo_remove`, the `key` parameter
-                is returned unmodified.
-
-        Returns:
-            str: The function `_on_undo_remove` takes two arguments `path` and
-            `key`, and returns only the value of `key`.
-
-        """
-        return key
-
-    def _on_undo_add(self, path, key):
-        """
-        This function is an observer for the `on_undo_add` event and returns the
-        `key` value associated with the specified `path`.
-
-        Args:
-            path (str): The `path` input parameter is not used by the function `_on_undo_add`.
-            key (str): In the given function `_on_undo_add`, the `key` parameter
-                represents the key of the item being undone.
-
-        Returns:
-            : The output of the function `_on_undo_add` is `key`.
-
-        """
-        return key
 
 
 class MoveOperation(PatchOperation):
     """Moves an object property or an array element to a new location."""
 
-    def apply(self, obj):
+    def _apply(self, obj, cache):
         """
         This function takes an object `obj` and an operation represented as a
         dictionary (`self.operation`) that contains information about the operation
@@ -554,16 +747,7 @@ class MoveOperation(PatchOperation):
             added at that location.
 
         """
-        try:
-            if isinstance(self.operation['from'], self.pointer_cls):
-                from_ptr = self.operation['from']
-            else:
-                from_ptr = self.pointer_cls(self.operation['from'])
-        except KeyError as ex:
-            raise InvalidJsonPatch(
-                "The operation does not contain a 'from' member")
-
-        subobj, part = from_ptr.to_last(obj)
+        from_ptr, subobj, part = self._from_to_last(obj, cache)
         try:
             value = subobj[part]
         except (KeyError, IndexError) as ex:
@@ -577,18 +761,33 @@ class MoveOperation(PatchOperation):
                 self.pointer.contains(from_ptr):
             raise JsonPatchConflict('Cannot move values into their own children')
 
-        obj = RemoveOperation({
-            'op': 'remove',
-            'path': self.operation['from']
-        }, pointer_cls=self.pointer_cls).apply(obj)
+        self._remove_member(subobj, part, cache, from_ptr)
+        subobj, part = self._to_last(obj, cache)
+        obj = self._add_member(obj, subobj, part, value, cache)
+        if cache is not None and cache.recording:
+            cache.moved()
+        return obj
 
-        obj = AddOperation({
-            'op': 'add',
-            'path': self.location,
-            'value': value
-        }, pointer_cls=self.pointer_cls).apply(obj)
+    def _compile(self):
+        """Compiles both the `path` and the `from` pointer of the operation."""
+        super(MoveOperation, self)._compile()
+        self._from_route = _CompiledPointer.for_pointer(self._get_from_pointer())
 
-        return obj
+    def _copy_on_write(self, obj, copies):
+        """
+        This function copies the containers modified by the move: those above
+        `from` and those above `path`. The latter are looked up as they will
+        be once the value has been removed from its source array, which shifts
+        the indices following it.
+
+        """
+        from_ptr = self._get_from_pointer()
+        obj = _copy_path(obj, from_ptr, copies)
+        try:
+            removed = from_ptr.to_last(obj)
+        except JsonPointerException:
+            removed = None
+        return _copy_path(obj, self.pointer, copies, removed)
 
     @property
     def from_path(self):
@@ -603,7 +802,7 @@ class MoveOperation(PatchOperation):
             components up to but not including the last one.
 
         """
-        from_ptr = self.pointer_cls(self.operation['from'])
+        from_ptr = self._get_from_pointer()
         return '/'.join(from_ptr.parts[:-1])
 
     @property
@@ -621,7 +820,7 @@ class MoveOperation(PatchOperation):
             integer using `int()`.
 
         """
-        from_ptr = self.pointer_cls(self.operation['from'])
+        from_ptr = self._get_from_pointer()
         try:
             return int(from_ptr.parts[-1])
         except TypeError:
@@ -641,78 +840,15 @@ class MoveOperation(PatchOperation):
         from_ptr = self.pointer_cls(self.operation['from'])
         from_ptr.parts[-1] = str(value)
         self.operation['from'] = from_ptr.path
+        self._parsed_from = (self.operation['from'], from_ptr)
+        self._from_route = None
 
-    def _on_undo_remove(self, path, key):
-        """
-        This function implements a simplistic version of "undo" functionality for
-        an object that has two keys ("from_key" and "key") and two corresponding
-        paths ("from_path" and "path"). When the function is called with a path
-        and a key as arguments. it updates the "from_key" and "key" attributes
-        accordingly based on the comparison of the given key with the current
-        values of the "from_key" and "key".
-
-        Args:
-            path (str): The `path` input parameter represents the path of the node
-                being undone. In the function Body portion: If self.from_path is
-                equal to that of 'path'. Whenever this function is called with
-                self.from_path then key operation gets executed.
-            key (int): The `key` input parameter serves as a placeholder to update
-                the value of either `self.from_key` or `self.key`, depending on
-                which direction the undo operation should be applied (forward or
-                backward).
-
-        Returns:
-            int: The output returned by the function is `key`.
-
-        """
-        if self.from_path == path:
-            if self.from_key >= key:
-                self.from_key += 1
-            else:
-                key -= 1
-        if self.path == path:
-            if self.key > key:
-                self.key += 1
-            else:
-                key += 1
-        return key
-
-    def _on_undo_add(self, path, key):
-        """
-        This function reverses the difference between two keys. If `path` and `key`
-        are given as input arguments and `self` is an object with `from_path`,
-        `from_key`, `path`, and `key` attributes describing a sequence of keys and
-        pointers to corresponding values stored at each key; this function subtracts
-        one from either `from_key` or `key` if the value at that key should be undone.
-
-        Args:
-            path (str): The `path` input parameter is used to specify the parent
-                directory of the key that is being undone.
-            key (int): The `key` input parameter serves as a local variable that
-                is incremented or decremented within the function based on the
-                specific undo action being performed.
-
-        Returns:
-            int: The output returned by this function is `key`.
-
-        """
-        if self.from_path == path:
-            if self.from_key > key:
-                self.from_key -= 1
-            else:
-                key -= 1
-        if self.path == path:
-            if self.key > key:
-                self.key -= 1
-            else:
-                key += 1
-        return key
 
 
 class TestOperation(PatchOperation):
     """Test value by specified location."""
 
-    def apply(self, obj):
+    def _apply(self, obj, cache):
         """
         This function applies a json patch to an object and checks that the result
         is equal to the expected value.
@@ -726,7 +862,7 @@ class TestOperation(PatchOperation):
 
         """
         try:
-            subobj, part = self.pointer.to_last(obj)
+            subobj, part = self._to_last(obj, cache)
             if part is None:
                 val = subobj
             else:
@@ -747,11 +883,20 @@ class TestOperation(PatchOperation):
 
         return obj
 
+    def _copy_on_write(self, obj, copies):
+        """Testing does not modify the document, nothing needs to be copied."""
+        return obj
+
 
 class CopyOperation(PatchOperation):
     """ Copies an object property or an array element to a new location """
 
-    def apply(self, obj):
+    def _compile(self):
+        """Compiles both the `path` and the `from` pointer of the operation."""
+        super(CopyOperation, self)._compile()
+        self._from_route = _CompiledPointer.for_pointer(self._get_from_pointer())
+
+    def _apply(self, obj, cache):
         """
         This function takes an object `obj` and applies a JSON patch operation to
         it. The operation is specified as a dictionary containing the "op", "path",
@@ -768,31 +913,24 @@ class CopyOperation(PatchOperation):
             : The output returned by this function is `obj`.
 
         """
+        from_ptr, subobj, part = self._from_to_last(obj, cache)
         try:
-            from_ptr = self.pointer_cls(self.operation['from'])
-        except KeyError as ex:
-            raise InvalidJsonPatch(
-                "The operation does not contain a 'from' member")
-
-        subobj, part = from_ptr.to_last(obj)
-        try:
-            value = copy.deepcopy(subobj[part])
+            value = _copy_value(subobj[part])
         except (KeyError, IndexError) as ex:
             raise JsonPatchConflict(str(ex))
 
-        obj = AddOperation({
-            'op': 'add',
-            'path': self.location,
-            'value': value
-        }, pointer_cls=self.pointer_cls).apply(obj)
-
-        return obj
+        subobj, part = self._to_last(obj, cache)
+        return self._add_member(obj, subobj, part, value, cache)
 
 
 class JsonPatch(object):
     json_dumper = staticmethod(json.dumps)
     json_loader = staticmethod(_jsonloads)
 
+    # Whether apply() resolves the parents of the operations through a
+    # _ParentCache
+    _cache_parents = True
+
     operations = MappingProxyType({
         'remove': RemoveOperation,
         'add': AddOperation,
@@ -862,11 +1000,22 @@ class JsonPatch(object):
         """
         self.patch = patch
         self.pointer_cls = pointer_cls
+        self._validate()
 
-        # Verify that the structure of the patch document
-        # is correct by retrieving each patch element.
-        # Much of the validation is done in the initializer
-        # though some is delayed until the patch is applied.
+    def _validate(self):
+        """
+        This function verifies the structure of the patch document by
+        building the operation object of each of its elements.
+
+        Returns:
+            tuple: The operation objects built.
+
+        """
+        # Verify that the structure of the patch document
+        # is correct by retrieving each patch element.
+        # Much of the validation is done in the initializer
+        # though some is delayed until the patch is applied.
+        ops = []
         for op in self.patch:
             # We're only checking for basestring in the following check
             # for two reasons:
@@ -881,7 +1030,8 @@ class JsonPatch(object):
                 raise InvalidJsonPatch("Document is expected to be sequence of "
                                        "operations, got a sequence of strings.")
 
-            self._get_operation(op)
+            ops.append(self._get_operation(op))
+        return tuple(ops)
 
     def __str__(self):
         """str(self) -> self.to_string()"""
@@ -980,7 +1130,9 @@ class JsonPatch(object):
     @classmethod
     def from_diff(
             cls, src, dst, optimization=True, dumps=None,
-            pointer_cls=JsonPointer,
+            pointer_cls=JsonPointer, align_lists=False, workers=None,
+            list_key=None, replace_subtrees=False, max_ops=None,
+            include=None, exclude=None,
     ):
         """
         This function takes two dictionaries `src` and `dst` and returns a list
@@ -993,13 +1145,147 @@ class JsonPatch(object):
                 compared to the `dst` value.
             dst (): The `dst` parameter is the "destination" object that the diff
                 function is comparing the `src` object to.
-            optimization (bool): The `optimization` parameter controls whether the
-                function uses optimization to generate patches (default is `True`).
+            optimization (str): The `optimization` parameter trades the time
+                taken to diff for the size of the patch. ``'fast'`` compares
+                arrays element by element by position and records every
+                difference as it is found, without pairing removed and added
+                values into moves and without the index bookkeeping this
+                takes. ``'balanced'`` (the default) does pair them into
+                moves; True and False, which earlier versions accepted but
+                ignored, both mean ``'balanced'``, so they still give the same
+                patches as before. ``'minimal'`` also aligns arrays, as
+                `align_lists` does, matches the records of arrays by their
+                ``'id'`` member unless `list_key` says otherwise, and
+                replaces subtrees as `replace_subtrees` does. Any other
+                value raises ValueError.
+
+                >>> src, dst = [1, 2, 3], [2, 3, 1]
+                >>> len(JsonPatch.from_diff(src, dst, optimization='fast').patch)
+                3
+                >>> JsonPatch.from_diff(src, dst).patch
+                [{'op': 'move', 'from': '/0', 'path': '/2'}]
+                >>> JsonPatch.from_diff(src, dst, optimization=False).patch
+                [{'op': 'move', 'from': '/0', 'path': '/2'}]
+
             dumps (None): The `dumps` input parameter is used to provide an alternate
                 JSON dumper object to be used for serializing the objects being compared.
             pointer_cls (int): The `pointer_cls` parameter is an optional class
                 that determines the type of JSON pointers used to represent
                 differences between objects.
+            align_lists (bool): The `align_lists` parameter makes arrays be
+                compared by aligning their elements with a Myers diff rather
+                than element by element by position, so that inserting or
+                removing elements produces just the corresponding `add` and
+                `remove` operations instead of rewriting every following
+                element.
+
+                >>> src = {'m': [[2, 3], 1, [1]]}
+                >>> dst = {'m': [1, [2, 3], [2, 3]]}
+                >>> patch = JsonPatch.from_diff(src, dst, align_lists=True)
+                >>> patch.apply(src) == dst
+                True
+
+            workers (int): The `workers` parameter, when greater than one and
+                both documents are objects, splits the comparison of their
+                members across a pool of that many processes. The processes
+                only compare; the changes they find are replayed in order in
+                this process, so moves across members are still detected and
+                the patch is the same as without workers, where processes
+                are forked. Where they are spawned instead, as on Windows,
+                nested members may be compared in another order, giving an
+                equivalent patch whose operations may differ.
+            list_key (str): The `list_key` parameter makes arrays whose
+                elements are all objects with a distinct value for this
+                member be compared by matching their elements by that value
+                rather than by position. Removed, added and reordered records
+                then produce just the corresponding `remove`, `add` and
+                `move` operations, followed by a nested diff of each record
+                that changed, instead of rewriting the records that shifted.
+                It may also be a function taking the JSON pointer of an array
+                and returning the member to use for it, or None to compare
+                it as usual.
+
+                >>> src = [{'id': 1, 'n': 'a'}, {'id': 2, 'n': 'b'}]
+                >>> dst = [{'id': 2, 'n': 'c'}, {'id': 1, 'n': 'a'}]
+                >>> patch = JsonPatch.from_diff(src, dst, list_key='id')
+                >>> patch.patch[0]
+                {'op': 'move', 'from': '/1', 'path': '/0'}
+                >>> patch.patch[1]
+                {'op': 'replace', 'path': '/0/n', 'value': 'c'}
+
+            replace_subtrees (bool): The `replace_subtrees` parameter makes
+                each changed object or array be replaced whole when the
+                operations changing it would encode larger than the
+                `replace`, judging by an estimate made in a first pass over
+                the documents. Patches of heavily rewritten subtrees are then
+                smaller and have fewer operations to apply.
+            max_ops (int): The `max_ops` parameter bounds the number of
+                operations of the patch. When the diff would need more, the
+                changed objects and arrays that save the most operations for
+                the size they add are replaced whole until it does not; at
+                worst, the patch is a single `replace` of the document.
+                With `include` or `exclude`, the containers the rules
+                restrict are not replaced, so the patch may exceed the bound.
+
+                >>> src = {'a': {'x': 1, 'y': 2}, 'b': 1, 'c': list(range(50))}
+                >>> dst = {'a': {'x': 0, 'y': 0}, 'b': 2, 'c': src['c']}
+                >>> sorted(op['path'] for op in JsonPatch.from_diff(src, dst))
+                ['/a/x', '/a/y', '/b']
+                >>> patch = JsonPatch.from_diff(src, dst, max_ops=2)
+                >>> sorted(op['path'] for op in patch)
+                ['/a', '/b']
+
+            include (list): The `include` parameter restricts the comparison
+                to the given locations, JSON pointers whose reference tokens
+                may use the wildcards of `fnmatch`, and ``**`` for any number
+                of tokens. A location is compared when a pattern matches it
+                or one of its ancestors, or when it is on the way to one;
+                other members are skipped without being looked at. A
+                location only on the way to one is just descended into: it
+                is left as it is unless it holds an object or an array in
+                both documents, and it keeps its members, or its elements in
+                their order, only those in both documents being compared.
+
+                >>> src = {'cfg': {'v': 1}, 'ts': 1, 'tags': ['a']}
+                >>> dst = {'cfg': {'v': 2}, 'ts': 2, 'tags': ['b'], 'new': {}}
+                >>> JsonPatch.from_diff(src, dst, include=['/*/v']).patch
+                [{'op': 'replace', 'path': '/cfg/v', 'value': 2}]
+                >>> JsonPatch.from_diff(src, dst, include=['/ts/x']).patch
+                []
+
+            exclude (list): The `exclude` parameter is patterns like those of
+                `include`, of locations whose differences are ignored. Their
+                members are skipped before any comparison, which saves the
+                time of diffing volatile parts of the documents, such as
+                timestamps or metrics. Exclusion wins over inclusion. Rules
+                apply to the members of objects, and to the elements of
+                arrays that are compared with an element of the other array,
+                paired by position, by alignment or by `list_key`; their
+                index in `dst` is the one matched. Elements without such a
+                counterpart are added or removed whole, and the rules do not
+                apply to values added, removed or replaced as a whole. The
+                patch leaves the skipped locations as they are in `src`, and
+                the containers the rules restrict are never replaced whole
+                to make it smaller.
+                Either parameter must be a list: any other value raises
+                TypeError.
+
+                >>> src = {'name': 'a', 'stats': {'cpu': 1}, 'items': [{'ts': 1}]}
+                >>> dst = {'name': 'b', 'stats': {'cpu': 2}, 'items': [{'ts': 2}]}
+                >>> patch = JsonPatch.from_diff(src, dst,
+                ...                             exclude=['/stats', '/items/*/ts'])
+                >>> patch.patch
+                [{'op': 'replace', 'path': '/name', 'value': 'b'}]
+                >>> src, dst = {'a': [1, 2, 3]}, {'a': [0, 5, 3]}
+                >>> JsonPatch.from_diff(src, dst, exclude=['/a/1']).patch
+                [{'op': 'replace', 'path': '/a/0', 'value': 0}]
+                >>> JsonPatch.from_diff(src, dst, exclude=['/a/*']).patch
+                []
+                >>> JsonPatch.from_diff(src, dst, exclude='/a')
+                Traceback (most recent call last):
+                    ...
+                TypeError: exclude must be a list of patterns, got str
+
 
         Returns:
             list: The output returned by the function `from_diff` is a list of
@@ -1008,10 +1294,28 @@ class JsonPatch(object):
 
         """
         json_dumper = dumps or cls.json_dumper
-        builder = DiffBuilder(src, dst, json_dumper, pointer_cls=pointer_cls)
-        builder._compare_values('', None, src, dst)
-        ops = list(builder.execute())
-        return cls(ops, pointer_cls=pointer_cls)
+        budget = max_ops
+        while True:
+            builder = _diff_builder(src, dst, json_dumper, pointer_cls,
+                                    align_lists, optimization, list_key,
+                                    replace_subtrees, budget, include,
+                                    exclude)
+            if workers is not None and workers > 1:
+                builder._compare_in_processes(workers)
+            else:
+                builder._compare_values('', None, src, dst)
+            ops = list(builder.execute())
+
+            if max_ops is None or len(ops) <= max_ops:
+                return cls(ops, pointer_cls=pointer_cls)
+            if budget == 1 and (include or exclude):
+                # the document cannot be replaced over the skipped locations
+                return cls(ops, pointer_cls=pointer_cls)
+            if budget == 1:
+                return cls([{'op': 'replace', 'path': '', 'value': dst}],
+                           pointer_cls=pointer_cls)
+            # the estimates are not exact: plan again, for fewer operations
+            budget = max(1, budget * max_ops // len(ops))
 
     def to_string(self, dumps=None):
         """Returns patch set as JSON string."""
@@ -1029,7 +1333,21 @@ class JsonPatch(object):
         """
         return tuple(map(self._get_operation, self.patch))
 
-    def apply(self, obj, in_place=False):
+    @property
+    def _plan(self):
+        """
+        This function returns the operations of the patch as they are
+        applied: runs of operations that add a block of elements to an array,
+        or remove one from it, are grouped into an `_ArrayRun` each.
+
+        Returns:
+            list: The operations and runs of operations, in order.
+
+        """
+        return _plan_operations(self._ops)
+
+    def apply(self, obj, in_place=False, copy_on_write=False,
+              record_inverse=False, atomic=False):
         """Applies the patch to a given object.
 
         :param obj: Document object.
@@ -1039,17 +1357,244 @@ class JsonPatch(object):
                          specified `obj` or to its copy.
         :type in_place: bool
 
-        :return: Modified `obj`.
+        :param copy_on_write: When not applying in place, copy only the
+                              containers on the path of each operation instead
+                              of deep-copying the whole document. Untouched
+                              subtrees of the result are shared with `obj`, so
+                              mutating them later affects both documents.
+        :type copy_on_write: bool
+
+        :param record_inverse: Also return the patch that undoes this one,
+                               recorded while applying it: each change is
+                               reported with the value it overwrote or
+                               removed, so no diff of the documents is
+                               needed. Applied to the result, the inverse
+                               patch gives back `obj`. The values it restores
+                               are not copied.
+        :type record_inverse: bool
+
+        :param atomic: When applying in place, undo the changes already made
+                       if the patch fails, so that `obj` is left as it was,
+                       before re-raising the error. The changes are journaled
+                       as they are made and undone in reverse order, which
+                       costs a fraction of copying the document.
+        :type atomic: bool
+
+        :return: Modified `obj`, or a tuple of the modified `obj` and the
+                 inverse :class:`JsonPatch` with `record_inverse`.
+
+        Persistent documents (see :func:`freeze`) are never modified, whatever
+        `in_place` says: a new version sharing all unchanged nodes with `obj`
+        is returned instead.
+
+        >>> doc = {'a': [1, 2], 'b': 1}
+        >>> patch = JsonPatch([
+        ...     {'op': 'add', 'path': '/a/-', 'value': 3},
+        ...     {'op': 'move', 'from': '/b', 'path': '/c'},
+        ... ])
+        >>> new, inverse = patch.apply(doc, record_inverse=True)
+        >>> inverse.patch == [
+        ...     {'op': 'move', 'from': '/c', 'path': '/b'},
+        ...     {'op': 'remove', 'path': '/a/2'},
+        ... ]
+        True
+        >>> inverse.apply(new) == doc
+        True
+
+        The inverse of a patch applied to a persistent document restores
+        plain copies of its values, so that it serializes like any patch:
+
+        >>> frozen = freeze({'a': {'b': [1]}})
+        >>> new, inverse = JsonPatch([
+        ...     {'op': 'replace', 'path': '/a', 'value': 1},
+        ... ]).apply(frozen, record_inverse=True)
+        >>> inverse.to_string()
+        '[{"op": "replace", "path": "/a", "value": {"b": [1]}}]'
+        >>> thaw(inverse.apply(new)) == thaw(frozen)
+        True
+
+        With `copy_on_write`, `obj` is left unchanged and the subtrees the
+        patch does not touch are shared with the result:
+
+        >>> doc = {'a': {'b': [1, 2]}, 'c': {'d': [3]}}
+        >>> new = JsonPatch([
+        ...     {'op': 'add', 'path': '/a/b/-', 'value': 3},
+        ... ]).apply(doc, copy_on_write=True)
+        >>> new
+        {'a': {'b': [1, 2, 3]}, 'c': {'d': [3]}}
+        >>> doc
+        {'a': {'b': [1, 2]}, 'c': {'d': [3]}}
+        >>> new['c'] is doc['c']
+        True
+        >>> new['a'] is doc['a'] or new['a']['b'] is doc['a']['b']
+        False
+
+        An atomic patch that fails part-way leaves the document exactly as it
+        was, whether the changes already made were to objects or to arrays:
+
+        >>> doc = {'a': {'x': 1, 'y': [1]}, 'l': [1, 2, 3], 'c': {}}
+        >>> original = copy.deepcopy(doc)
+        >>> patch = JsonPatch([
+        ...     {'op': 'add', 'path': '/a/z', 'value': 2},
+        ...     {'op': 'replace', 'path': '/a/x', 'value': 3},
+        ...     {'op': 'remove', 'path': '/a/y'},
+        ...     {'op': 'remove', 'path': '/l/0'},
+        ...     {'op': 'add', 'path': '/l/1', 'value': 4},
+        ...     {'op': 'replace', 'path': '/l/0', 'value': 5},
+        ...     {'op': 'move', 'from': '/l/2', 'path': '/c/m'},
+        ...     {'op': 'move', 'from': '/a/x', 'path': '/l/0'},
+        ...     {'op': 'copy', 'from': '/a', 'path': '/c/n'},
+        ...     {'op': 'copy', 'from': '/l', 'path': '/l/1'},
+        ...     {'op': 'remove', 'path': '/missing'},
+        ... ])
+        >>> try:
+        ...     patch.apply(doc, in_place=True, atomic=True)
+        ... except JsonPatchConflict:
+        ...     print('failed')
+        failed
+        >>> doc == original
+        True
         """
+        if record_inverse:
+            return self._apply_journaled(obj, in_place, copy_on_write, True,
+                                         atomic)
+
+        # plain documents skip the slower isinstance() check of the ABCs
+        if type(obj) is not dict and type(obj) is not list and \
+                isinstance(obj, (PersistentMapping, PersistentSequence)):
+            return freeze(self._apply_copy_on_write(obj))
 
         if not in_place:
+            if copy_on_write:
+                return self._apply_copy_on_write(obj)
             obj = copy.deepcopy(obj)
+        elif atomic:
+            return self._apply_journaled(obj, True, False, False, True)[0]
 
-        for operation in self._ops:
-            obj = operation.apply(obj)
+        return self._apply_in_place(obj)
+
+    def _apply_in_place(self, obj):
+        """
+        This function applies the operations of the patch to `obj` itself.
+
+        Args:
+            obj (dict): The `obj` input parameter is the document to modify.
+
+        Returns:
+            dict: The patched document, which is `obj` unless an operation
+            replaced the root.
+
+        """
+        if not self._cache_parents:
+            for operation in self._plan:
+                obj = operation.apply(obj)
+            return obj
+
+        # Planning and caching cost more than they save unless operations
+        # work on the same containers.
+        operations = self._ops
+        if not _shares_parents(operations):
+            for operation in operations:
+                obj = operation.apply(obj)
+            return obj
+
+        # The containers that the operations resolve are kept for the
+        # following ones, so that operations on siblings walk their common
+        # path only once.
+        cache = _ParentCache(obj)
+        for operation in _plan_operations(operations):
+            obj = _apply_operation(operation, obj, cache)
+
+        return obj
+
+    def _apply_copy_on_write(self, obj, journal=None):
+        """
+        This function applies the patch to a copy of `obj` that is made
+        lazily: before each operation, every container from the root down to
+        the containers the operation modifies is shallow-copied, unless it was
+        already copied by an earlier operation.
+
+        Args:
+            obj (dict): The `obj` input parameter is the document to patch; it
+                is never modified.
+            journal (_Journal): The `journal` input parameter is the optional
+                journal to record the changes in.
+
+        Returns:
+            dict: The patched document, sharing unchanged subtrees with `obj`.
+
+        """
+        copies = {}
+        for operation in self._plan:
+            obj = operation._copy_on_write(obj, copies)
+            if journal is None:
+                obj = operation.apply(obj)
+            else:
+                obj = operation._apply(obj, journal)
 
         return obj
 
+    def _apply_journaled(self, obj, in_place, copy_on_write, record_inverse,
+                         atomic):
+        """
+        This function applies the patch like `apply()` does, journaling the
+        changes to record the inverse of the patch, or to undo them if it
+        fails.
+
+        Args:
+            record_inverse (bool): The `record_inverse` input parameter tells
+                whether to record the inverse of the patch.
+            atomic (bool): The `atomic` input parameter tells whether to undo
+                the changes made in place if the patch fails.
+
+        Returns:
+            tuple: The patched document and the inverse patch, or None.
+
+        """
+        if not all(_takes_cache(operation) for operation in self._plan):
+            # Operations that only implement apply() do not report their
+            # changes, so they are diffed from a copy of the document.
+            before = copy.deepcopy(obj)
+            try:
+                result = self.apply(obj, in_place, copy_on_write)
+            except Exception:
+                if atomic and in_place and obj is not before:
+                    JsonPatch.from_diff(
+                        obj, before, pointer_cls=self.pointer_cls
+                    ).apply(obj, in_place=True)
+                raise
+            if not record_inverse:
+                return result, None
+            if isinstance(obj, (PersistentMapping, PersistentSequence)):
+                return result, JsonPatch.from_diff(
+                    thaw(result), thaw(before), pointer_cls=self.pointer_cls)
+            return result, JsonPatch.from_diff(result, before,
+                                               pointer_cls=self.pointer_cls)
+
+        if isinstance(obj, (PersistentMapping, PersistentSequence)):
+            journal = _Journal(inverse=record_inverse)
+            obj = freeze(self._apply_copy_on_write(obj, journal))
+            # the values the inverse restores are persistent nodes of obj
+            return obj, journal.patch(self.pointer_cls, thawed=True)
+
+        if not in_place:
+            if copy_on_write:
+                journal = _Journal(inverse=record_inverse)
+                obj = self._apply_copy_on_write(obj, journal)
+                return obj, journal.patch(self.pointer_cls)
+            obj = copy.deepcopy(obj)
+
+        cache = _ParentCache(obj) if self._cache_parents else None
+        journal = _Journal(cache, record_inverse)
+        try:
+            for operation in self._plan:
+                obj = operation._apply(obj, journal)
+        except Exception:
+            if atomic and in_place:
+                journal.rollback()
+            raise
+        return obj, journal.patch(self.pointer_cls)
+
     def _get_operation(self, operation):
         """
         This function checks the validity of an operation object passed as an
@@ -1082,447 +1627,4586 @@ class JsonPatch(object):
         cls = self.operations[op]
         return cls(operation, pointer_cls=self.pointer_cls)
 
+    def compile(self, specialize=False, sample=None):
+        """Prepares the patch for repeated application.
+
+        The returned :class:`CompiledPatch` builds its operations once and
+        keeps them, so applying it does no per-call parsing. It takes a
+        snapshot of the operations: later changes to :attr:`patch` are not
+        picked up.
+
+        >>> patch = JsonPatch([{'op': 'add', 'path': '/foo', 'value': 'bar'}])
+        >>> compiled = patch.compile()
+        >>> compiled.apply({}) == patch.apply({})
+        True
+
+        :param specialize: Also generate a Python function applying the
+                           ``add``, ``remove``, ``replace`` and ``test``
+                           operations of the patch with their lookups
+                           unrolled and type checks inlined. Where a check
+                           fails, the operation is applied the generic way,
+                           so the results and errors are the same. Functions
+                           are kept for the most recently specialized patch
+                           shapes, which differ only by their values.
+        :type specialize: bool
+
+        :param sample: A document shaped like those the patch will be applied
+                       to: with `specialize`, only the code for the kinds of
+                       containers found in it along the paths of the
+                       operations is generated.
+
+        :return: :class:`CompiledPatch` instance.
+        """
+        return CompiledPatch(self.patch, pointer_cls=self.pointer_cls,
+                             operations=self.operations,
+                             specialize=specialize, sample=sample)
+
+    def optimize(self):
+        """Returns an equivalent patch without redundant operations.
+
+        The operations are analysed in order, keeping for each location the
+        last operation on it that no later operation has touched since. Such
+        an operation is merged with the next one on the same location when
+        the two amount to one:
+
+        - ``replace`` after ``add`` or ``replace`` becomes one ``add`` or
+          ``replace`` of the last value, and ``remove`` after ``replace``
+          becomes the ``remove``;
+        - ``add`` after ``remove`` becomes a ``replace``;
+        - a ``test`` of the value just added, replaced or tested is dropped.
+
+        Operations below a value that was added or replaced are applied to
+        that value instead, and operations whose result is overwritten or
+        removed as a whole by a later one are dropped. Other operations,
+        including ``move``, ``copy`` and operations of unknown types, are kept
+        as they are, and no operation is moved across one that touches the
+        same locations. Whether a location is an array index or an object
+        member is not known without the document, so operations that would
+        differ between the two are kept.
+
+        >>> patch = JsonPatch([
+        ...     {'op': 'add', 'path': '/a', 'value': {}},
+        ...     {'op': 'add', 'path': '/a/b', 'value': 1},
+        ...     {'op': 'replace', 'path': '/c', 'value': 2},
+        ...     {'op': 'replace', 'path': '/c', 'value': 3},
+        ...     {'op': 'test', 'path': '/c', 'value': 3},
+        ... ])
+        >>> patch.optimize().patch == [
+        ...     {'op': 'add', 'path': '/a', 'value': {'b': 1}},
+        ...     {'op': 'replace', 'path': '/c', 'value': 3},
+        ... ]
+        True
+
+        The optimized patch has the same result as this one on every
+        document this one applies to. On other documents it may fail
+        differently, or not at all: an operation is dropped even if it would
+        have failed.
+
+        :return: :class:`JsonPatch` instance, of the same kind as this one.
+        """
+        if not _resolves_plainly(self.pointer_cls):
+            return self._derive(list(self.patch))
+        optimizer = _PatchOptimizer(self.operations)
+        for operation in self._ops:
+            optimizer.add(operation)
+        return self._derive(optimizer.result())
 
-class DiffBuilder(object):
-
-    def __init__(self, src_doc, dst_doc, dumps=json.dumps, pointer_cls=JsonPointer):
+    @classmethod
+    def compose(cls, *patches):
+        """Squashes a sequence of patches into one equivalent patch.
+
+        Applying the result to a document has the same effect as applying
+        each of `patches` in turn, without building the intermediate
+        documents. The paths of every patch are relative to the document
+        left by the previous ones, so the operations are chained in order and
+        then :meth:`optimize`\\ d: values set by an earlier patch and changed
+        at the same location, or below it, by a later one are folded into
+        one operation, and values a later patch overwrites are dropped.
+
+        >>> first = JsonPatch([{'op': 'add', 'path': '/a', 'value': {}}])
+        >>> second = JsonPatch([{'op': 'add', 'path': '/a/b', 'value': [1]}])
+        >>> third = [{'op': 'add', 'path': '/a/b/0', 'value': 0}]
+        >>> JsonPatch.compose(first, second, third).patch
+        [{'op': 'add', 'path': '/a', 'value': {'b': [0, 1]}}]
+
+        Paths are not rewritten: locations are not followed across the
+        index shifts of array adds and removes, nor along chains of moves.
+        Whether a location of the document is an array index or an object
+        member is not known without it, and the two would need different
+        rewrites, so such operations are kept as they are.
+
+        >>> len(JsonPatch.compose(
+        ...     [{'op': 'add', 'path': '/l/0', 'value': 1}],
+        ...     [{'op': 'add', 'path': '/l/0', 'value': 2}],
+        ...     [{'op': 'replace', 'path': '/l/1', 'value': 3}]).patch)
+        3
+        >>> len(JsonPatch.compose(
+        ...     [{'op': 'move', 'from': '/a', 'path': '/b'}],
+        ...     [{'op': 'move', 'from': '/b', 'path': '/c'}]).patch)
+        2
+
+        :param patches: Patches to compose, as :class:`JsonPatch` instances
+                        or lists of operations.
+
+        :return: :class:`JsonPatch` instance, with the pointer class of the
+                 given patches.
+
+        :raises: :exc:`InvalidJsonPatch` if the patches use different pointer
+                 classes.
         """
-        This function initializes an object for indexing and comparing two JSON
-        documents using the `JsonPointer` class and `dumps` function.
+        pointer_cls = None
+        patch = []
+        for item in patches:
+            if isinstance(item, JsonPatch):
+                if pointer_cls is None:
+                    pointer_cls = item.pointer_cls
+                elif item.pointer_cls is not pointer_cls:
+                    raise InvalidJsonPatch(
+                        'Cannot compose patches with different pointer '
+                        'classes')
+                item = item.patch
+            patch.extend(item)
+        return cls(patch, pointer_cls=pointer_cls or JsonPointer).optimize()
+
+    def _derive(self, patch):
+        """
+        This function creates a patch with the operations `patch` and the
+        same settings as this one.
 
         Args:
-            src_doc (dict): The `src_doc` input parameter is the original document
-                being transformed.
-            dst_doc (list): The `dst_doc` input parameter is not used at all within
-                this specific code snippet. The parameter is passed but then
-                immediately discarded without being accessed or referred to within
-                the body of the function.
-            dumps (str): The `dumps` input parameter is used to specify a function
-                for converting Python objects to JSON data.
-            pointer_cls (int): The `pointer_cls` parameter is used to specify the
-                class to use for representing JsonPointer objects.
+            patch (list): The `patch` input parameter is the operations of the
+                new patch.
 
-        """
-        self.dumps = dumps
-        self.pointer_cls = pointer_cls
-        self.index_storage = [{}, {}]
-        self.index_storage2 = [[], []]
-        self.__root = root = []
-        self.src_doc = src_doc
-        self.dst_doc = dst_doc
-        root[:] = [root, root, None]
+        Returns:
+            JsonPatch: The new patch, compiled if this one is.
 
-    def store_index(self, value, index, st):
         """
-        This function stores an item (value and its type) and an index for the
-        item with a specific storage (st). If the item is already stored with the
-        same value and type before. It just appends the index to the existing list
-        of indices stored with that value. If it's not already stored before then
-        it stores a new list of only that index for that value-type combo.
-        Note that the function catches a TypeError exception which suggests that
-        the typed_key or the storage used by this function expects particular type
-        information to exist therein but cannot guarantee that these conditions
-        do indeed apply within.
+        derived = copy.copy(self)
+        derived.patch = patch
+        return derived
 
-        Args:
-            value (): The `value` parameter is used to form a tuples of typed key
-                for indexing purposes.
-            index (int): The `index` input parameter is used to store the index
-                of the value inside the storage container.
-            st (str): The `st` parameter is a storage dictionary key that specifies
-                which of two indexing structures to use for storing the value and
-                its index.
 
-        """
-        typed_key = (value, type(value))
-        try:
-            storage = self.index_storage[st]
-            stored = storage.get(typed_key)
-            if stored is None:
-                storage[typed_key] = [index]
-            else:
-                storage[typed_key].append(index)
+    def apply_many(self, docs, in_place=False, copy_on_write=False,
+                   workers=None, processes=False):
+        """Applies the patch to each of many documents.
 
-        except TypeError:
-            self.index_storage2[st].append((typed_key, index))
+        The patch is compiled once for all documents (see :meth:`compile`),
+        and a document the patch fails on does not stop the others.
 
-    def take_index(self, value, st):
-        """
-        This function takes a value and a search type (st) as inputs and returns
-        the corresponding index of the value from two stored indexes. It first
-        looks up the value's typed key (value and its type) from the index storage
-        using a tries-like approach and then pops the found index if it exists.
+        >>> patch = JsonPatch([{'op': 'replace', 'path': '/a', 'value': 2}])
+        >>> [result.doc for result in patch.apply_many([{'a': 1}, {'a': 3}])]
+        [{'a': 2}, {'a': 2}]
+        >>> [result.index for result in patch.apply_many([{'a': 1}, {}])
+        ...  if result.error is not None]
+        [1]
 
-        Args:
-            value (dict): The `value` input parameter is used to look up an entry
-                associated with it and its type (`type(value)`) by being added to
-                a dictionary of dictionaries using `typed_key = (value)` for
-                indexing and then attempting to retrieve the associated value
-                through subsequent calls to the dictionary within `self.index_storage`
-                and finally to `storage`.
-            st (str): In this function `take_index`, `st` is an input parameter
-                that refers to a storage dictionary of the same type as `self.index_storage`.
+        :param docs: Documents to patch; any iterable, consumed as the
+                     results are.
+        :type docs: iterable
 
-        Returns:
-            int: The output returned by the `take_index` function is either the
-            value popped from the internal dictionary stored at
-            `self.index_storage[st][typed_key]` if it exists and is not `None`,
-            or the value poped from the external dictionary `self.index_storage2[st]`
-            if no matching value is found internally.
+        :param in_place: Modify the documents rather than copies of them, as
+                         for :meth:`apply`. A document the patch failed on may
+                         be left partially modified.
+        :type in_place: bool
 
+        :param copy_on_write: Copy only the modified containers of the
+                              documents, as for :meth:`apply`.
+        :type copy_on_write: bool
+
+        :param workers: Number of threads or processes to apply the patch
+                        in; by default it is applied in this thread. Only a
+                        bounded number of documents are handed out ahead of
+                        the results taken.
+        :type workers: int
+
+        :param processes: Apply the patch in a pool of processes instead of
+                          threads. The documents are then sent to the
+                          processes and the results back, so `in_place` and
+                          `copy_on_write` have no effect: the documents
+                          passed in are never modified.
+        :type processes: bool
+
+        :return: Iterator of :class:`ApplyResult`, one per document in the
+                 order of `docs`, with either the patched document or the
+                 :class:`JsonPatchConflict`, :class:`JsonPatchTestFailed` or
+                 :class:`jsonpointer.JsonPointerException` the patch failed
+                 with.
         """
-        typed_key = (value, type(value))
+        compiled = self.compile()
+        if workers is None or ThreadPoolExecutor is None:
+            for index, doc in enumerate(docs):
+                yield _apply_to(compiled, index, doc, in_place, copy_on_write)
+            return
+
+        if processes:
+            pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=_pool_context(),
+                initializer=_start_batch,
+                initargs=(self.patch, self.pointer_cls,
+                          dict(self.operations),
+                          compiled._function is not None))
+            submit = functools.partial(pool.submit, _apply_batched)
+        else:
+            pool = ThreadPoolExecutor(max_workers=workers)
+
+            def submit(index, doc):
+                return pool.submit(_apply_to, compiled, index, doc, in_place,
+                                   copy_on_write)
+
+        pending = collections.deque()
         try:
-            stored = self.index_storage[st].get(typed_key)
-            if stored:
-                return stored.pop()
+            for index, doc in enumerate(docs):
+                if len(pending) >= workers * _BATCH_WINDOW:
+                    yield pending.popleft().result()
+                pending.append(submit(index, doc))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown()
 
-        except TypeError:
-            storage = self.index_storage2[st]
-            for i in range(len(storage)-1, -1, -1):
-                if storage[i][0] == typed_key:
-                    return storage.pop(i)[1]
 
-    def insert(self, op):
-        """
-        The given function `insert` takes an operation `op` as input and performs
-        the following action on a linked list:
-        Inserts `op` at the end of the list (i.e., after the last element), linking
-        it to the previous last element of the list.
+# Documents that JsonPatch.apply_many() hands out per worker ahead of the
+# results taken
+_BATCH_WINDOW = 4
 
-        Args:
-            op (list): The `op` input parameter is used to store the value being
-                inserted into the tree. It is assigned to the second element of
-                the current node (i.e., last[1]) and then used to construct a new
-                node with three elements: last+op.
+# The CompiledPatch of a process of JsonPatch.apply_many()
+_batch_patch = None
 
-        Returns:
-            list: The output returned by this function is `last`.
 
-        """
-        root = self.__root
-        last = root[0]
-        last[1] = root[0] = [last, root, op]
-        return root[0]
+def _apply_to(patch, index, doc, in_place, copy_on_write):
+    """
+    This function applies a patch to one document of
+    `JsonPatch.apply_many()`.
 
-    def remove(self, index):
-        """
-        This function removes an element at a given index from a list of links
-        (i.e., a linked list) by replacing the elements at the indices `link_prev`
-        and `link_next` with each other's values and then resetting the index to
-        an empty list.
+    Args:
+        patch (JsonPatch): The `patch` input parameter is the patch to apply.
+        index (int): The `index` input parameter is the position of the
+            document.
+        doc (dict): The `doc` input parameter is the document to patch.
+        in_place (bool): The `in_place` input parameter is passed on to
+            `JsonPatch.apply()`.
+        copy_on_write (bool): The `copy_on_write` input parameter is passed
+            on to `JsonPatch.apply()`.
 
-        Args:
-            index (list): In this function `remove(self index)` the input parameter
-                `index` is used to specify which element to remove from the list.
-                It is a tuple of three elements representing the previous and next
-                links of the element to be removed.
+    Returns:
+        ApplyResult: The patched document, or the error the patch failed
+        with.
 
-        """
-        link_prev, link_next, _ = index
-        link_prev[1] = link_next
-        link_next[0] = link_prev
-        index[:] = []
+    """
+    try:
+        doc = patch.apply(doc, in_place, copy_on_write=copy_on_write)
+    except _DOCUMENT_ERRORS as ex:
+        return ApplyResult(index, None, ex)
+    return ApplyResult(index, doc, None)
 
-    def iter_from(self, start):
-        """
-        This function iterates over the edges of a graph starting from a given
-        vertex and yields the vertices at the other end of each edge.
 
-        Args:
-            start (list): The `start` input parameter specifies the starting node
-                of the tree traversal.
+def _start_batch(patch, pointer_cls, operations, specialize):
+    """Compiles the patch of a process of `JsonPatch.apply_many()`."""
+    global _batch_patch
+    _batch_patch = CompiledPatch(patch, pointer_cls=pointer_cls,
+                                 operations=operations,
+                                 specialize=specialize)
 
-        """
-        root = self.__root
-        curr = start[1]
-        while curr is not root:
-            yield curr[2]
-            curr = curr[1]
 
-    def __iter__(self):
-        """
-        This function implements an iterator for a data structure. It starts at
-        the second child of the root node (the first child is the root itself),
-        and iterates over all the nodes that have a third child (i.e., all the leaves).
+def _apply_batched(index, doc):
+    """Applies the patch of a process to a document it received."""
+    return _apply_to(_batch_patch, index, doc, True, False)
 
-        """
-        root = self.__root
-        curr = root[1]
-        while curr is not root:
-            yield curr[2]
-            curr = curr[1]
 
-    def execute(self):
-        """
-        This function takes a root node of an operation tree and iterates over all
-        operations (Add/Remove/Replace) below the root node. It yields each operation
-        along with its pointer (location and value).
+class CompiledPatch(JsonPatch):
+    """A JSON Patch whose operations are built and validated only once.
 
-        """
-        root = self.__root
-        curr = root[1]
-        while curr is not root:
-            if curr[1] is not root:
-                op_first, op_second = curr[2], curr[1][2]
-                if op_first.location == op_second.location and \
-                        type(op_first) == RemoveOperation and \
-                        type(op_second) == AddOperation:
-                    yield ReplaceOperation({
-                        'op': 'replace',
-                        'path': op_second.location,
-                        'value': op_second.operation['value'],
-                    }, pointer_cls=self.pointer_cls).operation
-                    curr = curr[1][1]
-                    continue
+    Each operation keeps its pointers pre-split into typed parts, so
+    :meth:`apply` resolves locations without going through the generic
+    pointer walk. Apart from that it behaves like the :class:`JsonPatch` it
+    was compiled from, and compares equal to it.
+    """
 
-            yield curr[2].operation
-            curr = curr[1]
+    # The compiled routes are walked faster than the cache is looked up
+    _cache_parents = False
 
-    def _item_added(self, path, key, item):
+    def __init__(self, patch, pointer_cls=JsonPointer, operations=None,
+                 specialize=False, sample=None):
         """
-        This function handles the addition of an item to a doubly-linked list data
-        structure. It takes the item to be added and the path to where it should
-        be inserted as input. The function checks if the item already exists
-        somewhere else on the list and if so moves it instead of adding it twice.
+        This function validates the patch like `JsonPatch` does and keeps the
+        compiled operation objects for all later applications.
 
         Args:
-            path (): The `path` input parameter is a sequence of keys that represents
-                the path to the item being added.
-            key (int): The `key` input parameter is the key of the item being added.
-            item (int): The `item` parameter is the item being added to the collection.
+            patch (list): The `patch` input parameter is the sequence of
+                operations to compile.
+            pointer_cls (type): The `pointer_cls` input parameter is the class
+                used to parse the pointers of the operations.
+            operations (Mapping): The `operations` input parameter maps op
+                names to operation classes; it defaults to the class-level
+                `operations` and lets subclasses with custom operations be
+                compiled.
+            specialize (bool): The `specialize` input parameter tells whether
+                to generate a function applying the patch; see
+                `JsonPatch.compile()`.
+            sample (dict): The `sample` input parameter is an optional
+                document of the shape the patch will be applied to.
 
         """
-        index = self.take_index(item, _ST_REMOVE)
-        if index is not None:
-            op = index[2]
-            if type(op.key) == int and type(key) == int:
-                for v in self.iter_from(index):
-                    op.key = v._on_undo_remove(op.path, op.key)
+        if operations is not None:
+            self.operations = operations
+        super(CompiledPatch, self).__init__(patch, pointer_cls=pointer_cls)
+        self._compiled_plan = _plan_operations(self._compiled_ops)
+        self._function = None
+        if specialize:
+            self._function = _specialize(self._compiled_plan, sample)
+            self._values = tuple(
+                getattr(item, 'operation', {}).get('value')
+                for item in self._compiled_plan)
+
+    def _validate(self):
+        """Keeps the operations built while validating the patch, compiled."""
+        ops = super(CompiledPatch, self)._validate()
+        for operation in ops:
+            operation._compile()
+        self._compiled_ops = ops
+        return ops
 
-            self.remove(index)
-            if op.location != _path_join(path, key):
-                new_op = MoveOperation({
-                    'op': 'move',
-                    'from': op.location,
-                    'path': _path_join(path, key),
-                }, pointer_cls=self.pointer_cls)
-                self.insert(new_op)
-        else:
-            new_op = AddOperation({
-                'op': 'add',
-                'path': _path_join(path, key),
-                'value': item,
-            }, pointer_cls=self.pointer_cls)
-            new_index = self.insert(new_op)
-            self.store_index(item, new_index, _ST_ADD)
+    @property
+    def _ops(self):
+        """Returns the operations built when the patch was compiled."""
+        return self._compiled_ops
 
-    def _item_removed(self, path, key, item):
-        """
-        This function is a decorator that undo-es an operation performed on a
-        dictionaries like data structure. Whenever an item is removed from the
-        dictionary using `pop`, this function is called with the path of the item
+    @property
+    def _plan(self):
+        """Returns the plan made when the patch was compiled."""
+        return self._compiled_plan
+
+    def compile(self, specialize=False, sample=None):
+        """Returns the patch itself, it is already compiled, unless it is to
+        be specialized and is not yet."""
+        if specialize and self._function is None:
+            return CompiledPatch(self.patch, pointer_cls=self.pointer_cls,
+                                 operations=self.operations,
+                                 specialize=True, sample=sample)
+        return self
+
+    def _apply_in_place(self, obj):
+        """Applies the patch with the generated function, if specialized."""
+        if self._function is None:
+            return super(CompiledPatch, self)._apply_in_place(obj)
+        return self._function(obj, self._values, self._compiled_plan)
+
+    def _derive(self, patch):
+        """Compiles the new patch with the same settings as this one."""
+        return CompiledPatch(patch, pointer_cls=self.pointer_cls,
+                             operations=self.operations,
+                             specialize=self._function is not None)
+
+
+class PersistentMapping(Mapping):
+    """An immutable JSON object, as produced by :func:`freeze`.
+
+    Applying a patch to a persistent document returns a new version of it:
+    only the nodes on the path of each operation are copied, all the others
+    are shared with the previous version. That makes keeping every version
+    of a document cheap, and `copy` operations free.
+
+    >>> v1 = freeze({'a': {'b': 1}, 'c': [1, 2]})
+    >>> patch = JsonPatch([{'op': 'replace', 'path': '/a/b', 'value': 2}])
+    >>> v2 = patch.apply(v1)
+    >>> v2['c'] is v1['c']
+    True
+    >>> thaw(v1) == {'a': {'b': 1}, 'c': [1, 2]}
+    True
+    >>> v2 == {'a': {'b': 2}, 'c': [1, 2]}
+    True
+    """
+
+    __slots__ = ('_data', '_hash')
+
+    def __init__(self, *args, **kwargs):
+        self._data = dict(
+            (key, freeze(value))
+            for key, value in dict(*args, **kwargs).items()
+        )
+        self._hash = None
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self._data.items()))
+        return self._hash
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self._data)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class PersistentSequence(Sequence):
+    """An immutable JSON array, the counterpart of :class:`PersistentMapping`."""
+
+    __slots__ = ('_items', '_hash')
+
+    def __init__(self, items=()):
+        self._items = tuple(freeze(item) for item in items)
+        self._hash = None
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return type(self)(self._items[index])
+        return self._items[index]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __eq__(self, other):
+        if isinstance(other, PersistentSequence):
+            return self._items == other._items
+        if isinstance(other, (list, tuple)):
+            return self._items == tuple(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(self._items)
+        return self._hash
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, list(self._items))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def freeze(doc):
+    """Returns a persistent version of the JSON document `doc`.
+
+    Objects become :class:`PersistentMapping` and arrays
+    :class:`PersistentSequence` instances; persistent nodes found in `doc`
+    are reused as they are.
+
+    :param doc: JSON document.
+
+    :return: Persistent document.
+    """
+    if isinstance(doc, (PersistentMapping, PersistentSequence)):
+        return doc
+    if isinstance(doc, Mapping):
+        return PersistentMapping(doc)
+    if isinstance(doc, Sequence) and not isinstance(doc, basestring):
+        return PersistentSequence(doc)
+    return doc
+
+
+def thaw(doc):
+    """Returns a mutable copy of the persistent document `doc`.
+
+    :param doc: Persistent document, see :func:`freeze`.
+
+    :return: JSON document made of plain dicts and lists.
+    """
+    if isinstance(doc, Mapping):
+        return dict((key, thaw(value)) for key, value in doc.items())
+    if isinstance(doc, Sequence) and not isinstance(doc, basestring):
+        return [thaw(item) for item in doc]
+    return doc
+
+
+class _MutationLog(object):
+    """The operations recorded by the proxies of a tracked document."""
+
+    __slots__ = ('operations', 'pointer_cls')
+
+    def __init__(self, pointer_cls):
+        self.operations = []
+        self.pointer_cls = pointer_cls
+
+
+class _Tracked(object):
+    """
+    The behaviour shared by :class:`TrackedMapping` and
+    :class:`TrackedSequence`: each proxy wraps a container of the document,
+    and knows the proxy it was obtained from and its key there, from which
+    its location is found when it records an operation.
+    """
+
+    __slots__ = ('_data', '_log', '_parent', '_key')
+
+    def __init__(self, data, log, parent=None, key=None):
+        self._data = data
+        self._log = log
+        self._parent = parent
+        self._key = key
+
+    def patch(self):
+        """Returns the changes made through the proxies of the document.
+
+        The operations are recorded as the changes are made, and compacted
+        with :meth:`JsonPatch.optimize`, so this takes time in the number of
+        changes rather than in the size of the document.
+
+        :return: :class:`JsonPatch` instance.
+        """
+        log = self._log
+        return JsonPatch(list(log.operations),
+                         pointer_cls=log.pointer_cls).optimize()
+
+    def _wrap(self, key, value):
+        """
+        This function returns a proxy of a value of the container, or the
+        value itself when it is a scalar.
+
+        Args:
+            key (str): The `key` input parameter is the key of the value.
+            value (): The `value` input parameter is the value.
+
+        Returns:
+            object: The proxy or scalar.
+
+        """
+        if isinstance(value, MutableMapping):
+            return TrackedMapping(value, self._log, self, key)
+        if isinstance(value, MutableSequence):
+            return TrackedSequence(value, self._log, self, key)
+        return value
+
+    def _location(self):
+        """
+        This function returns the current location of the container in the
+        document. The indices of arrays are checked, and looked up again when
+        elements were inserted or removed before the container since its
+        proxy was obtained.
+
+        Returns:
+            str: The JSON pointer of the container, or None when it is no
+            longer in the document.
+
+        """
+        chain = []
+        node = self
+        while node._parent is not None:
+            chain.append(node)
+            node = node._parent
+
+        path = ''
+        for node in reversed(chain):
+            data, key = node._parent._data, node._key
+            if isinstance(data, MutableMapping):
+                if data.get(key, _MISSING) is not node._data:
+                    return None
+            elif not (key < len(data) and data[key] is node._data):
+                for index, item in enumerate(data):
+                    if item is node._data:
+                        key = node._key = index
+                        break
+                else:
+                    return None
+            path = _path_join(path, key)
+        return path
+
+    def _record(self, op, key, *value):
+        """
+        This function records an operation on a member of the container,
+        unless the container was taken out of the document.
+
+        Args:
+            op (str): The `op` input parameter is the name of the operation.
+            key (str): The `key` input parameter is the key of the member.
+            *value (): The `value` input parameter holds the value of the
+                operation, which is copied, if it has one.
+
+        """
+        location = self._location()
+        if location is None:
+            return
+
+        operation = {'op': op, 'path': _path_join(location, key)}
+        if value:
+            operation['value'] = _copy_value(value[0])
+        self._log.operations.append(operation)
+
+    def __eq__(self, other):
+        if isinstance(other, _Tracked):
+            other = other._data
+        return self._data == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self._data)
+
+    def __copy__(self):
+        return copy.copy(self._data)
+
+    def __deepcopy__(self, memo):
+        return _copy_value(self._data)
+
+
+def _stored(value):
+    """
+    This function returns the value to store in a tracked document: a copy,
+    so that the document only ever changes through its proxies.
+    """
+    if isinstance(value, _Tracked):
+        value = value._data
+    return _copy_value(value)
+
+
+class TrackedMapping(_Tracked, MutableMapping):
+    """A JSON object of a document returned by :func:`track`."""
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        return self._wrap(key, self._data[key])
+
+    def __setitem__(self, key, value):
+        op = 'replace' if key in self._data else 'add'
+        self._data[key] = _stored(value)
+        self._record(op, key, value)
+
+    def __delitem__(self, key):
+        del self._data[key]
+        self._record('remove', key)
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+class TrackedSequence(_Tracked, MutableSequence):
+    """A JSON array of a document returned by :func:`track`."""
+
+    __slots__ = ()
+
+    def _index(self, index):
+        """
+        This function turns a possibly negative index into a position in
+        the array, raising IndexError if there is no such element.
+        """
+        length = len(self._data)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError('list index out of range')
+        return index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in
+                    range(*index.indices(len(self._data)))]
+        index = self._index(index)
+        return self._wrap(index, self._data[index])
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self._data))
+            values = list(value)
+            if step == 1:
+                del self[start:stop]
+                for offset, item in enumerate(values):
+                    self.insert(start + offset, item)
+                return
+
+            positions = range(start, stop, step)
+            if len(positions) != len(values):
+                raise ValueError(
+                    'attempt to assign sequence of size {0} to extended '
+                    'slice of size {1}'.format(len(values), len(positions)))
+            for position, item in zip(positions, values):
+                self[position] = item
+            return
+
+        index = self._index(index)
+        self._data[index] = _stored(value)
+        self._record('replace', index, value)
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            positions = range(*index.indices(len(self._data)))
+            for position in sorted(positions, reverse=True):
+                del self[position]
+            return
+
+        index = self._index(index)
+        del self._data[index]
+        self._record('remove', index)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        for index, item in enumerate(self._data):
+            yield self._wrap(index, item)
+
+    def insert(self, index, value):
+        length = len(self._data)
+        if index < 0:
+            index = max(0, index + length)
+        index = min(index, length)
+        self._data.insert(index, _stored(value))
+        self._record('add', index, value)
+
+    def sort(self, key=None, reverse=False):
+        """Sorts the array in place, like :meth:`list.sort`, and records it
+        as a replace of the whole array. `key` is given the elements
+        themselves rather than their proxies.
+
+        >>> doc = {'a': [3, 1, 2]}
+        >>> tracked = track(doc)
+        >>> tracked['a'].sort(reverse=True)
+        >>> doc
+        {'a': [3, 2, 1]}
+        >>> tracked.patch().patch
+        [{'op': 'replace', 'path': '/a', 'value': [3, 2, 1]}]
+        """
+        data = self._data
+        before = list(data)
+        data.sort(key=key, reverse=reverse)
+        if all(item is old for item, old in zip(data, before)):
+            return
+
+        location = self._location()
+        if location is not None:
+            self._log.operations.append(
+                {'op': 'replace', 'path': location,
+                 'value': _copy_value(data)})
+
+
+def track(doc, pointer_cls=JsonPointer):
+    """Returns a proxy of the JSON document `doc` that records the changes
+    made through it, so that the patch of the changes does not need a copy
+    of the document from before them nor a diff.
+
+    `doc` is changed in place. Objects and arrays read from the proxy are
+    proxies of the same document, and stored values are copied, so that
+    the document only changes through them; changes made through proxies
+    of values no longer in the document are not recorded. Containers must
+    not appear at several locations of `doc`.
+
+    >>> doc = {'name': 'a', 'items': [{'n': 1}, {'n': 2}]}
+    >>> tracked = track(doc)
+    >>> tracked['items'].insert(0, {'n': 0})
+    >>> tracked['items'][2]['n'] = 3
+    >>> tracked['name'] = 'b'
+    >>> tracked['name'] = 'c'
+    >>> patch = tracked.patch()
+    >>> len(patch.patch)
+    3
+    >>> patch.apply({'name': 'a', 'items': [{'n': 1}, {'n': 2}]}) == doc
+    True
+
+    :param doc: JSON document, an object or an array.
+
+    :param pointer_cls: JSON pointer class to use for the patch.
+    :type pointer_cls: Type[JsonPointer]
+
+    :return: :class:`TrackedMapping` or :class:`TrackedSequence` instance.
+    """
+    log = _MutationLog(pointer_cls)
+    if isinstance(doc, MutableMapping):
+        return TrackedMapping(doc, log)
+    if isinstance(doc, MutableSequence):
+        return TrackedSequence(doc, log)
+    raise TypeError("Only objects and arrays can be tracked")
+
+
+class DiffBuilder(object):
+
+    def __init__(self, src_doc, dst_doc, dumps=json.dumps, pointer_cls=JsonPointer,
+                 align_lists=False, list_key=None, include=None,
+                 exclude=None):
+        """
+        This function initializes an object for indexing and comparing two JSON
+        documents using the `JsonPointer` class and `dumps` function.
+
+        Args:
+            src_doc (dict): The `src_doc` input parameter is the original document
+                being transformed.
+            dst_doc (list): The `dst_doc` input parameter is not used at all within
+                this specific code snippet. The parameter is passed but then
+                immediately discarded without being accessed or referred to within
+                the body of the function.
+            dumps (str): The `dumps` input parameter is used to specify a function
+                for converting Python objects to JSON data.
+            pointer_cls (int): The `pointer_cls` parameter is used to specify the
+                class to use for representing JsonPointer objects.
+            align_lists (bool): The `align_lists` parameter selects the
+                alignment-based list comparison of `_aligned_list_steps()`.
+            list_key (str): The `list_key` parameter selects the key-based
+                list comparison of `_keyed_list_steps()`: the name of the
+                member identifying the records of every array, or a function
+                returning it, or None, given the path of an array.
+            include (list): The `include` parameter is the patterns of the
+                locations to compare, or None for all; see `_PathRules`.
+            exclude (list): The `exclude` parameter is the patterns of the
+                locations not to compare.
+
+        """
+        self.dumps = dumps
+        self.pointer_cls = pointer_cls
+        self.align_lists = align_lists
+        self.list_key = list_key
+        self.include = include
+        self.exclude = exclude
+        self.rules = None
+        if include or exclude:
+            self.rules = _PathRules(include, exclude, pointer_cls)
+        self._rule_states = {}
+        # paths of the containers to replace whole; see _plan_replacements()
+        self._replaced = set()
+        self._fingerprints = {}
+        self._interned = {}
+        self._equality_keys = {}
+        self.index_storage = [{}, {}]
+        self.index_storage2 = [{}, {}]
+        # the _OpChain of each array, by location, once there are enough
+        # operations; see _start_chains()
+        self._chains = None
+        self._entries = {}
+        # the nodes of the additions and removals of array elements not
+        # matched into moves yet, by array; see _nested_element()
+        self._unpaired = {}
+        self._pinned = set()
+        self._size = 0
+        self.__root = root = []
+        self.src_doc = src_doc
+        self.dst_doc = dst_doc
+        root[:] = [root, root, None]
+
+    def _fingerprint(self, value):
+        """
+        This function returns the structural fingerprint of a JSON value: a
+        small integer that two values share if and only if they are equal as
+        JSON. Unlike `==`, it tells apart `1`, `1.0` and `True`. Fingerprints
+        are hash-consed, so they are exact, and computed bottom-up once per
+        container; later lookups are O(1).
+
+        Args:
+            value (): The `value` input parameter is the value to fingerprint.
+
+        Returns:
+            int: The fingerprint of `value`.
+
+        """
+        fingerprints = self._fingerprints
+        if not isinstance(value, (MutableMapping, MutableSequence)):
+            return self._intern(_scalar_key(value))
+
+        entry = fingerprints.get(id(value))
+        if entry is not None:
+            return entry[1]
+
+        # post-order walk, so every child is done before its parent
+        stack = [(value, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if id(node) in fingerprints:
+                continue
+
+            is_mapping = isinstance(node, MutableMapping)
+            children = node.values() if is_mapping else node
+            if not children_done:
+                stack.append((node, True))
+                for child in children:
+                    if isinstance(child, (MutableMapping, MutableSequence)) \
+                            and id(child) not in fingerprints:
+                        stack.append((child, False))
+                continue
+
+            if is_mapping:
+                key = (dict, frozenset(
+                    (k, self._fingerprint(v)) for k, v in node.items()))
+            else:
+                key = (list, tuple(self._fingerprint(v) for v in node))
+            # keep the node alive so that its id cannot be reused
+            fingerprints[id(node)] = (node, self._intern(key))
+
+        return fingerprints[id(value)][1]
+
+    def _same_value(self, src, dst):
+        """
+        This function tells whether comparing two values would find no
+        difference, without walking them more than needed: identical
+        objects and values with equal fingerprints are recognized in O(1),
+        containers get a C-level `==` check, and scalars are compared by
+        type and value instead of being serialized.
+
+        As in `_positional_list_steps()`, elements of arrays are considered equal
+        when `==` says so. Objects are walked further, as their values are
+        compared exactly.
+
+        Args:
+            src (): The `src` input parameter is the first value.
+            dst (): The `dst` input parameter is the second value.
+
+        Returns:
+            bool: True if comparing the values would not produce operations;
+            False when they differ or that could not be decided cheaply.
+
+        """
+        if src is dst:
+            return True
+
+        fingerprints = self._fingerprints
+        if fingerprints:
+            src_entry = fingerprints.get(id(src))
+            dst_entry = fingerprints.get(id(dst))
+            if src_entry is not None and dst_entry is not None and \
+                    src_entry[1] == dst_entry[1]:
+                return True
+
+        if not isinstance(src, (MutableMapping, MutableSequence)):
+            if isinstance(dst, (MutableMapping, MutableSequence)):
+                return False
+            return self._same_scalar(src, dst)
+
+        if not _try_equal(src, dst):
+            return False
+        if not isinstance(src, MutableMapping):
+            return True
+
+        # == equates 1, 1.0 and True, which JSON does not: walk the objects
+        # down to their scalar values to tell them apart.
+        stack = [(src, dst)]
+        while stack:
+            src, dst = stack.pop()
+            for key, value in src.items():
+                other = dst[key]
+                if value is other:
+                    continue
+
+                cls = type(value)
+                if cls is dict or cls is not list and \
+                        isinstance(value, MutableMapping):
+                    stack.append((value, other))
+                elif cls is list or isinstance(value, MutableSequence):
+                    continue
+                elif not self._same_scalar(value, other):
+                    return False
+
+        return True
+
+    def _same_scalar(self, src, dst):
+        """
+        This function tells whether two scalars are equal as JSON, comparing
+        the plain JSON types by type and value without serializing them.
+
+        Args:
+            src (): The `src` input parameter is the first scalar.
+            dst (): The `dst` input parameter is the second scalar.
+
+        Returns:
+            bool: True if `src` and `dst` are equal as JSON.
+
+        """
+        src_cls, dst_cls = type(src), type(dst)
+        if src_cls is dst_cls and src_cls in _JSON_SCALARS:
+            if src_cls is float:
+                return repr(src) == repr(dst)
+            return src == dst
+
+        if src_cls in _JSON_SCALARS and dst_cls in _JSON_SCALARS:
+            return False
+
+        # To ensure we catch changes to JSON, we can't rely on a simple
+        # src == dst, because it would not recognize the difference between
+        # 1 and True, among other things. For anything that is not a plain
+        # JSON type, using json.dumps is the most fool-proof way to ensure we
+        # catch type changes that matter to JSON and ignore those that don't.
+        return self.dumps(src) == self.dumps(dst)
+
+    def _intern(self, key):
+        """Returns the fingerprint number of a structural key."""
+        interned = self._interned
+        number = interned.get(key)
+        if number is None:
+            number = interned[key] = len(interned)
+        return number
+
+    def _equality_key(self, value):
+        """
+        This function returns a hashable key for a value, such that values
+        that are equal according to `==` have equal keys. Objects and arrays
+        are keyed by numbering the sets and tuples of their items' keys, which
+        hash and compare with the same semantics as the containers themselves
+        (`1`, `1.0` and `True` are alike). Values that are not equal may share
+        a key, so callers still compare the values themselves.
+
+        Args:
+            value (): The `value` input parameter is the value to key.
+
+        Returns:
+            The hashable key of `value`.
+
+        """
+        def scalar_key(item):
+            try:
+                hash(item)
+            except TypeError:
+                return (_UNHASHABLE,)
+            return (None, item)
+
+        containers = (MutableMapping, MutableSequence)
+        if not isinstance(value, containers):
+            return scalar_key(value)
+
+        interned = self._equality_keys
+        keys = {}
+
+        def key_of(item):
+            if isinstance(item, containers):
+                return keys[id(item)]
+            return scalar_key(item)
+
+        # post-order walk, so every child is done before its parent
+        stack = [(value, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if id(node) in keys:
+                continue
+
+            is_mapping = isinstance(node, MutableMapping)
+            children = node.values() if is_mapping else node
+            if not children_done:
+                stack.append((node, True))
+                for child in children:
+                    if isinstance(child, containers) and id(child) not in keys:
+                        stack.append((child, False))
+                continue
+
+            if is_mapping:
+                key = (dict, frozenset(
+                    (k, key_of(v)) for k, v in node.items()))
+            else:
+                key = (list, tuple(key_of(v) for v in node))
+            number = interned.get(key)
+            if number is None:
+                number = interned[key] = len(interned)
+            keys[id(node)] = number
+
+        return keys[id(value)]
+
+    def store_index(self, value, index, st):
+        """
+        This function stores an item (value and its type) and an index for the
+        item with a specific storage (st). If the item is already stored with the
+        same value and type before. It just appends the index to the existing list
+        of indices stored with that value. If it's not already stored before then
+        it stores a new list of only that index for that value-type combo.
+        Note that the function catches a TypeError exception which suggests that
+        the typed_key or the storage used by this function expects particular type
+        information to exist therein but cannot guarantee that these conditions
+        do indeed apply within.
+
+        Args:
+            value (): The `value` parameter is used to form a tuples of typed key
+                for indexing purposes.
+            index (int): The `index` input parameter is used to store the index
+                of the value inside the storage container.
+            st (str): The `st` parameter is a storage dictionary key that specifies
+                which of two indexing structures to use for storing the value and
+                its index.
+
+        """
+        typed_key = (value, type(value))
+        try:
+            storage = self.index_storage[st]
+            stored = storage.get(typed_key)
+            if stored is None:
+                storage[typed_key] = [index]
+            else:
+                storage[typed_key].append(index)
+
+        except TypeError:
+            # Unhashable values are bucketed by a hashable key that is equal
+            # for equal values, so they don't need a linear scan.
+            self.index_storage2[st].setdefault(
+                self._equality_key(value), []).append((typed_key, index))
+
+    def take_index(self, value, st):
+        """
+        This function takes a value and a search type (st) as inputs and returns
+        the corresponding index of the value from two stored indexes. It first
+        looks up the value's typed key (value and its type) from the index storage
+        using a tries-like approach and then pops the found index if it exists.
+
+        Args:
+            value (dict): The `value` input parameter is used to look up an entry
+                associated with it and its type (`type(value)`) by being added to
+                a dictionary of dictionaries using `typed_key = (value)` for
+                indexing and then attempting to retrieve the associated value
+                through subsequent calls to the dictionary within `self.index_storage`
+                and finally to `storage`.
+            st (str): In this function `take_index`, `st` is an input parameter
+                that refers to a storage dictionary of the same type as `self.index_storage`.
+
+        Returns:
+            int: The output returned by the `take_index` function is either the
+            value popped from the internal dictionary stored at
+            `self.index_storage[st][typed_key]` if it exists and is not `None`,
+            or the value poped from the bucket of `self.index_storage2[st]` that
+            holds the values equal to an unhashable `value`.
+
+        """
+        typed_key = (value, type(value))
+        pinned = self._pinned
+        try:
+            stored = self.index_storage[st].get(typed_key)
+            while stored:
+                index = stored.pop()
+                if id(index) not in pinned:
+                    return index
+
+        except TypeError:
+            storage = self.index_storage2[st].get(self._equality_key(value))
+            if not storage:
+                return None
+            for i in range(len(storage)-1, -1, -1):
+                stored_value, stored_type = storage[i][0]
+                if stored_type == typed_key[1] and \
+                        (stored_value is value or _equal(stored_value, value)):
+                    index = storage.pop(i)[1]
+                    if id(index) not in pinned:
+                        return index
+
+    def insert(self, op):
+        """
+        The given function `insert` takes an operation `op` as input and performs
+        the following action on a linked list:
+        Inserts `op` at the end of the list (i.e., after the last element), linking
+        it to the previous last element of the list.
+
+        Args:
+            op (list): The `op` input parameter is used to store the value being
+                inserted into the tree. It is assigned to the second element of
+                the current node (i.e., last[1]) and then used to construct a new
+                node with three elements: last+op.
+
+        Returns:
+            list: The output returned by this function is `last`.
+
+        """
+        root = self.__root
+        last = root[0]
+        last[1] = root[0] = [last, root, op]
+        self._size += 1
+        if self._chains is not None:
+            self._track(root[0])
+        elif self._size > _CHAIN_MIN_OPS:
+            self._start_chains()
+        return root[0]
+
+    def _start_chains(self):
+        """
+        This function starts tracking the array indices of the operations in
+        the chains of their containers, once there are too many operations
+        to scan for each index fixup.
+
+        """
+        self._chains = {}
+        root = self.__root
+        curr = root[1]
+        while curr is not root:
+            self._track(curr)
+            curr = curr[1]
+
+    def _track(self, index):
+        """
+        This function records the array indices that the operation of a node
+        removes from and adds at in the chains of the containers they belong
+        to, so that index fixups only visit the operations they can affect.
+
+        Args:
+            index (list): The `index` input parameter is the node to track.
+
+        """
+        entries = None
+        for path, removed, added in _index_slots(index[2]):
+            chain = self._chains.get(path)
+            if chain is None:
+                chain = self._chains[path] = _OpChain()
+            entry = chain.track(index, removed, added)
+            if entry is not None:
+                if entries is None:
+                    entries = self._entries.setdefault(id(index), [])
+                entries.append(entry)
+
+    def _sync(self, index):
+        """
+        This function writes the array indices that index fixups shifted
+        back to the operation of a node.
+
+        Args:
+            index (list): The `index` input parameter is the node to update.
+
+        """
+        for entry in self._entries.get(id(index), ()):
+            if entry[3]:
+                _write_back(entry)
+
+    def _sync_all(self):
+        """
+        This function writes the array indices that index fixups shifted back
+        to all operations.
+
+        """
+        if self._chains is None:
+            return
+        for chain in self._chains.values():
+            for index in chain.shifted():
+                self._sync(index)
+
+    def _undo_shift(self, index, key, removal):
+        """
+        This function fixes up the array indices of the operations that
+        follow a node as if the removal or the addition that its operation
+        makes at `key` had not happened; see `_OpChain.undo_remove()` and
+        `_OpChain.undo_add()`. Until the chains are tracked, the following
+        operations are scanned and fixed up directly instead.
+
+        Args:
+            index (list): The `index` input parameter is the node.
+            key (int): The `key` input parameter is the index of the element
+                the operation removes or adds.
+            removal (bool): The `removal` input parameter tells whether the
+                operation removes the element.
+
+        Returns:
+            int: `key` shifted by the following operations in turn.
+
+        """
+        path = index[2].location.rpartition('/')[0]
+        if self._chains is not None:
+            chain = self._chains[path]
+            if removal:
+                return chain.undo_remove(index, key)
+            return chain.undo_add(index, key)
+
+        shift = 1 if removal else -1
+        root = self.__root
+        curr = index[1]
+        while curr is not root:
+            op = curr[2]
+            for slot_path, removed, added in _index_slots(op):
+                if slot_path != path:
+                    continue
+                if removed is not None:
+                    if removed > key or removal and removed == key:
+                        if type(op) is MoveOperation:
+                            op.from_key = removed + shift
+                        else:
+                            op.key = removed + shift
+                    else:
+                        key -= 1
+                if added is not None:
+                    if added > key:
+                        op.key = added + shift
+                    else:
+                        key += 1
+            curr = curr[1]
+        return key
+
+    def remove(self, index):
+        """
+        This function removes an element at a given index from a list of links
+        (i.e., a linked list) by replacing the elements at the indices `link_prev`
+        and `link_next` with each other's values and then resetting the index to
+        an empty list.
+
+        Args:
+            index (list): In this function `remove(self index)` the input parameter
+                `index` is used to specify which element to remove from the list.
+                It is a tuple of three elements representing the previous and next
+                links of the element to be removed.
+
+        """
+        link_prev, link_next, _ = index
+        link_prev[1] = link_next
+        link_next[0] = link_prev
+        index[:] = []
+        self._size -= 1
+        if self._entries:
+            self._entries.pop(id(index), None)
+        if self._pinned:
+            self._pinned.discard(id(index))
+
+    def iter_from(self, start):
+        """
+        This function iterates over the edges of a graph starting from a given
+        vertex and yields the vertices at the other end of each edge.
+
+        Args:
+            start (list): The `start` input parameter specifies the starting node
+                of the tree traversal.
+
+        """
+        self._sync_all()
+        root = self.__root
+        curr = start[1]
+        while curr is not root:
+            yield curr[2]
+            curr = curr[1]
+
+    def __iter__(self):
+        """
+        This function implements an iterator for a data structure. It starts at
+        the second child of the root node (the first child is the root itself),
+        and iterates over all the nodes that have a third child (i.e., all the leaves).
+
+        """
+        self._sync_all()
+        root = self.__root
+        curr = root[1]
+        while curr is not root:
+            yield curr[2]
+            curr = curr[1]
+
+    def execute(self):
+        """
+        This function takes a root node of an operation tree and iterates over all
+        operations (Add/Remove/Replace) below the root node. It yields each operation
+        along with its pointer (location and value).
+
+        Returns:
+            generator: The operations' dicts, a removal followed by an addition
+            at the same location being merged into a replacement.
+
+        """
+        return self._merge_replaced(iter(self))
+
+    def iter_operations(self, max_pending=None):
+        """
+        This generator compares `src_doc` with `dst_doc` and yields the
+        operations of the patch as they are found, rather than after the
+        whole comparison like `execute()`.
+
+        Operations can only be yielded once they can no longer be turned
+        into moves by a later match, so once `max_pending` operations are
+        waiting, the values not matched so far are given up as sources and
+        targets of moves, and the waiting operations are yielded. With
+        `max_pending=None`, nothing is yielded before the comparison ends,
+        and the patch is the one `execute()` produces.
+
+        Args:
+            max_pending (int): The `max_pending` input parameter bounds the
+                number of operations held back, checked each time the
+                comparison enters or leaves a nested container.
+
+        """
+        steps = self._value_steps('', None, self.src_doc, self.dst_doc)
+        if steps is not None:
+            for _ in self._iter_steps(steps):
+                if max_pending is not None and self._size >= max_pending:
+                    for operation in self._flush(keep_last=True):
+                        yield operation
+
+        for operation in self._flush(keep_last=False):
+            yield operation
+
+    def _flush(self, keep_last):
+        """
+        This function stops matching the pending operations into moves and
+        takes them out of the operation list.
+
+        Args:
+            keep_last (bool): The `keep_last` input parameter keeps the last
+                operation in the list if it is a removal, which the next
+                operation may still turn into a replacement.
+
+        Returns:
+            generator: The operations taken out, merged like in `execute()`.
+
+        """
+        self._sync_all()
+        for storage in self.index_storage + self.index_storage2:
+            storage.clear()
+        self._chains = None
+        self._entries = {}
+        self._unpaired = {}
+        self._pinned = set()
+        self._equality_keys = {}
+
+        root = self.__root
+        stop = root
+        if keep_last and type(root[0][2]) == RemoveOperation:
+            stop = root[0]
+
+        ops = []
+        curr = root[1]
+        while curr is not stop:
+            ops.append(curr[2])
+            following = curr[1]
+            self.remove(curr)
+            curr = following
+        return self._merge_replaced(ops)
+
+    def _merge_replaced(self, ops):
+        """
+        This generator yields the operations' dicts, merging the removal and
+        addition of the same location into a replacement.
+
+        Args:
+            ops (iterable): The `ops` input parameter is the operations, in
+                order.
+
+        """
+        pending = None
+        for op in ops:
+            if pending is not None:
+                if pending.location == op.location and \
+                        type(pending) == RemoveOperation and \
+                        type(op) == AddOperation:
+                    yield ReplaceOperation({
+                        'op': 'replace',
+                        'path': op.location,
+                        'value': op.operation['value'],
+                    }, pointer_cls=self.pointer_cls).operation
+                    pending = None
+                    continue
+
+                yield pending.operation
+            pending = op
+
+        if pending is not None:
+            yield pending.operation
+
+    def _item_added(self, path, key, item):
+        """
+        This function handles the addition of an item to a doubly-linked list data
+        structure. It takes the item to be added and the path to where it should
+        be inserted as input. The function checks if the item already exists
+        somewhere else on the list and if so moves it instead of adding it twice.
+
+        Args:
+            path (): The `path` input parameter is a sequence of keys that represents
+                the path to the item being added.
+            key (int): The `key` input parameter is the key of the item being added.
+            item (int): The `item` parameter is the item being added to the collection.
+
+        """
+        index = self.take_index(item, _ST_REMOVE)
+        if index is not None:
+            self._sync(index)
+            op = index[2]
+            if type(op.key) == int and type(key) == int:
+                op.key = self._undo_shift(index, op.key, True)
+
+            self.remove(index)
+            if op.location != _path_join(path, key):
+                new_op = MoveOperation({
+                    'op': 'move',
+                    'from': op.location,
+                    'path': _path_join(path, key),
+                }, pointer_cls=self.pointer_cls)
+                self.insert(new_op)
+        else:
+            new_op = AddOperation({
+                'op': 'add',
+                'path': _path_join(path, key),
+                'value': item,
+            }, pointer_cls=self.pointer_cls)
+            new_index = self.insert(new_op)
+            self.store_index(item, new_index, _ST_ADD)
+            if type(key) == int:
+                self._unpaired.setdefault(path, []).append(new_index)
+
+    def _item_removed(self, path, key, item):
+        """
+        This function is a decorator that undo-es an operation performed on a
+        dictionaries like data structure. Whenever an item is removed from the
+        dictionary using `pop`, this function is called with the path of the item
         to be removed (`path` and `key`), the item being removed (`item`), and the
         index where the item was located (`index`). It creates a new `RemoveOperation`
         instance and updates the index to reflect the removal. If the item was
-        previously added using `push`, it undoes the addition by calling the
-        `__on_undo_add()` method on the item and removes it from the index.
+        previously added, it undoes the addition in the index chain of its
+        array and turns the two operations into a move.
+
+        Args:
+            path (): In this function `path` is a string used to create the path
+                of the RemoveOperation by joining it with the key passed as a argument.
+            key (str): The `key` parameter is the key of the item that was just
+                removed from the document.
+            item (str): The `item` input parameter is the item that was just removed
+                from the dictionary.
+
+        """
+        new_op = RemoveOperation({
+            'op': 'remove',
+            'path': _path_join(path, key),
+        }, pointer_cls=self.pointer_cls)
+        index = self.take_index(item, _ST_ADD)
+        new_index = self.insert(new_op)
+        if index is not None:
+            self._sync(index)
+            op = index[2]
+            # We can't rely on the op.key type since PatchOperation casts
+            # the .key property to int and this path wrongly ends up being taken
+            # for numeric string dict keys while the intention is to only handle lists.
+            # So we do an explicit check on the item affected by the op instead.
+            added_item = op.pointer.to_last(self.dst_doc)[0]
+            if type(added_item) == list:
+                op.key = self._undo_shift(index, op.key, False)
+
+            self.remove(index)
+            self._sync(new_index)
+            if new_op.location != op.location:
+                new_op = MoveOperation({
+                    'op': 'move',
+                    'from': new_op.location,
+                    'path': op.location,
+                }, pointer_cls=self.pointer_cls)
+                new_index[2] = new_op
+                if self._chains is not None:
+                    self._track(new_index)
+
+            else:
+                self.remove(new_index)
+
+        else:
+            self.store_index(item, new_index, _ST_REMOVE)
+            if type(key) == int:
+                self._unpaired.setdefault(path, []).append(new_index)
+
+    def _item_replaced(self, path, key, item):
+        """
+        This function performs a "replace" operation on a hierarchical data structure
+        using a "ReplaceOperation" object.
+
+        Args:
+            path (str): The `path` input parameter specifies the relative path of
+                the key that is being replaced.
+            key (str): The `key` input parameter is the name of the item being replaced.
+            item (): The `item` parameter is the new value that should be inserted
+                into the list at the specified key.
+
+        """
+        self.insert(ReplaceOperation({
+            'op': 'replace',
+            'path': _path_join(path, key),
+            'value': item,
+        }, pointer_cls=self.pointer_cls))
+
+    def _nested_element(self, path, key):
+        """
+        This function is called before the comparison goes into the element
+        at `key` of an array. The additions and removals of elements at or
+        before it that are still waiting for a match are no longer matched
+        into moves: a move takes the place of the later of its two
+        operations, and the index fixups that follow only reach the array
+        itself, so the operations found within the element in the meantime
+        would be left pointing at the wrong element.
+
+        Args:
+            path (str): The `path` input parameter is the location of the
+                array.
+            key (int): The `key` input parameter is the index of the element.
+
+        """
+        nodes = self._unpaired.get(path)
+        if not nodes:
+            return
+
+        waiting = []
+        for node in nodes:
+            if not node:
+                # matched into a move, or taken out of the list
+                continue
+            self._sync(node)
+            if node[2].key <= key:
+                self._pinned.add(id(node))
+            else:
+                waiting.append(node)
+        self._unpaired[path] = waiting
+
+    def _element_added(self, path, key, item):
+        """
+        This function records the addition of an array element that is not
+        to be matched with a removal into a move.
+
+        Args:
+            path (str): The `path` input parameter is the location of the
+                array.
+            key (int): The `key` input parameter is the index of the element.
+            item (): The `item` input parameter is the element added.
+
+        """
+        self.insert(AddOperation({
+            'op': 'add',
+            'path': _path_join(path, key),
+            'value': item,
+        }, pointer_cls=self.pointer_cls))
+
+    def _element_removed(self, path, key, item):
+        """
+        This function records the removal of an array element that is not
+        to be matched with an addition into a move.
+
+        Args:
+            path (str): The `path` input parameter is the location of the
+                array.
+            key (int): The `key` input parameter is the index of the element.
+            item (): The `item` input parameter is the element removed.
+
+        """
+        self.insert(RemoveOperation({
+            'op': 'remove',
+            'path': _path_join(path, key),
+        }, pointer_cls=self.pointer_cls))
+
+    def _item_moved(self, path, key, from_key):
+        """
+        This function records the move of an array element to another index
+        of the same array.
+
+        Args:
+            path (str): The `path` input parameter is the location of the
+                array.
+            key (int): The `key` input parameter is the index the element is
+                moved to.
+            from_key (int): The `from_key` input parameter is the index the
+                element is moved from.
+
+        """
+        self.insert(MoveOperation({
+            'op': 'move',
+            'from': _path_join(path, from_key),
+            'path': _path_join(path, key),
+        }, pointer_cls=self.pointer_cls))
+
+    def _compare_dicts(self, path, src, dst):
+        """
+        This function compares two dictionaries (src and dst), recording the
+        operations that turn `src` into `dst`. See `_dict_steps()`.
+
+        Args:
+            path (str): The `path` input parameter is the location of the
+                dictionaries being compared.
+            src (dict): The `src` parameter is the original dictionary.
+            dst (dict): The `dst` input parameter is the dictionary being
+                compared to the `src` dictionary.
+
+        """
+        self._run_steps(self._dict_steps(path, src, dst))
+
+    def _compare_lists(self, path, src, dst):
+        """
+        This function compares two lists (src and dst), recording the
+        operations that turn `src` into `dst`. See `_list_steps()`.
+
+        Args:
+            path (str): The `path` input parameter is the location of the
+                lists being compared.
+            src (list): The `src` input parameter is the original list.
+            dst (list): The `dst` input parameter is the list to compare it to.
+
+        """
+        self._run_steps(self._list_steps(path, src, dst))
+
+    def _compare_values(self, path, key, src, dst):
+        """
+        This function compares two objects (`src` and `dst`) for changes,
+        walking nested dictionaries and lists with an explicit stack below
+        the first levels, so that documents of any depth can be compared.
+
+        >>> depth = sys.getrecursionlimit() + 100
+        >>> src, dst = {'v': 1}, {'v': 2}
+        >>> for _ in range(depth):
+        ...     src, dst = {'a': src}, {'a': dst}
+        >>> patch = JsonPatch.from_diff(src, dst)
+        >>> patch.patch == [
+        ...     {'op': 'replace', 'path': '/a' * depth + '/v', 'value': 2}]
+        True
+
+        Args:
+            path (str): The `path` input parameter is used to construct the path
+                for the item being compared.
+            key (str): The `key` parameter specifies the specific item within the
+                MutableMapping or MutableSequence that is being compared.
+            src (): The `src` input parameter is the first object to be compared.
+            dst (list): The `dst` input parameter is the destination object that
+                is being compared to the `src` object.
+
+        """
+        steps = self._value_steps(path, key, src, dst)
+        if steps is not None:
+            self._run_steps(steps)
+
+    def _run_steps(self, steps, depth=0):
+        """
+        This function runs the comparison of two containers to completion.
+        The nested containers are compared by recursion, which is faster,
+        down to `_RECURSION_DEPTH` levels, and below that with the explicit
+        stack of `_iter_steps()`.
+
+        Args:
+            steps (generator): The `steps` input parameter is the step
+                generator of the outermost containers.
+            depth (int): The `depth` input parameter is the number of levels
+                of recursion above.
+
+        """
+        if depth < _RECURSION_DEPTH:
+            for nested in steps:
+                self._run_steps(nested, depth + 1)
+        else:
+            for _ in self._iter_steps(steps):
+                pass
+
+    def _iter_steps(self, steps):
+        """
+        This generator drives the comparison of two containers. Each step
+        generator records the operations of its own container and yields the
+        step generators of the nested containers that need comparing, which
+        are run to completion before it is resumed, so operations are
+        recorded in the same order as a depth-first recursion would.
+
+        It yields nothing useful, but pauses each time the comparison enters
+        or leaves a nested container.
+
+        Args:
+            steps (generator): The `steps` input parameter is the step
+                generator of the outermost containers.
+
+        """
+        stack = [steps]
+        while stack:
+            nested = next(stack[-1], None)
+            if nested is None:
+                stack.pop()
+            else:
+                stack.append(nested)
+            yield
+
+    def _value_steps(self, path, key, src, dst):
+        """
+        This function compares two values. Changed scalars are recorded
+        right away; changed containers are left to the returned steps.
+
+        Args:
+            path (str): The `path` input parameter is the location of the
+                container holding the values.
+            key (str): The `key` parameter is the key of the values in that
+                container.
+            src (): The `src` input parameter is the original value.
+            dst (): The `dst` input parameter is the value to compare it to.
+
+        Returns:
+            generator: The steps comparing the two containers, or None when
+            there is nothing left to compare.
+
+        """
+        if self.rules is not None:
+            if key is None:
+                state = self._rule_state(path)
+            else:
+                state = self.rules.child(self._rule_state(path), str(key))
+            if state is _SKIPPED:
+                return None
+
+            elif state is not _UNRESTRICTED:
+                # some rule applies within the values, so they are not
+                # compared as a whole but descended into
+                if isinstance(src, MutableMapping) and \
+                        isinstance(dst, MutableMapping):
+                    return self._dict_steps(_path_join(path, key), src, dst)
+                elif isinstance(src, MutableSequence) and \
+                        isinstance(dst, MutableSequence):
+                    return self._list_steps(_path_join(path, key), src, dst)
+                elif not state[0]:
+                    # only on the way to an included location
+                    return None
+
+        if self._same_value(src, dst):
+            return None
+
+        elif self._replaced and _path_join(path, key) in self._replaced:
+            self._item_replaced(path, key, dst)
+            return None
+
+        elif isinstance(src, MutableMapping) and \
+                isinstance(dst, MutableMapping):
+            return self._dict_steps(_path_join(path, key), src, dst)
+
+        elif isinstance(src, MutableSequence) and \
+                isinstance(dst, MutableSequence):
+            return self._list_steps(_path_join(path, key), src, dst)
+
+        else:
+            self._item_replaced(path, key, dst)
+            return None
+
+    def _dict_steps(self, path, src, dst):
+        """
+        This generator compares two dictionaries (src and dst) by identifying
+        added/removed keys and values using sets, and yields the steps that
+        compare the values of the keys they share.
+
+        Args:
+            path (str): The `path` input parameter is used to build the full path
+                of each item that has been removed or added by comparing the sets
+                of keys from both dictionaries.
+            src (dict): The `src` parameter is the dictionary that contains the
+                "original" values being compared.
+            dst (dict): The `dst` input parameter is the dictionary being compared
+                to the `src` dictionary.
+
+        """
+        for key in self._compare_keys(path, src, dst):
+            steps = self._value_steps(path, key, src[key], dst[key])
+            if steps is not None:
+                yield steps
+
+    def _compare_keys(self, path, src, dst):
+        """
+        This function records the keys that were removed from or added to a
+        dictionary, identifying them using sets.
+
+        Args:
+            path (str): The `path` input parameter is the location of the
+                dictionaries being compared.
+            src (dict): The `src` parameter is the original dictionary.
+            dst (dict): The `dst` input parameter is the dictionary being
+                compared to the `src` dictionary.
+
+        Returns:
+            set: The keys that both dictionaries have, whose values are left
+            to compare.
+
+        """
+        src_keys = set(src.keys())
+        dst_keys = set(dst.keys())
+        if self.rules is not None:
+            state = self._rule_state(path)
+            if state is not _UNRESTRICTED:
+                child = self.rules.child
+                skipped = set(key for key in src_keys | dst_keys
+                              if child(state, str(key)) is _SKIPPED)
+                # nor are the members only on the way to an included
+                # location added or removed whole
+                skipped.update(
+                    key for key in src_keys ^ dst_keys
+                    if self._on_the_way(_path_join(path, str(key))))
+                src_keys -= skipped
+                dst_keys -= skipped
+
+        added_keys = dst_keys - src_keys
+        removed_keys = src_keys - dst_keys
+
+        for key in removed_keys:
+            self._item_removed(path, str(key), src[key])
+
+        for key in added_keys:
+            self._item_added(path, str(key), dst[key])
+
+        return src_keys & dst_keys
+
+    def _rule_state(self, path):
+        """
+        This function returns the state of the include and exclude rules at
+        a location, from that of its parent.
+
+        Args:
+            path (str): The `path` input parameter is the location.
+
+        Returns:
+            object: The state; see `_PathRules`.
+
+        """
+        state = self._rule_states.get(path)
+        if state is None:
+            if path:
+                parent, token = path.rsplit('/', 1)
+                token = token.replace('~1', '/').replace('~0', '~')
+                state = self.rules.child(self._rule_state(parent), token)
+            else:
+                state = self.rules.root
+            self._rule_states[path] = state
+        return state
+
+    def _on_the_way(self, path):
+        """
+        This function tells whether a location is only on the way to the
+        locations that the include rules select, and not within one. The
+        container there keeps its members, its length and their order: only
+        the values it shares with the other container are compared.
+
+        Args:
+            path (str): The `path` input parameter is the location.
+
+        Returns:
+            bool: True if the location is only on the way to included ones.
+
+        """
+        if self.rules is None:
+            return False
+        state = self._rule_state(path)
+        return state is not _UNRESTRICTED and state is not _SKIPPED and \
+            not state[0]
+
+    def _skipped_elements(self, path):
+        """
+        This function returns the test of the include and exclude rules for
+        the elements of an array.
+
+        Args:
+            path (str): The `path` input parameter is the location of the
+                array.
+
+        Returns:
+            function: A function telling whether the element at an index is
+            skipped, or None if the rules skip no element of the array.
+
+        """
+        if self.rules is None:
+            return None
+        state = self._rule_state(path)
+        if state is _UNRESTRICTED:
+            return None
+        child = self.rules.child
+        return lambda key: child(state, str(key)) is _SKIPPED
+
+    def _plan_replacements(self, replace_subtrees, max_ops):
+        """
+        This function decides which changed containers to replace whole
+        rather than diff, from the estimates of a `_CostEstimator`, before
+        the comparison starts.
+
+        Args:
+            replace_subtrees (bool): The `replace_subtrees` input parameter
+                replaces the containers whose operations are estimated to
+                encode larger than a `replace` of them.
+            max_ops (int): The `max_ops` input parameter is the number of
+                operations the estimates are not to exceed, or None.
+
+        """
+        estimator = _CostEstimator(self, replace_subtrees)
+        estimator._compare_values('', None, self.src_doc, self.dst_doc)
+        self._replaced = estimator.replaced(max_ops)
+
+    def _compare_in_processes(self, workers):
+        """
+        This function compares `src_doc` with `dst_doc` like
+        `_compare_values()` does, comparing the members of two dictionaries
+        in a pool of processes. The shared keys are split into consecutive
+        chunks, each process records the changes it finds in its chunks, and
+        these are replayed here chunk by chunk, in the order a sequential
+        comparison would have found them.
+
+        That order only holds for processes forked from this one (see
+        `_pool_context()`). Spawned processes hash strings with another seed,
+        so they iterate the key sets of nested dictionaries in another order.
+        The operations then come in another order, and values may be matched
+        into other moves: the patch is equivalent, but not the same.
+
+        Args:
+            workers (int): The `workers` input parameter is the number of
+                processes to use.
+
+        """
+        src, dst = self.src_doc, self.dst_doc
+        if ProcessPoolExecutor is None or self._same_value(src, dst) or \
+                not isinstance(src, MutableMapping) or \
+                not isinstance(dst, MutableMapping):
+            self._compare_values('', None, src, dst)
+            return
+
+        keys = list(self._compare_keys('', src, dst))
+        size = max(1, -(-len(keys) // (workers * _CHUNKS_PER_WORKER)))
+        chunks = [keys[i:i + size] for i in range(0, len(keys), size)]
+
+        pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=_pool_context(),
+            initializer=_start_recorder,
+            initargs=(src, dst, self.dumps, self.pointer_cls,
+                      self.align_lists, self.list_key, self.include,
+                      self.exclude, self._replaced))
+        with pool:
+            for changes in pool.map(_record_changes, chunks):
+                for change in changes:
+                    getattr(self, change[0])(*change[1:])
+
+    def _list_steps(self, path, src, dst):
+        """
+        This function returns the steps comparing two lists, aligning them
+        first if `align_lists` is set.
+
+        Args:
+            path (str): The `path` input parameter is the location of the
+                lists being compared.
+            src (list): The `src` input parameter is the original list.
+            dst (list): The `dst` input parameter is the list to compare it to.
+
+        Returns:
+            generator: The steps comparing the two lists.
+
+        """
+        if self._on_the_way(path):
+            # the elements stay where they are, at their index in both lists
+            return self._positional_list_steps(path, src, dst)
+
+        field = self.list_key
+        if callable(field):
+            field = field(path)
+        if field is not None:
+            src_keys = self._record_keys(src, field)
+            if src_keys is not None:
+                dst_keys = self._record_keys(dst, field)
+                if dst_keys is not None:
+                    return self._keyed_list_steps(path, src, dst,
+                                                  src_keys, dst_keys)
+
+        if self.align_lists:
+            return self._aligned_list_steps(path, src, dst)
+        return self._positional_list_steps(path, src, dst)
+
+    def _record_keys(self, items, field):
+        """
+        This function returns the keys identifying the records of a list, as
+        the fingerprints of their `field` members.
+
+        Args:
+            items (list): The `items` input parameter is the list.
+            field (str): The `field` input parameter is the name of the member
+                identifying the records.
+
+        Returns:
+            list: The keys of the records in order, or None if some element
+            is not a record with a `field` member or two records share a key.
+
+        """
+        keys = []
+        for item in items:
+            if not isinstance(item, MutableMapping) or field not in item:
+                return None
+            keys.append(self._fingerprint(item[field]))
+        if len(set(keys)) != len(keys):
+            return None
+        return keys
+
+    def _keyed_list_steps(self, path, src, dst, src_keys, dst_keys):
+        """
+        This generator compares two lists of records by matching the records
+        by key instead of by position. Records whose key is gone are removed,
+        the longest run of shared records already in order stays in place
+        while the other shared records are moved next to their predecessor
+        in `dst`, and records with a new key are added. It then yields the
+        steps comparing each shared record with its match, so that changed
+        records get a nested diff and unchanged ones cost nothing.
+
+        Removed and added records are not matched into moves with values
+        elsewhere in the document: the index fixups of such a move only
+        reach operations on the array itself, not the nested diffs of its
+        records.
+
+        Args:
+            path (str): The `path` input parameter is the location of the
+                lists being compared.
+            src (list): The `src` input parameter is the original list.
+            dst (list): The `dst` input parameter is the list to compare it to.
+            src_keys (list): The `src_keys` input parameter is the keys of the
+                records of `src`, from `_record_keys()`.
+            dst_keys (list): The `dst_keys` input parameter is the keys of the
+                records of `dst`.
+
+        """
+        dst_index = dict((key, i) for i, key in enumerate(dst_keys))
+        src_index = dict((key, i) for i, key in enumerate(src_keys))
+
+        # the keys of the working copy of the list, updated as it is patched
+        current = []
+        for i, key in enumerate(src_keys):
+            if key in dst_index:
+                current.append(key)
+            else:
+                self._element_removed(path, len(current), src[i])
+
+        shared = [key for key in dst_keys if key in src_index]
+        in_place = _increasing_run([src_index[key] for key in shared])
+        for i, key in enumerate(shared):
+            if i in in_place:
+                continue
+            from_key = current.index(key)
+            del current[from_key]
+            to_key = current.index(shared[i - 1]) + 1 if i else 0
+            current.insert(to_key, key)
+            if from_key != to_key:
+                self._item_moved(path, to_key, from_key)
+
+        for i, key in enumerate(dst_keys):
+            if key not in src_index:
+                self._element_added(path, i, dst[i])
+
+        skipped = self._skipped_elements(path)
+        for i, key in enumerate(dst_keys):
+            if key in src_index and not (skipped and skipped(i)):
+                steps = self._value_steps(path, i, src[src_index[key]], dst[i])
+                if steps is not None:
+                    self._nested_element(path, i)
+                    yield steps
+
+    def _positional_list_steps(self, path, src, dst):
+        """
+        This generator compares two lists (src and dst) by iterating over their
+        elements and checking for equivalence. It yields the steps comparing
+        elements that are both dicts or both sequences. If an item is found to
+        be different between the lists it triggers a callback function
+        (itemRemoved and itemAdded).
+
+        Args:
+            path (str): The `path` input parameter is used to build a path for
+                printing out item comparison details.
+            src (list): The `src` input parameter is the first list being compared
+                to the second list `dst`.
+            dst (dict): The `dst` input parameter is the second list to be compared
+                with the first list `src`.
+
+        """
+        len_src, len_dst = len(src), len(dst)
+        max_len = max(len_src, len_dst)
+        min_len = min(len_src, len_dst)
+        on_the_way = self._on_the_way(path)
+        if on_the_way:
+            max_len = min_len
+        skipped = self._skipped_elements(path)
+        for key in range(max_len):
+            if key < min_len:
+                old, new = src[key], dst[key]
+                if _try_equal(old, new) or (skipped and skipped(key)):
+                    continue
+
+                elif on_the_way:
+                    # see _value_steps()
+                    steps = self._value_steps(path, key, old, new)
+                    if steps is not None:
+                        self._nested_element(path, key)
+                        yield steps
+
+                elif self._replaced and \
+                        _path_join(path, key) in self._replaced:
+                    # replaced whole, so not matched into a move elsewhere
+                    self._element_removed(path, key, old)
+                    self._element_added(path, key, new)
+
+                elif isinstance(old, MutableMapping) and \
+                    isinstance(new, MutableMapping):
+                    self._nested_element(path, key)
+                    yield self._dict_steps(_path_join(path, key), old, new)
+
+                elif isinstance(old, MutableSequence) and \
+                        isinstance(new, MutableSequence):
+                    self._nested_element(path, key)
+                    yield self._list_steps(_path_join(path, key), old, new)
+
+                else:
+                    self._item_removed(path, key, old)
+                    self._item_added(path, key, new)
+
+            elif len_src > len_dst:
+                self._item_removed(path, len_dst, src[key])
+
+            else:
+                self._item_added(path, key, dst[key])
+
+    def _aligned_list_steps(self, path, src, dst):
+        """
+        This generator compares two lists by first aligning their elements
+        with a shortest edit script, so that only the elements that were
+        actually inserted or deleted are reported. Within each run of changed
+        elements, deleted and inserted elements are paired up and compared
+        like `_positional_list_steps()` does, so that modified containers
+        still get a nested diff.
+
+        The elements left over are not matched into moves with values
+        elsewhere in the document, like the records of
+        `_keyed_list_steps()`: the move would take the place of a later
+        operation, after the nested diffs of the elements that follow,
+        which the index fixups of the move do not reach.
+
+        Args:
+            path (str): The `path` input parameter is the location of the
+                lists being compared.
+            src (list): The `src` input parameter is the original list.
+            dst (list): The `dst` input parameter is the list to compare it to.
+
+        """
+        index = 0
+        src_start = dst_start = 0
+        skipped = self._skipped_elements(path)
+        matches = _myers_matches(list(map(self._fingerprint, src)),
+                                 list(map(self._fingerprint, dst)))
+        matches.append((len(src), len(dst)))
+        for src_end, dst_end in matches:
+            removed = src[src_start:src_end]
+            added = dst[dst_start:dst_end]
+            paired = min(len(removed), len(added))
+            for old, new in zip(removed, added):
+                if skipped and skipped(index):
+                    # left as it is in src
+                    pass
+
+                elif self._replaced and \
+                        _path_join(path, index) in self._replaced:
+                    # replaced whole, so not matched into a move elsewhere
+                    self._element_removed(path, index, old)
+                    self._element_added(path, index, new)
+
+                elif isinstance(old, MutableMapping) and \
+                        isinstance(new, MutableMapping):
+                    self._nested_element(path, index)
+                    yield self._dict_steps(_path_join(path, index), old, new)
+
+                elif isinstance(old, MutableSequence) and \
+                        isinstance(new, MutableSequence):
+                    self._nested_element(path, index)
+                    yield self._list_steps(_path_join(path, index), old, new)
+
+                else:
+                    self._item_removed(path, index, old)
+                    self._item_added(path, index, new)
+                index += 1
+
+            for old in removed[paired:]:
+                self._element_removed(path, index, old)
+
+            for new in added[paired:]:
+                self._element_added(path, index, new)
+                index += 1
+
+            # step over the matched element
+            index += 1
+            src_start, dst_start = src_end + 1, dst_end + 1
+
+
+# The depth of nesting down to which DiffBuilder compares containers by
+# recursion, leaving room on the stack of the caller
+_RECURSION_DEPTH = 100
+
+# The number of pending operations of a DiffBuilder above which their array
+# indices are tracked in chains, rather than found by scanning the following
+# operations at each index fixup
+_CHAIN_MIN_OPS = 32
+
+# The scalar types that json.dumps() serializes in a way that is unique to
+# the type: values of two different types among them are never equal as JSON.
+_JSON_SCALARS = frozenset((str, int, float, bool, type(None)))
+
+# Marks the keys of scalars that cannot be hashed; those are only ever
+# equal to themselves.
+_UNHASHABLE = object()
+
+
+def _pool_context():
+    """
+    This function returns the multiprocessing context of the process pools of
+    this module: forked processes where the platform has them, since they
+    share the documents with this one instead of receiving a pickled copy,
+    and the default context elsewhere.
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+# Chunks of keys that _compare_in_processes() makes per process, so that the
+# processes stay busy when the members differ in size.
+_CHUNKS_PER_WORKER = 4
+
+# The _ChangeRecorder of a process of _compare_in_processes()
+_recorder = None
+
+
+class _ChangeRecorder(DiffBuilder):
+    """
+    A `DiffBuilder` that records the changes it finds instead of making
+    operations of them, for them to be replayed in another process.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_ChangeRecorder, self).__init__(*args, **kwargs)
+        self.changes = []
+
+    def _item_added(self, path, key, item):
+        self.changes.append(('_item_added', path, key, item))
+
+    def _item_removed(self, path, key, item):
+        self.changes.append(('_item_removed', path, key, item))
+
+    def _item_replaced(self, path, key, item):
+        self.changes.append(('_item_replaced', path, key, item))
+
+    def _item_moved(self, path, key, from_key):
+        self.changes.append(('_item_moved', path, key, from_key))
+
+    def _element_added(self, path, key, item):
+        self.changes.append(('_element_added', path, key, item))
+
+    def _element_removed(self, path, key, item):
+        self.changes.append(('_element_removed', path, key, item))
+
+    def _nested_element(self, path, key):
+        self.changes.append(('_nested_element', path, key))
+
+
+class _PositionalDiffBuilder(DiffBuilder):
+    """
+    A `DiffBuilder` for the ``'fast'`` optimization level, which makes an
+    operation of every change as it is found. As removed and added values
+    are never paired into moves, the operations never need their array
+    indices fixed up, and neither the values nor the indices are tracked.
+    """
+
+    def _track(self, index):
+        pass
+
+    def _item_added(self, path, key, item):
+        self._element_added(path, key, item)
+
+    def _item_removed(self, path, key, item):
+        self._element_removed(path, key, item)
+
+
+class _CostEstimator(DiffBuilder):
+    """
+    A `DiffBuilder` that, instead of making operations, adds up the number
+    of operations found in each changed container and the approximate size
+    of their JSON encoding, to compare it with that of a `replace` of the
+    whole container. It makes the same comparisons as the builder it
+    estimates for, and shares its fingerprints, but does not match values
+    into moves. Where that builder would, it aligns arrays whose length
+    changed instead, which finds about as few changes for the elements that
+    were only shifted.
+    """
+
+    def __init__(self, builder, replace_subtrees):
+        super(_CostEstimator, self).__init__(
+            builder.src_doc, builder.dst_doc, builder.dumps,
+            pointer_cls=builder.pointer_cls, align_lists=builder.align_lists,
+            list_key=builder.list_key)
+        self.rules = builder.rules
+        self._rule_states = builder._rule_states
+        self._moves = not isinstance(builder, _PositionalDiffBuilder)
+        self._fingerprints = builder._fingerprints
+        self._interned = builder._interned
+        self._equality_keys = builder._equality_keys
+        self.replace_subtrees = replace_subtrees
+        self._sizes = {}
+        # [path, parent, operations, size, replace size, replaced] of each
+        # changed container, parents first
+        self.nodes = []
+        self._node = None
+
+    def _dict_steps(self, path, src, dst):
+        return self._node_steps(
+            path, dst, DiffBuilder._dict_steps(self, path, src, dst))
+
+    def _list_steps(self, path, src, dst):
+        return self._node_steps(
+            path, dst, DiffBuilder._list_steps(self, path, src, dst))
+
+    def _positional_list_steps(self, path, src, dst):
+        if self._moves and len(src) != len(dst) and \
+                not self._on_the_way(path):
+            return self._aligned_list_steps(path, src, dst)
+        return DiffBuilder._positional_list_steps(self, path, src, dst)
+
+    def _node_steps(self, path, dst, steps):
+        """
+        This generator runs the steps comparing two containers, charging the
+        operations they find to a node of their own, and then charges the
+        node to its parent at the cheaper of its own cost and that of
+        replacing the container. With `replace_subtrees`, it stops as soon
+        as replacing the container is known to be cheaper.
+
+        Args:
+            path (str): The `path` input parameter is the location of the
+                containers.
+            dst (): The `dst` input parameter is the updated container.
+            steps (generator): The `steps` input parameter is the steps
+                comparing the containers.
+
+        """
+        parent = self._node
+        if self.rules is not None and \
+                self._rule_state(path) is not _UNRESTRICTED:
+            # replacing it would overwrite the locations the rules skip
+            replace = None
+        else:
+            replace = _OP_SIZE + len(path) + self._encoded_size(dst)
+        node = self._node = [path, parent, 0, 0, replace, False]
+        self.nodes.append(node)
+        replaceable = self.replace_subtrees and replace is not None
+        for nested in steps:
+            yield nested
+            self._node = node
+            # the rest of the containers would only add to the cost
+            if replaceable and node[3] > replace:
+                break
+
+        if replaceable and node[3] > replace:
+            node[5] = True
+        self._node = parent
+        if parent is not None:
+            if node[5]:
+                parent[2] += 1
+                parent[3] += node[4]
+            else:
+                parent[2] += node[2]
+                parent[3] += node[3]
+
+    def _charge(self, path, key, size):
+        node = self._node
+        if node is not None:
+            node[2] += 1
+            node[3] += _OP_SIZE + len(path) + len(str(key)) + 1 + size
+
+    def _item_added(self, path, key, item):
+        self._charge(path, key, self._encoded_size(item))
+
+    def _item_removed(self, path, key, item):
+        self._charge(path, key, 0)
+
+    def _item_replaced(self, path, key, item):
+        self._charge(path, key, self._encoded_size(item))
+
+    def _item_moved(self, path, key, from_key):
+        self._charge(path, key, len(path) + len(str(from_key)) + 1)
+
+    _element_added = _item_added
+    _element_removed = _item_removed
+
+    def _encoded_size(self, value):
+        """
+        This function returns the approximate size of the JSON encoding of a
+        value, computed bottom-up once per container.
+
+        Args:
+            value (): The `value` input parameter is the value to measure.
+
+        Returns:
+            int: The size of `value`.
+
+        """
+        if not isinstance(value, (MutableMapping, MutableSequence)):
+            return _scalar_size(value)
+
+        sizes = self._sizes
+        stack = [(value, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if id(node) in sizes:
+                continue
+
+            is_mapping = isinstance(node, MutableMapping)
+            children = list(node.values()) if is_mapping else node
+            if not children_done:
+                stack.append((node, True))
+                stack.extend(
+                    (child, False) for child in children
+                    if isinstance(child, (MutableMapping, MutableSequence)))
+                continue
+
+            size = 2 * len(node)
+            for child in children:
+                if isinstance(child, (MutableMapping, MutableSequence)):
+                    size += sizes[id(child)][1]
+                else:
+                    size += _scalar_size(child)
+            if is_mapping:
+                size += sum(_scalar_size(key) + 2 for key in node)
+            # the container is kept so that its id is not reused
+            sizes[id(node)] = (node, size)
+        return sizes[id(value)][1]
+
+    def replaced(self, max_ops):
+        """
+        This function returns the paths of the containers to replace whole:
+        those cheaper to replace, and then, while the operations exceed
+        `max_ops`, those saving the most operations for the size they add.
+
+        Args:
+            max_ops (int): The `max_ops` input parameter is the number of
+                operations not to exceed, or None.
+
+        Returns:
+            set: The paths of the containers.
+
+        """
+        nodes = self.nodes
+        if max_ops is not None and nodes:
+            root = nodes[0]
+            total = 1 if root[5] else root[2]
+
+            def benefit(node):
+                return float(node[2] - 1) / max(node[4] - node[3], 1)
+
+            candidates = [node for node in nodes
+                          if not node[5] and node[2] > 1 and
+                          node[4] is not None]
+            candidates.sort(key=benefit, reverse=True)
+            for node in candidates:
+                if total <= max_ops:
+                    break
+
+                parent = node[1]
+                while parent is not None and not parent[5]:
+                    parent = parent[1]
+                if parent is not None:
+                    continue
+
+                saved, added = node[2] - 1, node[4] - node[3]
+                node[5] = True
+                total -= saved
+                parent = node[1]
+                while parent is not None:
+                    parent[2] -= saved
+                    parent[3] += added
+                    parent = parent[1]
+
+        return set(node[0] for node in nodes if node[5])
+
+
+def _scalar_size(value):
+    """
+    This function returns the approximate size of the JSON encoding of a
+    scalar, not counting escapes.
+
+    Args:
+        value (): The `value` input parameter is the scalar to measure.
+
+    Returns:
+        int: The size of `value`.
+
+    """
+    if isinstance(value, basestring):
+        return len(value) + 2
+    if value is None or value is True:
+        return 4
+    if value is False:
+        return 5
+    return len(repr(value))
+
+
+# The approximate size of the JSON encoding of an operation, besides its
+# paths and value
+_OP_SIZE = 30
+
+
+# The `optimization` levels of `JsonPatch.from_diff()`, with their aliases
+_OPTIMIZATION_LEVELS = {
+    'fast': 'fast',
+    # Before the levels, the flag was ignored: False still gives the same
+    # patches as True
+    'balanced': 'balanced', True: 'balanced', False: 'balanced',
+    'minimal': 'minimal',
+}
+
+
+def _diff_builder(src, dst, dumps, pointer_cls, align_lists, optimization,
+                  list_key=None, replace_subtrees=False, max_ops=None,
+                  include=None, exclude=None):
+    """
+    This function makes the `DiffBuilder` comparing `src` with `dst` at the
+    given `optimization` level.
+
+    Args:
+        src (dict): The `src` input parameter is the original document.
+        dst (dict): The `dst` input parameter is the updated document.
+        dumps (function): The `dumps` input parameter is the JSON serializer.
+        pointer_cls (type): The `pointer_cls` input parameter is the JSON
+            pointer class to use.
+        align_lists (bool): The `align_lists` input parameter makes arrays be
+            aligned at any level.
+        optimization (str): The `optimization` input parameter is one of the
+            levels of `JsonPatch.from_diff()`.
+        list_key (str): The `list_key` input parameter identifies the records
+            of arrays; see `JsonPatch.from_diff()`.
+        replace_subtrees (bool): The `replace_subtrees` input parameter
+            replaces containers whole where that is smaller; see
+            `JsonPatch.from_diff()`.
+        max_ops (int): The `max_ops` input parameter bounds the number of
+            operations; see `JsonPatch.from_diff()`.
+        include (list): The `include` input parameter is the patterns of the
+            locations to compare; see `JsonPatch.from_diff()`.
+        exclude (list): The `exclude` input parameter is the patterns of the
+            locations not to compare.
+
+    Returns:
+        DiffBuilder: The builder, whose comparison has not started yet.
+
+    """
+    try:
+        level = _OPTIMIZATION_LEVELS[optimization]
+    except (KeyError, TypeError):
+        raise ValueError(
+            "Unknown optimization level {0!r}".format(optimization))
+    if max_ops is not None and max_ops < 1:
+        raise ValueError("max_ops must be at least 1")
+
+    options = dict(pointer_cls=pointer_cls, align_lists=align_lists,
+                   list_key=list_key, include=include, exclude=exclude)
+    if level == 'fast':
+        builder = _PositionalDiffBuilder(src, dst, dumps, **options)
+    elif level == 'minimal':
+        options['align_lists'] = True
+        if list_key is None:
+            options['list_key'] = 'id'
+        builder = DiffBuilder(src, dst, dumps, **options)
+        replace_subtrees = True
+    else:
+        builder = DiffBuilder(src, dst, dumps, **options)
+
+    if replace_subtrees or max_ops is not None:
+        builder._plan_replacements(replace_subtrees, max_ops)
+    return builder
+
+
+def _start_recorder(src, dst, dumps, pointer_cls, align_lists, list_key,
+                    include, exclude, replaced):
+    """Sets up the `_ChangeRecorder` of a worker process."""
+    global _recorder
+    _recorder = _ChangeRecorder(src, dst, dumps, pointer_cls=pointer_cls,
+                                align_lists=align_lists, list_key=list_key,
+                                include=include, exclude=exclude)
+    _recorder._replaced = replaced
+
+
+def _record_changes(keys):
+    """
+    This function compares the values of some keys of the documents of a
+    worker process.
+
+    Args:
+        keys (list): The `keys` input parameter is the keys to compare.
+
+    Returns:
+        list: The changes found, as `(method name, path, key, item)`.
+
+    """
+    recorder = _recorder
+    src, dst = recorder.src_doc, recorder.dst_doc
+    recorder.changes = []
+    for key in keys:
+        recorder._compare_values('', key, src[key], dst[key])
+    return recorder.changes
+
+
+def _try_equal(src, dst):
+    """
+    This function compares two values with `==`, which cannot compare dicts
+    and lists nested deeper than the interpreter's recursion limit.
+
+    Args:
+        src (): The `src` input parameter is the first value.
+        dst (): The `dst` input parameter is the second value.
+
+    Returns:
+        bool: True if the values are equal, False if they are not, or None
+        if they are nested too deeply to tell.
+
+    """
+    try:
+        return src == dst
+    except RecursionError:
+        return None
+
+
+def _equal(src, dst):
+    """
+    This function compares two values with `==`. Nested dicts and lists deeper
+    than the interpreter's recursion limit, which `==` cannot compare, are
+    walked with an explicit stack instead.
+
+    Args:
+        src (): The `src` input parameter is the first value.
+        dst (): The `dst` input parameter is the second value.
+
+    Returns:
+        bool: True if the values are equal.
+
+    """
+    equal = _try_equal(src, dst)
+    if equal is not None:
+        return equal
+
+    stack = [(src, dst)]
+    while stack:
+        src, dst = stack.pop()
+        if src is dst:
+            continue
+
+        cls = type(src)
+        if cls is not type(dst) or cls not in (dict, list):
+            if src != dst:
+                return False
+        elif len(src) != len(dst):
+            return False
+        elif cls is list:
+            stack.extend(zip(src, dst))
+        else:
+            for key, value in src.items():
+                if key not in dst:
+                    return False
+                stack.append((value, dst[key]))
+
+    return True
+
+
+def _scalar_key(value):
+    """
+    This function returns the structural key of a scalar JSON value. Floats
+    are keyed by their repr, as that is what they serialize to, so that
+    `0.0` and `-0.0` differ while NaNs are equal.
+
+    Args:
+        value (): The `value` input parameter is the scalar to key.
+
+    Returns:
+        tuple: The hashable key of `value`.
+
+    """
+    cls = type(value)
+    if cls is float:
+        return (cls, repr(value))
+    try:
+        hash(value)
+    except TypeError:
+        return (_UNHASHABLE, id(value))
+    return (cls, value)
+
+
+# Edit distance past which _myers_matches() gives up aligning; both time and
+# memory of the search grow quadratically with it.
+_MYERS_MAX_COST = 1024
+
+
+def _myers_matches(src, dst):
+    """
+    This function aligns two sequences with Myers' O(ND) difference
+    algorithm, after stripping their common prefix and suffix.
+
+    Args:
+        src (list): The `src` input parameter is the original sequence.
+        dst (list): The `dst` input parameter is the sequence to align it to.
+
+    Returns:
+        list: The `(src_index, dst_index)` pairs of a longest common
+        subsequence, in increasing order. Only the common prefix and suffix
+        are matched when the edit distance exceeds `_MYERS_MAX_COST`.
+
+    """
+    len_src, len_dst = len(src), len(dst)
+    prefix = 0
+    while prefix < len_src and prefix < len_dst and \
+            src[prefix] == dst[prefix]:
+        prefix += 1
+
+    suffix = 0
+    while suffix < len_src - prefix and suffix < len_dst - prefix and \
+            src[len_src - suffix - 1] == dst[len_dst - suffix - 1]:
+        suffix += 1
+
+    a = src[prefix:len_src - suffix]
+    b = dst[prefix:len_dst - suffix]
+    n, m = len(a), len(b)
+
+    middle = []
+    if n and m:
+        v = {1: 0}
+        trace = []
+        for d in range(min(n + m, _MYERS_MAX_COST) + 1):
+            trace.append(v.copy())
+            for k in range(-d, d + 1, 2):
+                if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                    x = v[k + 1]
+                else:
+                    x = v[k - 1] + 1
+                y = x - k
+                while x < n and y < m and a[x] == b[y]:
+                    x += 1
+                    y += 1
+                v[k] = x
+                if x >= n and y >= m:
+                    break
+            else:
+                continue
+            break
+        else:
+            trace = None
+
+        if trace is not None:
+            # walk the trace back from the end to recover the matches
+            x, y = n, m
+            for d in range(len(trace) - 1, -1, -1):
+                v = trace[d]
+                k = x - y
+                if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                    prev_k = k + 1
+                else:
+                    prev_k = k - 1
+                prev_x = v[prev_k]
+                prev_y = prev_x - prev_k
+                while x > prev_x and y > prev_y:
+                    x -= 1
+                    y -= 1
+                    middle.append((prefix + x, prefix + y))
+                x, y = prev_x, prev_y
+            middle.reverse()
+
+    matches = [(i, i) for i in range(prefix)]
+    matches.extend(middle)
+    matches.extend(
+        (len_src - i, len_dst - i) for i in range(suffix, 0, -1))
+    return matches
+
+
+def _increasing_run(values):
+    """
+    This function finds a longest strictly increasing subsequence of
+    `values`, in O(n log n).
+
+    Args:
+        values (list): The `values` input parameter is the sequence.
+
+    Returns:
+        set: The positions in `values` of the subsequence.
+
+    """
+    tails = []
+    tail_positions = []
+    previous = [None] * len(values)
+    for i, value in enumerate(values):
+        j = bisect.bisect_left(tails, value)
+        if j == len(tails):
+            tails.append(value)
+            tail_positions.append(i)
+        else:
+            tails[j] = value
+            tail_positions[j] = i
+        previous[i] = tail_positions[j - 1] if j else None
+
+    run = set()
+    i = tail_positions[-1] if tail_positions else None
+    while i is not None:
+        run.add(i)
+        i = previous[i]
+    return run
+
+
+# The states of _PathRules for locations that no rule restricts further, and
+# for locations that are skipped
+_UNRESTRICTED = object()
+_SKIPPED = object()
+
+# Matches any number of reference tokens in the patterns of _PathRules
+_ANY_TOKENS = object()
+
+
+class _PathRules(object):
+    """
+    The include and exclude rules of a diff. The patterns are matched
+    against locations one reference token at a time, as the comparison
+    descends into the documents: the state of a location is `_SKIPPED` when
+    an exclude pattern matches it or it is not within or on the way to an
+    included location, `_UNRESTRICTED` when no pattern can match within it
+    any more, and otherwise the patterns partially matched so far.
+    """
+
+    def __init__(self, include, exclude, pointer_cls=JsonPointer):
+        self.patterns = []
+        for name, patterns in (('include', include), ('exclude', exclude)):
+            if patterns is not None and \
+                    not isinstance(patterns, (list, tuple, set, frozenset)):
+                raise TypeError("{0} must be a list of patterns, got {1}"
+                                .format(name, type(patterns).__name__))
+
+        for is_include, patterns in ((True, include), (False, exclude)):
+            for pattern in patterns or ():
+                tokens = []
+                for part in pointer_cls(pattern).parts:
+                    if part == '**':
+                        tokens.append(_ANY_TOKENS)
+                    elif any(char in part for char in '*?['):
+                        tokens.append(re.compile(fnmatch.translate(part)))
+                    else:
+                        tokens.append(part)
+                self.patterns.append((is_include, tokens))
+
+        self.root = self._state(
+            not include, [(i, 0) for i in range(len(self.patterns))])
+
+    def child(self, state, token):
+        """
+        This function returns the state of a member of a location.
+
+        Args:
+            state (object): The `state` input parameter is the state of the
+                location.
+            token (str): The `token` input parameter is the key of the
+                member.
+
+        Returns:
+            object: The state of the member.
+
+        """
+        if state is _UNRESTRICTED or state is _SKIPPED:
+            return state
+
+        included, partial = state
+        advanced = []
+        for i, position in partial:
+            expected = self.patterns[i][1][position]
+            if expected is _ANY_TOKENS:
+                advanced.append((i, position))
+            elif expected == token if isinstance(expected, basestring) \
+                    else expected.match(token):
+                advanced.append((i, position + 1))
+        return self._state(included, advanced)
+
+    def _state(self, included, partial):
+        """
+        This function makes the state of a location from the positions
+        reached in the patterns.
+
+        Args:
+            included (bool): The `included` input parameter tells whether the
+                location is within an included one.
+            partial (list): The `partial` input parameter is the patterns
+                matched so far, as (index, position) pairs.
+
+        Returns:
+            object: The state of the location.
+
+        """
+        remaining = set()
+        while partial:
+            i, position = partial.pop()
+            is_include, tokens = self.patterns[i]
+            if position == len(tokens):
+                if not is_include:
+                    return _SKIPPED
+                included = True
+            elif tokens[position] is _ANY_TOKENS:
+                # `**` may also match no token at all
+                remaining.add((i, position))
+                partial.append((i, position + 1))
+            else:
+                remaining.add((i, position))
+
+        if included:
+            # only the exclude patterns matter within an included location
+            remaining = set(entry for entry in remaining
+                            if not self.patterns[entry[0]][0])
+            if not remaining:
+                return _UNRESTRICTED
+        elif not any(self.patterns[i][0] for i, _ in remaining):
+            return _SKIPPED
+        return included, frozenset(remaining)
+
+
+class _OpChain(object):
+    """
+    The nodes of a `DiffBuilder` operation list that refer to one container,
+    in list order, along with the array indices their operations remove from
+    and add at. Index fixups shift these plain integers, and only the shifted
+    ones are written back to the operations, on demand.
+
+    Nodes removed from the operation list are emptied by
+    `DiffBuilder.remove()`; they are skipped, and dropped once they make up
+    most of the chain.
+    """
+
+    __slots__ = ('entries', 'positions')
+
+    def __init__(self):
+        self.entries = []
+        self.positions = {}
+
+    def track(self, node, removed, added):
+        """
+        Records the indices of a node, appending it if it is new. Returns the
+        new entry, or None if the node already had one.
+        """
+        position = self.positions.get(id(node))
+        if position is None:
+            entry = [node, removed, added, False]
+            self.positions[id(node)] = len(self.entries)
+            self.entries.append(entry)
+            return entry
+
+        entry = self.entries[position]
+        if removed is not None:
+            entry[1] = removed
+        if added is not None:
+            entry[2] = added
+        return None
+
+    def shifted(self):
+        """Returns the live nodes whose indices were shifted."""
+        return [entry[0] for entry in self.entries if entry[3] and entry[0]]
+
+    def undo_remove(self, node, key):
+        """
+        Shifts the indices that follow `node` as if the removal at `key`,
+        which `node` did, had not happened, and returns `key` shifted by the
+        following operations in turn.
+        """
+        for entry in self._following(node):
+            removed, added = entry[1], entry[2]
+            if removed is not None:
+                if removed >= key:
+                    entry[1] = removed + 1
+                    entry[3] = True
+                else:
+                    key -= 1
+            if added is not None:
+                if added > key:
+                    entry[2] = added + 1
+                    entry[3] = True
+                else:
+                    key += 1
+        return key
+
+    def undo_add(self, node, key):
+        """
+        Shifts the indices that follow `node` as if the addition at `key`,
+        which `node` did, had not happened, and returns `key` shifted by the
+        following operations in turn.
+        """
+        for entry in self._following(node):
+            removed, added = entry[1], entry[2]
+            if removed is not None:
+                if removed > key:
+                    entry[1] = removed - 1
+                    entry[3] = True
+                else:
+                    key -= 1
+            if added is not None:
+                if added > key:
+                    entry[2] = added - 1
+                    entry[3] = True
+                else:
+                    key += 1
+        return key
+
+    def _following(self, node):
+        """Returns the entries of the live nodes that follow `node`."""
+        entries = self.entries
+        following = entries[self.positions[id(node)] + 1:]
+        live = [entry for entry in following if entry[0]]
+        if 2 * (len(following) - len(live)) > len(entries):
+            entries[:] = [entry for entry in entries if entry[0]]
+            self.positions = dict(
+                (id(entry[0]), i) for i, entry in enumerate(entries))
+        return live
+
+
+def _int_key(part):
+    """Returns `part` as the integer `PatchOperation.key` reads, or None."""
+    if part[:1].isalpha():
+        # int() would fail, and exceptions are slow
+        return None
+    try:
+        return int(part)
+    except ValueError:
+        return None
+
+
+def _index_slots(op):
+    """
+    This function returns the array indices that an operation of a
+    `DiffBuilder` removes from and adds at.
+
+    Args:
+        op (PatchOperation): The `op` input parameter is the operation.
+
+    Returns:
+        tuple: The ``(location of the array, removed index, added index)``
+        of each array the operation removes from or adds at.
+
+    """
+    cls = type(op)
+    if cls is ReplaceOperation:
+        return ()
+
+    path, _, part = op.location.rpartition('/')
+    key = _int_key(part)
+    if cls is MoveOperation:
+        from_path, _, from_part = op.operation['from'].rpartition('/')
+        from_key = _int_key(from_part)
+        if from_key is None:
+            return () if key is None else ((path, None, key),)
+        if key is None:
+            return ((from_path, from_key, None),)
+        return ((from_path, from_key, None), (path, None, key))
+
+    if key is None:
+        return ()
+    if cls is RemoveOperation:
+        return ((path, key, None),)
+    if cls is AddOperation:
+        return ((path, None, key),)
+    return ()
+
+
+def _write_back(entry):
+    """
+    This function writes the indices of an `_OpChain` entry that index
+    fixups shifted back to its operation.
+
+    Args:
+        entry (list): The `entry` input parameter is the entry.
+
+    """
+    entry[3] = False
+    op = entry[0][2]
+    if entry[1] is not None:
+        if isinstance(op, MoveOperation):
+            op.from_key = entry[1]
+        else:
+            op.key = entry[1]
+    if entry[2] is not None:
+        op.key = entry[2]
+
+
+def _path_join(path, key):
+    """
+    This function joins two strings `path` and `key`, where `key` is a nullable object.
+
+    Args:
+        path (str): The `path` input parameter joins with the key using a separator
+            and returns the joined string.
+        key (str): The `key` input parameter specifies a sub-key within the path.
+
+    Returns:
+        str: The function takes two arguments `path` and `key`, and returns a new
+        string representing the concatenation of `path` and `key`.
+        
+        The output returned by the function will be the concatenation of `path`
+        and `key`, with any occurrences of '~' replaced with '~0'.
+
+    """
+    if key is None:
+        return path
+
+    return path + '/' + str(key).replace('~', '~0').replace('/', '~1')
+
+
+
+
+
+
+# Array indices as accepted by JsonPointer.get_part(): no signs, no leading
+# zeros. Anything else is left to the pointer class to accept or reject.
+_RE_ARRAY_INDEX = re.compile(r'(0|[1-9][0-9]*)\Z')
+
+
+class _CompiledPointer(object):
+    """A JSON pointer whose parts have been pre-split into typed steps.
+
+    Resolution takes a fast path through plain ``dict`` and ``list``
+    containers. Anything else, including every error case, is handed back to
+    the wrapped pointer so results and exceptions are exactly those of
+    :meth:`JsonPointer.to_last`.
+    """
+
+    __slots__ = ('pointer', 'steps', 'last')
+
+    def __init__(self, pointer):
+        self.pointer = pointer
+        steps = [(part, _array_index(part)) for part in pointer.parts]
+        self.last = steps.pop() if steps else None
+        self.steps = tuple(steps)
+
+    @classmethod
+    def for_pointer(cls, pointer):
+        """
+        This function compiles `pointer`, unless its class customizes how
+        pointers are resolved; such pointers get a route that always takes
+        the generic path.
+
+        Args:
+            pointer (JsonPointer): The pointer to compile.
+
+        Returns:
+            _CompiledPointer: The compiled route for the pointer.
+
+        """
+        route = cls(pointer)
+        if not _resolves_plainly(type(pointer)):
+            route.steps = None
+        return route
+
+    def to_last(self, doc):
+        """Resolves the pointer until the last step, like `JsonPointer.to_last`."""
+        steps = self.steps
+        if steps is None or self.last is None:
+            return self.pointer.to_last(doc)
+
+        subobj = doc
+        try:
+            for key, index in steps:
+                cls = type(subobj)
+                if cls is dict:
+                    subobj = subobj[key]
+                elif cls is list and index is not None:
+                    subobj = subobj[index]
+                else:
+                    return self.pointer.to_last(doc)
+        except (KeyError, IndexError):
+            return self.pointer.to_last(doc)
+
+        key, index = self.last
+        cls = type(subobj)
+        if cls is dict:
+            return subobj, key
+        if cls is list:
+            if key == '-':
+                return subobj, key
+            if index is not None:
+                return subobj, index
+        return self.pointer.to_last(doc)
+
+
+def _specialize(plan, sample):
+    """
+    This function returns the function applying the operations of `plan`,
+    generated for the shape of the operations: their kinds and paths, and
+    the kinds of the containers along those paths in `sample`. Functions are
+    kept for the `_SPECIALIZED_SIZE` most recently used shapes.
+
+    Args:
+        plan (list): The `plan` input parameter is the plan of the compiled
+            patch.
+        sample (dict): The `sample` input parameter is a document of the shape
+            the patch will be applied to, or None.
+
+    Returns:
+        function: A function of the document, the values of the operations of
+        the plan and the plan, which applies the plan to the document in
+        place and returns it.
+
+    The generated functions give the same results and raise the same errors
+    as the generic apply, including on documents of another shape than the
+    sample:
+
+    >>> patch = JsonPatch([
+    ...     {'op': 'test', 'path': '/a/0', 'value': 1},
+    ...     {'op': 'add', 'path': '/a/-', 'value': 3},
+    ...     {'op': 'add', 'path': '/a/0', 'value': 0},
+    ...     {'op': 'replace', 'path': '/b/c', 'value': 4},
+    ...     {'op': 'remove', 'path': '/b/d/1'},
+    ... ])
+    >>> sample = {'a': [1], 'b': {'c': 1, 'd': [1, 2]}}
+    >>> specialized = patch.compile(specialize=True, sample=sample)
+    >>> def outcome(patch, doc):
+    ...     try:
+    ...         return patch.apply(doc)
+    ...     except Exception as ex:
+    ...         return type(ex), str(ex)
+    >>> docs = [
+    ...     {'a': [1], 'b': {'c': 1, 'd': [1, 2]}},
+    ...     {'a': [1, 2], 'b': {'c': None, 'd': {'1': 5}}},
+    ...     {'a': {'0': 1}, 'b': {'c': 1, 'd': [1, 2]}},
+    ...     {'a': [2], 'b': {'c': 1, 'd': [1, 2]}},
+    ...     {'a': [1], 'b': {'d': [1, 2]}},
+    ...     {'a': [1], 'b': {'c': 1, 'd': [1]}},
+    ...     {'a': [1], 'b': [1]},
+    ... ]
+    >>> [outcome(specialized, doc) == outcome(patch, doc) for doc in docs]
+    [True, True, True, True, True, True, True]
+
+    The function of the least recently used shape is dropped once there are
+    more than `_SPECIALIZED_SIZE`:
+
+    >>> _SPECIALIZED.clear()
+    >>> patches = [JsonPatch([{'op': 'add', 'path': '/k%d' % i, 'value': i}])
+    ...            for i in range(_SPECIALIZED_SIZE + 1)]
+    >>> plans = [patch._plan for patch in patches]
+    >>> functions = [_specialize(plan, None) for plan in plans[:-1]]
+    >>> _specialize(plans[0], None) is functions[0]
+    True
+    >>> _ = _specialize(plans[-1], None)
+    >>> len(_SPECIALIZED) == _SPECIALIZED_SIZE
+    True
+    >>> _specialize(plans[0], None) is functions[0]
+    True
+    >>> _specialize(plans[1], None) is functions[1]
+    False
+
+    """
+    shapes = tuple(_operation_shape(item, sample) for item in plan)
+    with _SPECIALIZED_LOCK:
+        function = _SPECIALIZED.pop(shapes, None)
+        if function is None:
+            function = _generate_function(shapes)
+        _SPECIALIZED[shapes] = function
+        if len(_SPECIALIZED) > _SPECIALIZED_SIZE:
+            _SPECIALIZED.popitem(last=False)
+    return function
+
+
+# Shapes of the operations of a patch -> function generated for them, the
+# most recently used last
+_SPECIALIZED = collections.OrderedDict()
+_SPECIALIZED_LOCK = threading.Lock()
+_SPECIALIZED_SIZE = 256
+
+# The operations with code of their own in the generated functions
+_SPECIALIZED_OPERATIONS = frozenset([
+    AddOperation, RemoveOperation, ReplaceOperation, TestOperation])
+
+
+def _operation_shape(item, sample):
+    """
+    This function describes what the function generated for a patch does
+    for the plan item `item`.
+
+    Returns:
+        tuple: The class of the operation, the parts of its pointer and for
+        each of them the kind of container, ``'dict'``, ``'list'`` or None if
+        unknown, that `sample` has there; or None if the item is applied the
+        generic way.
+
+    """
+    cls = type(item)
+    if cls not in _SPECIALIZED_OPERATIONS or \
+            not _resolves_plainly(type(item.pointer)):
+        return None
+    parts = tuple(item.pointer.parts)
+    if not parts or (cls is not RemoveOperation and
+                     'value' not in item.operation):
+        return None
+
+    kinds = []
+    container = sample
+    for part in parts:
+        kind = None
+        if type(container) is dict:
+            kind = 'dict'
+            container = container.get(part)
+        elif type(container) is list:
+            kind = 'list'
+            index = _array_index(part)
+            if index is not None and index < len(container):
+                container = container[index]
+            else:
+                container = None
+        kinds.append(kind)
+    return cls, parts, tuple(kinds)
+
+
+def _generate_function(shapes):
+    """
+    This function generates the source of the function applying a plan
+    whose items have the `shapes`, and compiles it.
+
+    Each operation first walks to its parent container with subscripts, as
+    an expression that only succeeds where `JsonPointer.walk()` would
+    reach the same container. Then the kind of the container and the bounds
+    are checked inline before modifying it; the plan item is applied the
+    generic way instead whenever anything does not match, which also raises
+    the errors.
+
+    """
+    lines = ['def specialized(doc, values, plan):']
+    for position, shape in enumerate(shapes):
+        fallback = 'doc = plan[{0}].apply(doc)'.format(position)
+        if shape is None:
+            lines.append('    ' + fallback)
+            continue
+
+        cls, parts, kinds = shape
+        lines.append('    p = doc')
+        if len(parts) > 1:
+            lines.append('    try:')
+            for part, kind in zip(parts[:-1], kinds):
+                index = _array_index(part)
+                if index is None or kind == 'dict':
+                    step = 'p[{0!r}]'.format(part)
+                elif kind == 'list':
+                    step = 'p[{0}]'.format(index)
+                else:
+                    step = 'p[{0}] if type(p) is list else p[{1!r}]'.format(
+                        index, part)
+                lines.append('        p = ' + step)
+            lines.append('    except _WALK_ERRORS:')
+            lines.append('        p = None')
+
+        value = 'values[{0}]'.format(position)
+        branches = _mutation_branches(cls, parts[-1], kinds[-1], value)
+        keyword = 'if'
+        for condition, statement in branches:
+            lines.append('    {0} {1}:'.format(keyword, condition))
+            lines.append('        ' + statement)
+            keyword = 'elif'
+        if branches:
+            lines.append('    else:')
+            lines.append('        ' + fallback)
+        else:
+            lines.append('    ' + fallback)
+    lines.append('    return doc')
+
+    namespace = {'_WALK_ERRORS': (KeyError, IndexError, TypeError)}
+    code = compile('\n'.join(lines) + '\n', '<specialized patch>', 'exec')
+    exec(code, namespace)
+    return namespace['specialized']
+
+
+def _mutation_branches(cls, part, kind, value):
+    """
+    This function returns the ``(condition, statement)`` pairs that apply
+    an operation of class `cls` to the member `part` of the container ``p``,
+    whose kind in the sample is `kind`, with the value expression `value`.
+
+    """
+    index = _array_index(part)
+    key = repr(part)
+    branches = []
+    if kind != 'dict':
+        if cls is AddOperation and part == '-':
+            branches.append(('type(p) is list', 'p.append({0})'.format(value)))
+        elif index is not None:
+            if cls is AddOperation:
+                condition = 'type(p) is list and {0} <= len(p)'
+                statement = 'p.insert({0}, {1})'
+            elif cls is ReplaceOperation:
+                condition = 'type(p) is list and {0} < len(p)'
+                statement = 'p[{0}] = {1}'
+            elif cls is RemoveOperation:
+                condition = 'type(p) is list and {0} < len(p)'
+                statement = 'del p[{0}]'
+            else:
+                condition = ('type(p) is list and {0} < len(p) and '
+                             'p[{0}] == {1}')
+                statement = 'pass'
+            branches.append((condition.format(index, value),
+                             statement.format(index, value)))
+
+    if kind != 'list' and not (cls is ReplaceOperation and part == '-'):
+        if cls is AddOperation:
+            condition = 'type(p) is dict'
+            statement = 'p[{0}] = {1}'
+        elif cls is ReplaceOperation:
+            condition = 'type(p) is dict and {0} in p'
+            statement = 'p[{0}] = {1}'
+        elif cls is RemoveOperation:
+            condition = 'type(p) is dict and {0} in p'
+            statement = 'del p[{0}]'
+        else:
+            condition = 'type(p) is dict and {0} in p and p[{0}] == {1}'
+            statement = 'pass'
+        branches.append((condition.format(key, value),
+                         statement.format(key, value)))
+    return branches
+
+
+def _copy_path(doc, pointer, copies, removed=None):
+    """
+    This function shallow-copies the containers of `doc` from the root down
+    to the parent of the location referenced by `pointer`, linking every copy
+    into its (copied) parent.
+
+    Args:
+        doc (dict): The `doc` input parameter is the document to copy from.
+        pointer (JsonPointer): The `pointer` input parameter references the
+            location whose parent is about to be modified.
+        copies (dict): The `copies` input parameter maps the ids of the
+            containers copied so far to the copies; they are never copied
+            twice. Keeping the copies in it also keeps their ids unique.
+        removed (tuple): The `removed` input parameter is an optional
+            `(container, index)` pair of an array element that will be removed
+            before `pointer` is resolved; indices past it are shifted
+            accordingly.
+
+    Returns:
+        dict: The (possibly copied) root of the document.
+
+    """
+    doc = _copy_container(doc, copies)
+    subobj = doc
+    for part in pointer.parts[:-1]:
+        try:
+            part = pointer.get_part(subobj, part)
+            if removed is not None and subobj is removed[0] and \
+                    isinstance(part, int) and part >= removed[1]:
+                part += 1
+            child = subobj[part]
+        except (JsonPointerException, KeyError, IndexError, TypeError):
+            # Nothing to copy below here; the operation reports the error
+            break
+
+        copied = _copy_container(child, copies)
+        if copied is not child:
+            subobj[part] = copied
+        subobj = copied
+
+    return doc
+
+
+def _copy_container(value, copies):
+    """
+    This function returns a shallow, mutable copy of the container `value`,
+    unless it already is one of the `copies`. Persistent nodes are thawed into
+    a plain dict or list holding the same (persistent) children.
+
+    """
+    if id(value) in copies:
+        return value
+
+    cls = type(value)
+    if cls is dict or cls is list:
+        value = cls(value)
+    elif cls is PersistentMapping:
+        value = dict(value._data)
+    elif cls is PersistentSequence:
+        value = list(value._items)
+    elif isinstance(value, (MutableMapping, MutableSequence)):
+        value = copy.copy(value)
+    else:
+        return value
+
+    copies[id(value)] = value
+    return value
+
+
+def _resolves_plainly(ptr_cls):
+    """
+    This function tells whether the pointer class `ptr_cls` resolves pointers
+    like `JsonPointer` does, so that they can be resolved without it.
+
+    """
+    plain = _PLAIN_POINTER_CLASSES.get(ptr_cls)
+    if plain is None:
+        plain = all(_unwrap(getattr(ptr_cls, name)) is
+                    _unwrap(getattr(JsonPointer, name))
+                    for name in ('to_last', 'walk', 'get_part'))
+        _PLAIN_POINTER_CLASSES[ptr_cls] = plain
+    return plain
+
+
+# Pointer class -> whether _resolves_plainly()
+_PLAIN_POINTER_CLASSES = {}
+
+# The number of operations below which patches are applied one operation
+# at a time, without a _ParentCache or an operation plan: on short patches,
+# building them costs more than walking the shared parents again
+_CACHE_MIN_OPS = 8
+
+
+def _shares_parents(operations):
+    """
+    This function tells whether it is worth applying operations through a
+    `_ParentCache` and an operation plan: whether there are at least
+    `_CACHE_MIN_OPS` of them, two of which change the same container.
+
+    Args:
+        operations (tuple): The `operations` input parameter is the
+            operations of the patch.
+
+    Returns:
+        bool: True if two operations have the same parent location, or if
+        some location has no parent.
+
+    Patches applied through the cache give the same document as applying
+    their operations one at a time:
+
+    >>> patch = JsonPatch(
+    ...     [{'op': 'add', 'path': '/a/b/k%d' % i, 'value': i}
+    ...      for i in range(6)] +
+    ...     [{'op': 'remove', 'path': '/a/b/x'},
+    ...      {'op': 'move', 'from': '/a/b/k0', 'path': '/a/b/l/0'},
+    ...      {'op': 'replace', 'path': '/a/b/l/1', 'value': None}])
+    >>> _shares_parents(patch._ops)
+    True
+    >>> _shares_parents(patch._ops[:4])
+    False
+    >>> doc = {'a': {'b': {'x': 1, 'l': [1, 2]}}}
+    >>> expected = copy.deepcopy(doc)
+    >>> for operation in patch._ops:
+    ...     expected = operation.apply(expected)
+    >>> patch.apply(doc, in_place=True) == expected
+    True
+    >>> doc == expected
+    True
+
+    """
+    if len(operations) < _CACHE_MIN_OPS:
+        return False
+
+    parents = set()
+    for operation in operations:
+        location = operation.location
+        try:
+            parent = location[:location.rindex('/')]
+        except (AttributeError, TypeError, ValueError):
+            return True
+        if parent in parents:
+            return True
+        parents.add(parent)
+    return False
+
+
+def _apply_operation(operation, obj, cache):
+    """
+    This function applies `operation` to `obj` with the parents resolved in
+    `cache`. Operations that only implement `apply()` are applied without it,
+    and as they may have modified any container, the cache is emptied.
+
+    """
+    if _takes_cache(operation):
+        return operation._apply(obj, cache)
+    obj = operation.apply(obj)
+    cache.clear(obj)
+    return obj
+
+
+class _ArrayRun(object):
+    """Consecutive operations that add a block of elements to an array, or
+    remove one from it.
+
+    Each operation of the run inserts next to, or removes next to, the
+    elements of the block handled by the operations before it, so the whole
+    run amounts to a single slice assignment or deletion. When the array is
+    too short for that, or is not a plain ``list``, the operations are
+    applied one by one instead, failing exactly where they would have.
+
+    >>> def one_by_one(patch, doc):
+    ...     doc = copy.deepcopy(doc)
+    ...     try:
+    ...         for operation in patch._ops:
+    ...             doc = operation.apply(doc)
+    ...     except JsonPatchException as ex:
+    ...         return str(ex)
+    ...     return doc
+    >>> def as_run(patch, doc):
+    ...     try:
+    ...         return patch.apply(doc)
+    ...     except JsonPatchException as ex:
+    ...         return str(ex)
+    >>> def add(*indices):
+    ...     return [{'op': 'add', 'path': '/%d' % index, 'value': 'abcd'[n]}
+    ...             for n, index in enumerate(indices)]
+    >>> def remove(*indices):
+    ...     return [{'op': 'remove', 'path': '/%d' % index}
+    ...             for index in indices]
+    >>> patches = [
+    ...     JsonPatch(add(1, 2, 3)), JsonPatch(add(1, 1, 1)),
+    ...     JsonPatch(remove(1, 1, 1)), JsonPatch(remove(3, 2, 1)),
+    ... ]
+    >>> [[type(item).__name__ for item in patch._plan] for patch in patches]
+    [['_ArrayRun'], ['_ArrayRun'], ['_ArrayRun'], ['_ArrayRun']]
+    >>> patches[0].apply([0, 1]), patches[1].apply([0, 1])
+    ([0, 'a', 'b', 'c', 1], [0, 'c', 'b', 'a', 1])
+    >>> docs = [[0, 1, 2, 3, 4], [0, 1], [0], {'1': 1, '2': 2, '3': 3}]
+    >>> all(as_run(patch, doc) == one_by_one(patch, doc)
+    ...     for patch in patches for doc in docs)
+    True
+
+    A run ends at any other operation, which applies between the runs:
+
+    >>> patch = JsonPatch(add(1, 2) + [
+    ...     {'op': 'replace', 'path': '/2', 'value': 7},
+    ... ] + add(3, 4))
+    >>> [type(item).__name__ for item in patch._plan]
+    ['_ArrayRun', 'ReplaceOperation', '_ArrayRun']
+    >>> patch.apply([0, 1, 2])
+    [0, 'a', 7, 'a', 'b', 1, 2]
+    >>> all(as_run(patch, doc) == one_by_one(patch, doc) for doc in docs)
+    True
+    """
+
+    __slots__ = ('operations', 'parent', 'start', 'block')
+
+    def __init__(self, operation, parent, index):
+        """
+        This function starts a run with `operation`.
 
         Args:
-            path (): In this function `path` is a string used to create the path
-                of the RemoveOperation by joining it with the key passed as a argument.
-            key (str): The `key` parameter is the key of the item that was just
-                removed from the document.
-            item (str): The `item` input parameter is the item that was just removed
-                from the dictionary.
+            operation (PatchOperation): The `operation` input parameter is the
+                first `add` or `remove` operation of the run.
+            parent (list): The `parent` input parameter is the pointer parts
+                of the array.
+            index (int): The `index` input parameter is the array index of the
+                operation, or None for the end of the array.
 
         """
-        new_op = RemoveOperation({
-            'op': 'remove',
-            'path': _path_join(path, key),
-        }, pointer_cls=self.pointer_cls)
-        index = self.take_index(item, _ST_ADD)
-        new_index = self.insert(new_op)
-        if index is not None:
-            op = index[2]
-            # We can't rely on the op.key type since PatchOperation casts
-            # the .key property to int and this path wrongly ends up being taken
-            # for numeric string dict keys while the intention is to only handle lists.
-            # So we do an explicit check on the item affected by the op instead.
-            added_item = op.pointer.to_last(self.dst_doc)[0]
-            if type(added_item) == list:
-                for v in self.iter_from(index):
-                    op.key = v._on_undo_add(op.path, op.key)
+        self.operations = [operation]
+        self.parent = parent
+        self.start = index
+        # The `add` operations in the order of the elements they add
+        self.block = collections.deque(self.operations)
 
-            self.remove(index)
-            if new_op.location != op.location:
-                new_op = MoveOperation({
-                    'op': 'move',
-                    'from': new_op.location,
-                    'path': op.location,
-                }, pointer_cls=self.pointer_cls)
-                new_index[2] = new_op
+    def extend(self, operation, parent, index):
+        """
+        This function adds `operation` to the run if it adds or removes the
+        element next to the block of the run.
 
-            else:
-                self.remove(new_index)
+        Returns:
+            bool: Whether the operation was added to the run.
 
+        """
+        first = self.operations[0]
+        if type(operation) is not type(first) or parent != self.parent:
+            return False
+
+        start = self.start
+        if start is None or index is None:
+            # Additions to the end of the array
+            if start is not None or index is not None:
+                return False
+            self.block.append(operation)
+        elif type(first) is RemoveOperation:
+            if index == start - 1:
+                self.start = index
+            elif index != start:
+                return False
+        elif index == start + len(self.block):
+            self.block.append(operation)
+        elif index == start:
+            self.block.appendleft(operation)
         else:
-            self.store_index(item, new_index, _ST_REMOVE)
+            return False
 
-    def _item_replaced(self, path, key, item):
+        self.operations.append(operation)
+        return True
+
+    def apply(self, obj):
+        """Applies the operations of the run to the specified object."""
+        return self._apply(obj, None)
+
+    def _apply(self, obj, cache):
         """
-        This function performs a "replace" operation on a hierarchical data structure
-        using a "ReplaceOperation" object.
+        This function applies the run with one slice operation on the array,
+        or else its operations one by one.
 
         Args:
-            path (str): The `path` input parameter specifies the relative path of
-                the key that is being replaced.
-            key (str): The `key` input parameter is the name of the item being replaced.
-            item (): The `item` parameter is the new value that should be inserted
-                into the list at the specified key.
+            obj (dict): The `obj` input parameter is the document to patch.
+            cache (_ParentCache): The `cache` input parameter is the optional
+                cache of resolved containers.
+
+        Returns:
+            dict: The patched document.
 
         """
-        self.insert(ReplaceOperation({
-            'op': 'replace',
-            'path': _path_join(path, key),
-            'value': item,
-        }, pointer_cls=self.pointer_cls))
+        operations = self.operations
+        start = self.start
+        try:
+            subobj, part = operations[0]._to_last(obj, cache)
+        except JsonPointerException:
+            # The operations report it
+            subobj = None
+
+        if type(subobj) is list:
+            recording = cache is not None and cache.recording
+            if type(operations[0]) is RemoveOperation:
+                end = start + len(operations)
+                if end <= len(subobj):
+                    if recording:
+                        self._record_removals(subobj, cache)
+                    del subobj[start:end]
+                    if cache is not None:
+                        cache.changed(subobj, start, True)
+                    return obj
+            else:
+                try:
+                    values = [op.operation['value'] for op in self.block]
+                except KeyError:
+                    values = None
+                if values is not None and start is None:
+                    if recording:
+                        self._record_additions(subobj, len(subobj), cache)
+                    subobj.extend(values)
+                    return obj
+                if values is not None and start <= len(subobj):
+                    if recording:
+                        self._record_additions(subobj, start, cache)
+                    subobj[start:start] = values
+                    if cache is not None:
+                        cache.changed(subobj, start, True)
+                    return obj
+
+        for operation in operations:
+            obj = operation._apply(obj, cache)
+        return obj
 
-    def _compare_dicts(self, path, src, dst):
+    def _record_removals(self, subobj, journal):
+        """
+        This function tells `journal` about the element that each `remove`
+        operation of the run is about to remove from the array `subobj`.
+
+        """
+        start = self.start
+        block = subobj[start:start + len(self.operations)]
+        for operation in self.operations:
+            index = _array_index(operation.pointer.parts[-1])
+            journal.removed(subobj, index, block.pop(index - start),
+                            operation.pointer)
+
+    def _record_additions(self, subobj, end, journal):
+        """
+        This function tells `journal` about the element that each `add`
+        operation of the run is about to insert into the array `subobj`,
+        `end` being the index of the first of those appended to it.
+
+        """
+        for operation in self.operations:
+            index = _array_index(operation.pointer.parts[-1])
+            if index is None:
+                index = end
+                end += 1
+            journal.added(subobj, index, _MISSING, operation.pointer)
+
+    def _copy_on_write(self, obj, copies):
+        """All operations of the run modify the same array."""
+        return self.operations[0]._copy_on_write(obj, copies)
+
+
+def _plan_operations(operations):
+    """
+    This function groups the consecutive `add` and `remove` operations of a
+    patch that form an `_ArrayRun`.
+
+    Args:
+        operations (tuple): The `operations` input parameter is the operations
+            of the patch.
+
+    Returns:
+        list: The operations, with the runs of more than one operation
+        replaced by the run.
+
+    """
+    plan = []
+    run = None
+    for operation in operations:
+        cls = type(operation)
+        index = False
+        if (cls is AddOperation or cls is RemoveOperation) and \
+                _resolves_plainly(type(operation.pointer)):
+            parts = operation.pointer.parts
+            if parts:
+                last = parts[-1]
+                if last == '-' and cls is AddOperation:
+                    index = None
+                else:
+                    index = _array_index(last)
+                    if index is None:
+                        index = False
+
+        if run is not None and index is not False and \
+                run.extend(operation, parts[:-1], index):
+            continue
+
+        if run is not None:
+            plan.append(run if len(run.operations) > 1 else run.operations[0])
+            run = None
+        if index is False:
+            plan.append(operation)
+        else:
+            run = _ArrayRun(operation, parts[:-1], index)
+
+    if run is not None:
+        plan.append(run if len(run.operations) > 1 else run.operations[0])
+    return plan
+
+
+def _takes_cache(operation):
+    """
+    This function tells whether `operation` implements `_apply()`, and so
+    resolves its pointers through a cache and reports its changes to it,
+    rather than only `apply()`.
+
+    """
+    cls = type(operation)
+    takes = _CACHING_OPERATIONS.get(cls)
+    if takes is None:
+        takes = _CACHING_OPERATIONS[cls] = \
+            _unwrap(cls.apply) is _unwrap(PatchOperation.apply)
+    return takes
+
+
+# Operation class -> whether _takes_cache()
+_CACHING_OPERATIONS = {_ArrayRun: True}
+
+
+class _PatchOptimizer(object):
+    """The analysis of `JsonPatch.optimize()`.
+
+    The operations kept so far are in `operations`, dropped ones being None.
+    The open ones, those that no later operation has touched, are in a trie
+    of the locations, a node being ``[entry, {part: child node}, indices,
+    shifts]``, with the parts of the children that are array indices in
+    `indices`, and those of the children whose open operation inserts or
+    removes an array element in `shifts`, as sorted ints. An entry is
+    ``[position in operations, pointer parts, value, owned]``. Values are
+    only tracked for ``add`` and ``replace``; `owned` tells whether the value
+    is a copy that operations can be applied to.
+
+    An operation that inserts or removes an array element shifts the
+    following ones, so an operation on a later element relies on it. It is
+    then closed: changing or dropping it would move what the later operation
+    applies to.
+    """
+
+    # Operations the optimizer knows
+    _known = (AddOperation, RemoveOperation, ReplaceOperation, MoveOperation,
+              CopyOperation, TestOperation)
+
+    def __init__(self, operations):
+        self.classes = operations
+        self.operations = []
+        self.root = [None, {}, [], []]
+
+    def result(self):
+        """Returns the operations that were kept."""
+        return [op for op in self.operations if op is not None]
+
+    def add(self, operation):
         """
-        This function compares two dictionaries (src and dst) by identifying
-        added/removed keys and values using sets and recursively comparing the
-        corresponding values.
+        This function adds the next operation of the patch, merging it with
+        the open operations or dropping them where possible.
 
         Args:
-            path (str): The `path` input parameter is used to build the full path
-                of each item that has been removed or added by comparing the sets
-                of keys from both dictionaries.
-            src (dict): The `src` parameter is the dictionary that contains the
-                "original" values being compared.
-            dst (dict): The `dst` input parameter is the dictionary being compared
-                to the `src` dictionary.
+            operation (PatchOperation): The `operation` input parameter is the
+                operation to add.
 
         """
-        src_keys = set(src.keys())
-        dst_keys = set(dst.keys())
-        added_keys = dst_keys - src_keys
-        removed_keys = src_keys - dst_keys
+        op = operation.operation
+        kind = op.get('op')
+        if type(operation) not in self._known or \
+                (kind in ('add', 'replace', 'test') and 'value' not in op) or \
+                (kind in ('move', 'copy') and 'from' not in op):
+            # Nothing is known about what it does
+            self.root = [None, {}, [], []]
+            self.operations.append(op)
+            return
 
-        for key in removed_keys:
-            self._item_removed(path, str(key), src[key])
+        parts = tuple(operation.pointer.parts)
+        from_parts = None
+        if kind in ('move', 'copy'):
+            from_parts = tuple(operation._get_from_pointer().parts)
 
-        for key in added_keys:
-            self._item_added(path, str(key), dst[key])
+        if self._fold(op, kind, parts, from_parts):
+            return
 
-        for key in src_keys & dst_keys:
-            self._compare_values(path, key, src[key], dst[key])
+        node = self._node(parts)
+        if node is not None and node[0] is not None and from_parts is None:
+            if self._merge(node, op, kind, parts):
+                return
+
+        if kind == 'test':
+            self._touch(parts, False, False)
+        elif kind == 'copy':
+            self._touch(from_parts, False, False)
+            self._touch(parts, True, False)
+        elif kind == 'move':
+            self._touch(from_parts, True, False)
+            self._touch(parts, True, False)
+        else:
+            overwrites = kind != 'add' or not _is_index(parts)
+            self._touch(parts, True, overwrites)
+
+        self.operations.append(op)
+        if kind in ('add', 'replace', 'remove', 'test') and \
+                not (parts and parts[-1] == '-'):
+            value = op['value'] if kind in ('add', 'replace') else None
+            node = self._node(parts, True)
+            node[0] = [len(self.operations) - 1, parts, value, False]
+            index = _array_index(parts[-1]) if parts else None
+            if index is not None and kind in ('add', 'remove'):
+                bisect.insort(self._node(parts[:-1])[3], index)
+
+    def _node(self, parts, create=False):
+        """Returns the trie node of `parts`, or None if there is none."""
+        node = self.root
+        for part in parts:
+            child = node[1].get(part)
+            if child is None:
+                if not create:
+                    return None
+                child = node[1][part] = [None, {}, [], []]
+                index = _array_index(part)
+                if index is not None:
+                    bisect.insort(node[2], index)
+            node = child
+        return node
+
+    def _fold(self, op, kind, parts, from_parts):
+        """
+        This function applies the operation to the value of an open `add` or
+        `replace` above all locations of the operation, instead of keeping
+        it.
 
-    def _compare_lists(self, path, src, dst):
+        Returns:
+            bool: Whether the operation was applied to the value; when it
+            fails on the value, it is kept instead.
+
+        """
+        node = self.root
+        entry = None
+        for part in parts:
+            if node[0] is not None:
+                entry = node[0]
+                break
+            node = node[1].get(part)
+            if node is None:
+                return False
+        if entry is None or self.operations[entry[0]]['op'] == 'remove' or \
+                self.operations[entry[0]]['op'] == 'test':
+            return False
+
+        depth = len(entry[1])
+        if from_parts is not None and (len(from_parts) <= depth or
+                                       from_parts[:depth] != entry[1]):
+            return False
+
+        relative = dict(op)
+        relative['path'] = JsonPointer.from_parts(parts[depth:]).path
+        if from_parts is not None:
+            relative['from'] = JsonPointer.from_parts(from_parts[depth:]).path
+        if 'value' in op and kind != 'test':
+            relative['value'] = _copy_value(op['value'])
+        operation = self.classes[kind](relative)
+
+        value = entry[2]
+        if not entry[3] or kind == 'move':
+            # A move fails after removing the value it could not add
+            value = _copy_value(value)
+        try:
+            value = operation.apply(value)
+        except (JsonPatchException, JsonPointerException, TypeError):
+            return False
+
+        if kind != 'test':
+            entry[2] = value
+            entry[3] = True
+            kept = self.operations[entry[0]]
+            self.operations[entry[0]] = dict(kept, value=value)
+        return True
+
+    def _merge(self, node, op, kind, parts):
+        """
+        This function merges the operation with the open operation on the
+        same location, in `node`.
+
+        Returns:
+            bool: Whether the operation was merged into the open one, or
+            dropped.
+
+        """
+        entry = node[0]
+        kept = self.operations[entry[0]]
+        before = kept['op']
+        value = op.get('value')
+
+        if kind == 'test':
+            known = entry[2] if before in ('add', 'replace') else \
+                kept['value'] if before == 'test' else None
+            if before != 'remove' and known == value:
+                return True
+            return False
+
+        if kind == 'replace' and before in ('add', 'replace'):
+            self.operations[entry[0]] = dict(kept, value=value)
+            entry[2] = value
+            entry[3] = False
+            return True
+
+        if kind == 'add' and before == 'remove':
+            self.operations[entry[0]] = dict(op, op='replace')
+            entry[2] = value
+            entry[3] = False
+            return True
+
+        if kind == 'remove' and before == 'replace' or \
+                kind == 'add' and before in ('add', 'replace') and \
+                parts and not _is_index(parts):
+            # The value set before is removed, or overwritten; adding at the
+            # root is not the same as replacing it, it fails unless the root
+            # is an object.
+            self.operations[entry[0]] = None
+            node[0] = None
+        return False
+
+    def _touch(self, parts, writes, overwrites):
         """
-        This function compares two lists (src and dst) by iterating over their
-        elements and checking for equivalence. It recursively calls itself if
-        either list contains a dict or a sequence. If an item is found to be
-        different between the lists it triggers a callback function (itemRemoved
-        and itemAdded).
+        This function closes the open operations that an operation on
+        `parts` affects: those on it, above it and below it, and on the array
+        elements it shifts. Open writes below a location that is overwritten
+        as a whole are dropped.
 
         Args:
-            path (str): The `path` input parameter is used to build a path for
-                printing out item comparison details.
-            src (list): The `src` input parameter is the first list being compared
-                to the second list `dst`.
-            dst (dict): The `dst` input parameter is the second list to be compared
-                with the first list `src`.
+            parts (tuple): The `parts` input parameter is the location.
+            writes (bool): The `writes` input parameter tells whether the
+                operation modifies the location or only reads it.
+            overwrites (bool): The `overwrites` input parameter tells whether
+                the operation replaces or removes all there is at the
+                location.
 
         """
-        len_src, len_dst = len(src), len(dst)
-        max_len = max(len_src, len_dst)
-        min_len = min(len_src, len_dst)
-        for key in range(max_len):
-            if key < min_len:
-                old, new = src[key], dst[key]
-                if old == new:
-                    continue
+        if not parts:
+            self._close(self.root, overwrites)
+            self.root[0] = None
+            return
 
-                elif isinstance(old, MutableMapping) and \
-                    isinstance(new, MutableMapping):
-                    self._compare_dicts(_path_join(path, key), old, new)
+        parent = self.root
+        for part in parts[:-1]:
+            parent[0] = None
+            self._shifted(parent, part)
+            parent = parent[1].get(part)
+            if parent is None:
+                # Nothing is open below
+                return
+        parent[0] = None
+        self._shifted(parent, parts[-1])
+
+        node = parent[1].get(parts[-1])
+        if node is not None:
+            node[0] = None
+            self._close(node, overwrites)
+
+        index = _array_index(parts[-1]) if writes else None
+        if index is not None:
+            indices = parent[2]
+            cut = bisect.bisect_left(indices, index)
+            for shifted in indices[cut:]:
+                node = parent[1].pop(str(shifted))
+                node[0] = None
+                self._close(node, False)
+            del indices[cut:]
+
+    def _shifted(self, node, part):
+        """
+        This function closes the open operations that inserted or removed an
+        element of the array in `node` before the element `part`, or at it.
 
-                elif isinstance(old, MutableSequence) and \
-                        isinstance(new, MutableSequence):
-                    self._compare_lists(_path_join(path, key), old, new)
+        """
+        index = _array_index(part)
+        shifts = node[3]
+        if index is None or not shifts:
+            return
+        cut = bisect.bisect_right(shifts, index)
+        for shifted in shifts[:cut]:
+            child = node[1].get(str(shifted))
+            if child is not None:
+                child[0] = None
+        del shifts[:cut]
+
+    def _close(self, node, drop):
+        """Closes the open operations below `node`, dropping writes if `drop`."""
+        stack = list(node[1].values())
+        node[1].clear()
+        del node[2][:]
+        del node[3][:]
+        while stack:
+            node = stack.pop()
+            entry = node[0]
+            if drop and entry is not None and \
+                    self.operations[entry[0]]['op'] != 'test':
+                self.operations[entry[0]] = None
+            stack.extend(node[1].values())
+
+
+def _is_index(parts):
+    """Tells whether the last of `parts` could be an array index."""
+    return bool(parts) and (parts[-1] == '-' or
+                            _array_index(parts[-1]) is not None)
+
+
+class _ParentCache(object):
+    """The containers resolved while applying one patch, by path.
+
+    Operations resolve the parent of their location through the cache: the
+    deepest cached ancestor is looked up by path, and only the parts below it
+    are walked, adding the containers they reach. Only plain ``dict`` and
+    ``list`` containers are cached.
+
+    An operation that modifies a container reports it with :meth:`changed`,
+    which forgets what was cached below the modified member, and below all
+    members that it shifted in an array. The cache finds the paths to forget
+    by container, not by path, so a container that is reachable by several
+    paths is forgotten under each of them.
+    """
 
-                else:
-                    self._item_removed(path, key, old)
-                    self._item_added(path, key, new)
+    __slots__ = ('doc', 'parents', 'owners')
 
-            elif len_src > len_dst:
-                self._item_removed(path, len_dst, src[key])
+    # Whether the operations report their changes to the cache, see `_Journal`
+    recording = False
 
-            else:
-                self._item_added(path, key, dst[key])
+    def __init__(self, doc):
+        self.clear(doc)
 
-    def _compare_values(self, path, key, src, dst):
+    def clear(self, doc):
+        """Forgets all containers and starts over with the root `doc`."""
+        root = (doc, {}, '')
+        self.doc = doc
+        # path -> node, a node being (container, {part: child node}, path)
+        self.parents = {'': root}
+        # id(container) -> {path: node} of the nodes holding the container
+        self.owners = {id(doc): {'': root}}
+
+    def to_last(self, doc, pointer, location):
         """
-        This function compares two objects (`src` and `dst`) for changes by
-        recursively comparing their structure using `_compare_dicts` and `_compare_lists`.
+        This function resolves `pointer` up to its last part, like
+        `JsonPointer.to_last()` does, reusing the cached parent.
 
         Args:
-            path (str): The `path` input parameter is used to construct the path
-                for the item being compared.
-            key (str): The `key` parameter specifies the specific item within the
-                MutableMapping or MutableSequence that is being compared.
-            src (): The `src` input parameter is the first object to be compared.
-            dst (list): The `dst` input parameter is the destination object that
-                is being compared to the `src` object. The function checks if there
-                are any changes between the two objects by comparing their values
-                using `self.dumps()` method and checking if they are equal.
+            doc (dict): The `doc` input parameter is the document, which
+                replaces the cached one if an operation replaced the root.
+            pointer (JsonPointer): The `pointer` input parameter is the pointer
+                to resolve.
+            location (str): The `location` input parameter is the pointer as
+                the string it was created from, whose prefixes are the keys of
+                the cache. Pointer classes other than `JsonPointer` may resolve
+                another path than the one they were created from, so their
+                own is used instead.
+
+        Returns:
+            tuple: The parent container and the last part of the pointer.
 
         """
-        if isinstance(src, MutableMapping) and \
-                isinstance(dst, MutableMapping):
-            self._compare_dicts(_path_join(path, key), src, dst)
+        if doc is not self.doc:
+            self.clear(doc)
+        if type(pointer) is not JsonPointer or \
+                not isinstance(location, basestring):
+            if not _resolves_plainly(type(pointer)):
+                return pointer.to_last(doc)
+            location = pointer.path
+        end = location.rfind('/')
+        if end < 0:
+            return pointer.to_last(doc)
+
+        node = self.parents.get(location[:end])
+        if node is None:
+            node = self._resolve(pointer, location, end)
+            if node is None:
+                return pointer.to_last(doc)
+
+        subobj = node[0]
+        return subobj, pointer.get_part(subobj, pointer.parts[-1])
+
+    def _resolve(self, pointer, location, end):
+        """
+        This function walks to the parent of `pointer` from its deepest cached
+        ancestor, caching the containers on the way. It returns the node of
+        the parent, or None if the walk leaves plain containers or fails.
 
-        elif isinstance(src, MutableSequence) and \
-                isinstance(dst, MutableSequence):
-            self._compare_lists(_path_join(path, key), src, dst)
+        """
+        parents = self.parents
+        owners = self.owners
+        ends = [end]
+        end = location.rfind('/', 0, end)
+        node = parents.get(location[:end])
+        while node is None:
+            ends.append(end)
+            end = location.rfind('/', 0, end)
+            node = parents.get(location[:end])
+
+        depth = location.count('/', 0, end)
+        parts = pointer.parts
+        for end in reversed(ends):
+            subobj = node[0]
+            part = parts[depth]
+            depth += 1
+            cls = type(subobj)
+            try:
+                if cls is dict:
+                    child = subobj[part]
+                elif cls is list:
+                    index = _array_index(part)
+                    if index is None:
+                        return None
+                    child = subobj[index]
+                else:
+                    return None
+            except (KeyError, IndexError):
+                return None
+
+            cls = type(child)
+            if cls is not dict and cls is not list:
+                return None
+
+            path = location[:end]
+            child_node = (child, {}, path)
+            node[1][part] = child_node
+            parents[path] = child_node
+            owned = owners.get(id(child))
+            if owned is None:
+                owners[id(child)] = {path: child_node}
+            else:
+                owned[path] = child_node
+            node = child_node
+        return node
 
-        # To ensure we catch changes to JSON, we can't rely on a simple
-        # src == dst, because it would not recognize the difference between
-        # 1 and True, among other things. Using json.dumps is the most
-        # fool-proof way to ensure we catch type changes that matter to JSON
-        # and ignore those that don't. The performance of this could be
-        # improved by doing more direct type checks, but we'd need to be
-        # careful to accept type changes that don't matter when JSONified.
-        elif self.dumps(src) == self.dumps(dst):
+    def changed(self, container, part, shift):
+        """
+        This function forgets what was cached below the member `part` of
+        `container`, which an operation has just modified, and below the
+        members following it if `shift` is true.
+
+        """
+        owners = self.owners.get(id(container))
+        if not owners:
             return
 
+        for node in list(owners.values()):
+            children = node[1]
+            if not children or self.parents.get(node[2]) is not node:
+                # Nothing below it, or it was below another node of the
+                # container, which the document then contains.
+                continue
+            if shift:
+                keys = [key for key in children if int(key) >= part]
+            else:
+                keys = [str(part)]
+            for key in keys:
+                child = children.pop(key, None)
+                if child is not None:
+                    self._forget(child)
+
+    def _forget(self, node):
+        """Forgets `node` and all nodes below it."""
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            path = node[2]
+            del self.parents[path]
+            owners = self.owners[id(node[0])]
+            del owners[path]
+            if not owners:
+                del self.owners[id(node[0])]
+            stack.extend(node[1].values())
+
+
+class _Journal(object):
+    """The changes made while applying one patch, recorded as they are made.
+
+    The journal takes the place of the cache of resolved parents for the
+    operations, passing their lookups on to the `cache` it wraps, if any. In
+    turn the operations report every member they remove, add or replace,
+    along with the value it held. The journal keeps how to undo each change
+    on the container itself, for :meth:`rollback`, and, unless `inverse` is
+    None, the operations that undo it, so that the inverse of the patch comes
+    without diffing the documents.
+    """
+
+    __slots__ = ('cache', 'undo', 'inverse')
+
+    recording = True
+
+    def __init__(self, cache=None, inverse=True):
+        self.cache = cache
+        # (method, *args) calls undoing each change, in the order of the
+        # changes
+        self.undo = []
+        # The operations undoing each change, in the same order
+        self.inverse = [] if inverse else None
+
+    def clear(self, doc):
+        """Passes on to `_ParentCache.clear()`."""
+        if self.cache is not None:
+            self.cache.clear(doc)
+
+    def to_last(self, doc, pointer, location):
+        """Passes on to `_ParentCache.to_last()`."""
+        if self.cache is None:
+            return pointer.to_last(doc)
+        return self.cache.to_last(doc, pointer, location)
+
+    def changed(self, subobj, part, shift):
+        """Passes on to `_ParentCache.changed()`."""
+        if self.cache is not None:
+            self.cache.changed(subobj, part, shift)
+
+    def removed(self, subobj, part, value, pointer):
+        """
+        This function records that the member `part` of `subobj`, referenced
+        by `pointer`, has been removed; `value` is the value it held.
+
+        """
+        if isinstance(part, int):
+            self.undo.append((subobj.insert, part, value))
         else:
-            self._item_replaced(path, key, dst)
+            self.undo.append((subobj.__setitem__, part, value))
+        if self.inverse is not None:
+            self.inverse.append({'op': 'add', 'path': pointer.path,
+                                 'value': value})
 
+    def added(self, subobj, part, old, pointer):
+        """
+        This function records that a value has been added as the member
+        `part` of `subobj`, which is an array index even if `pointer` ends
+        with ``-``; `old` is the value it replaced, or `_MISSING`.
 
-def _path_join(path, key):
+        """
+        if old is _MISSING:
+            self.undo.append((subobj.__delitem__, part))
+        else:
+            self.undo.append((subobj.__setitem__, part, old))
+        if self.inverse is None:
+            return
+
+        path = pointer.path
+        if isinstance(part, int) and pointer.parts[-1] == '-':
+            path = path[:-1] + str(part)
+        if old is _MISSING:
+            self.inverse.append({'op': 'remove', 'path': path})
+        else:
+            # Unlike `replace`, `add` accepts an object member named "-"
+            self.inverse.append({'op': 'add', 'path': path, 'value': old})
+
+    def replaced(self, subobj, part, old, pointer):
+        """
+        This function records that the member `part` of `subobj` has been
+        replaced; `old` is the value it held. Both `subobj` and `part` are
+        None when the whole document was replaced, which leaves the document
+        itself unchanged.
+
+        """
+        if subobj is not None:
+            self.undo.append((subobj.__setitem__, part, old))
+        if self.inverse is not None:
+            self.inverse.append({'op': 'replace', 'path': pointer.path,
+                                 'value': old})
+
+    def moved(self):
+        """
+        This function records that the last removal and addition were made by
+        a `move` operation, to undo them with a `move` back rather than with
+        an ``add`` of the moved value, which the document still holds.
+
+        A move that replaced a member, or the whole document, is undone by
+        putting back what it replaced and then the moved value: the paths of
+        the replaced member are those after the removal, which the `move` back
+        would undo first. The value is copied then, as later operations may
+        still change it in the document.
+
+        """
+        if self.inverse is None:
+            return
+        undo_add = self.inverse.pop()
+        undo_remove = self.inverse.pop()
+        if undo_add['op'] == 'remove':
+            self.inverse.append({'op': 'move', 'from': undo_add['path'],
+                                 'path': undo_remove['path']})
+        else:
+            undo_remove['value'] = _copy_value(undo_remove['value'])
+            self.inverse.extend((undo_remove, undo_add))
+
+    def rollback(self):
+        """Undoes the recorded changes, from the last one to the first."""
+        undo = self.undo
+        while undo:
+            call = undo.pop()
+            call[0](*call[1:])
+
+    def patch(self, pointer_cls, thawed=False):
+        """
+        Returns the patch undoing the recorded changes, if recorded, with
+        plain copies of the values it restores if `thawed` (see
+        :func:`thaw`).
+        """
+        if self.inverse is None:
+            return None
+        inverse = self.inverse[::-1]
+        if thawed:
+            inverse = [dict(op, value=thaw(op['value'])) if 'value' in op
+                       else op for op in inverse]
+        return JsonPatch(inverse, pointer_cls=pointer_cls)
+
+
+# The value of a member that did not exist before being added
+_MISSING = object()
+
+
+def _copy_value(value):
     """
-    This function joins two strings `path` and `key`, where `key` is a nullable object.
+    This function deep-copies `value` like `copy.deepcopy()` does, walking
+    plain dicts and lists itself. Immutable JSON scalars are shared instead
+    of going through the copy machinery one by one; other values are left to
+    `copy.deepcopy()`.
 
     Args:
-        path (str): The `path` input parameter joins with the key using a separator
-            and returns the joined string.
-        key (str): The `key` input parameter specifies a sub-key within the path.
+        value (object): The `value` input parameter is the value to copy.
 
     Returns:
-        str: The function takes two arguments `path` and `key`, and returns a new
-        string representing the concatenation of `path` and `key`.
-        
-        The output returned by the function will be the concatenation of `path`
-        and `key`, with any occurrences of '~' replaced with '~0'.
+        object: The copy of `value`. Containers that appear several times in
+        `value` appear as often in the copy, copied once.
 
     """
-    if key is None:
-        return path
-
-    return path + '/' + str(key).replace('~', '~0').replace('/', '~1')
+    cls = type(value)
+    if cls in _JSON_SCALARS:
+        return value
+    if cls is not dict and cls is not list:
+        return copy.deepcopy(value)
+
+    memo = {}
+    stack = []
+
+    def copy_item(item):
+        cls = type(item)
+        if cls in _JSON_SCALARS:
+            return item
+        copied = memo.get(id(item))
+        if copied is not None:
+            return copied
+        if cls is not dict and cls is not list:
+            return copy.deepcopy(item, memo)
+        copied = memo[id(item)] = cls()
+        stack.append((item, copied))
+        return copied
+
+    root = copy_item(value)
+    while stack:
+        src, dst = stack.pop()
+        if type(src) is dict:
+            for key, item in src.items():
+                dst[key] = copy_item(item)
+        else:
+            dst.extend([copy_item(item) for item in src])
+    return root
 
 
+def _unwrap(method):
+    """Returns the function behind a (class or unbound) method."""
+    return getattr(method, '__func__', method)
 
 
+def _array_index(part):
+    """Returns `part` as an array index, or None if it is not a valid one."""
+    if _RE_ARRAY_INDEX.match(part):
+        return int(part)
+    return None